@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+"""
+Converts HDF5 containers saved by Titta to Parquet files (requires pyarrow).
+
+Each .h5-file in the 'data' folder is converted to a folder with the same
+name, with one Parquet file per table (gaze, msg, time_sync, ...). The
+tables can then be read with Titta_parquet() in import_funcs.py, which
+only reads the requested columns and rows from file.
+
+"""
+from pathlib import Path
+from titta import storage
+
+# %%
+
+files = (Path.cwd() / 'data').glob('*.h5')
+
+for f in files:
+
+    path = storage.h5_to_parquet(str(f))
+
+    print(str(f) + ' converted to folder ', path)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Runs the online event detector (titta/events.py) over recorded data, to
+see which events it would have detected during the experiment and how
+long after their onset they would have been detected.
+
+The gaze data in each .h5-file in the 'data' folder are fed to the
+detector in batches of the size the detector would get if it was called
+once per screen refresh, and the detection latency (time from the onset
+of an event to the sample at which it was detected) is summarized per
+event type.
+
+"""
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from titta import events
+from titta.helpers_tobii import MonitorGeometry
+
+#%% Settings
+screen_resolution = (1920, 1080)    # pixels
+viewing_distance = 65.0             # cm
+screen_refresh_rate = 60            # Hz
+
+#%%
+files = (Path.cwd() / 'data').glob('*.h5')
+
+for f in files:
+
+    print(f)
+
+    # Screen size and sampling rate from the info about the tracker
+    with open(str(f)[:-3] + '.json') as fh:
+        info = json.load(fh)
+
+    geometry = MonitorGeometry(info['display_area']['width'] / 10.0,
+                               screen_resolution, viewing_distance)
+    detector = events.EventDetector(geometry)
+
+    df = pd.read_hdf(f, 'gaze')
+    data = {c: df[c].to_numpy() for c in df.columns}
+
+    # Add the data as they would have arrived during the recording
+    batch_size = int(np.ceil(info['sampling_frequency'] / screen_refresh_rate))
+    detected = []
+    for i in range(0, len(df), batch_size):
+        detected += detector.add_gaze({c: v[i:i + batch_size] for c, v in data.items()})
+
+    df_events = pd.DataFrame(detected, columns=events.Event._fields)
+    df_events['latency (ms)'] = (df_events.detection_time_stamp - df_events.time_stamp) / 1000
+
+    print(df_events.groupby('type')['latency (ms)'].describe())
+    print('Final velocity threshold: {:.1f} deg/s'.format(detector.threshold))
@@ -14,15 +14,16 @@ import numpy as np
 import pandas as pd
 import os
 from pathlib import Path
+from titta.messages import MessageLog
 
 # %%
-def extract_trial_data(df_et_data, df_msg, msg_onset, msg_offset):
+def extract_trial_data(df_et_data, msg_log, msg_onset, msg_offset):
     ''' Extracts data from one trial associated with the
     stimulus name.
 
     Args:
         df_et_data - Pandas dataframe with sample et-data (output from Titta)
-        df_msg - Pandas dataframe containing messages (assume stimname is 'my_im.png')
+        msg_log - titta.messages.MessageLog with the messages (assume stimname is 'my_im.png')
         msg_onset (str) - message sent at stimulus onset
         msg_offset (str) - message sent at stimulus onset
 
@@ -33,11 +34,8 @@ def extract_trial_data(df_et_data, df_msg, msg_onset, msg_offset):
     '''
 
     # Find timestamps for data belonging to this stimulus
-    start_idx = np.where(df_msg.msg == msg_onset)[0][0]
-    stop_idx = np.where(df_msg.msg == msg_offset)[0][0]
-
-    start_time_stamp = df_msg.system_time_stamp[start_idx]
-    stop_time_stamp = df_msg.system_time_stamp[stop_idx]
+    start_time_stamp = msg_log.first(msg_onset)
+    stop_time_stamp = msg_log.first(msg_offset)
 
     # print(start_idx, stop_idx, start_time_stamp, stop_time_stamp)
     #
@@ -62,19 +60,14 @@ for f in files:
     # Convert to pandas dataframes
     df_gaze = pd.read_hdf(f, 'gaze')
     df_msg= pd.read_hdf(f, 'msg')
+    msg_log = MessageLog.from_dataframe(df_msg)
 
     # Read message for onset and offset
     # Assumption is that messages are on the form (must be unique)
     # 'onset_stimulusname' for the onset of a stimulus and
     # 'offset_stimulusname'for the offset of a stimulus
-    onset = []
-    offset = []
-    for i, row in df_msg.iterrows():
-
-        if 'onset' in row.msg:
-            onset.append(row.msg)
-        if 'offset' in row.msg:
-            offset.append(row.msg)
+    onset = [msg for ts, msg in msg_log.contains('onset')]
+    offset = [msg for ts, msg in msg_log.contains('offset')]
     trial_msg = zip(onset, offset)
 
     # Create a folder to put the trials
@@ -83,7 +76,7 @@ for f in files:
 
     # Extract relevant trial data and save in format required by I2MC
     for t in trial_msg:
-        df_trial = extract_trial_data(df_gaze, df_msg, t[0], t[1])
+        df_trial = extract_trial_data(df_gaze, msg_log, t[0], t[1])
 
         filename = t[0].split('_', 1)[1] + '.tsv'
         df_trial.to_csv(str(path) + os.sep + filename, sep='\t', index=False)
@@ -8,8 +8,11 @@ Created on Thu Sep 19 10:57:23 2019
 # =============================================================================
 # Import modules
 # =============================================================================
+import json
 import numpy as np
 import pandas as pd
+import h5py
+from pathlib import Path
 
 
 # =============================================================================
@@ -60,6 +63,148 @@ def Titta(fname, res=[1920,1080]):
 
     return df
 
+# =============================================================================
+# Import HDF5 container saved by Titta
+# =============================================================================
+def Titta_h5(fname, key='gaze', columns=None):
+    '''
+    Imports one table (e.g., gaze or messages) from a HDF5 container saved by
+    Titta. Containers saved with settings.DATA_STORAGE_FORMAT = 'columnar'
+    store each column as a separate dataset, and only the requested columns
+    are read from file. Tables saved by pandas are read in full.
+
+
+    Parameters
+    ----------
+    fname : string
+        The file (filepath)
+    key : string
+        Name of the table, e.g., 'gaze', 'msg', or 'time_sync'
+    columns : list of strings
+        (optional) Columns to read, e.g., ['system_time_stamp',
+        'left_gaze_point_on_display_area_x']. Default: all columns
+
+    Returns
+    -------
+    df : pandas.DataFrame
+         Table with the requested columns
+    '''
+
+    with h5py.File(fname, 'r') as hf:
+        columnar = key in hf and 'pandas_type' not in hf[key].attrs
+        if columnar:
+            grp = hf[key]
+            if columns is None:
+                columns = list(grp.keys())
+
+            df = pd.DataFrame()
+            for c in columns:
+                if h5py.check_string_dtype(grp[c].dtype) is not None:
+                    df[c] = grp[c].asstr()[:]
+                else:
+                    df[c] = grp[c][:]
+
+    if not columnar:
+        df = pd.read_hdf(fname, key)
+        if columns is not None:
+            df = df[columns]
+
+    return df
+
+# =============================================================================
+# Import segments saved by Titta
+# =============================================================================
+def Titta_segments(fname_manifest, t0=None, t1=None, key='gaze', columns=None):
+    '''
+    Imports one table (e.g., gaze) from a recording split into segments
+    (settings.SEGMENT_MAX_SAMPLES, SEGMENT_MAX_DURATION, or SEGMENT_ON_MESSAGE).
+    Only the segments that overlap with the time range [t0, t1] are read.
+
+
+    Parameters
+    ----------
+    fname_manifest : string
+        The manifest (<filename>.manifest.json)
+    t0 : int
+        (optional) First system time stamp, e.g., of a trial onset message
+    t1 : int
+        (optional) Last system time stamp, e.g., of a trial offset message
+    key : string
+        Name of the table, e.g., 'gaze', or 'time_sync'
+    columns : list of strings
+        (optional) Columns to read. Default: all columns
+
+    Returns
+    -------
+    df : pandas.DataFrame
+         Table with the samples recorded between t0 and t1
+    '''
+
+    with open(fname_manifest, 'r') as f:
+        manifest = json.load(f)
+
+    folder = Path(fname_manifest).parent
+    t_col = 'system_request_time_stamp' if key == 'time_sync' else 'system_time_stamp'
+    if columns is not None and t_col not in columns:
+        columns = [t_col] + list(columns)
+
+    dfs = []
+    for segment in manifest['segments']:
+        if segment['end_time_stamp'] is None:
+            continue
+        if t0 is not None and segment['end_time_stamp'] < t0:
+            continue
+        if t1 is not None and segment['start_time_stamp'] > t1:
+            continue
+
+        with h5py.File(folder / segment['file'], 'r') as hf:
+            if key not in hf or len(hf[key].keys()) == 0:
+                continue
+        dfs.append(Titta_h5(folder / segment['file'], key, columns))
+
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.concat(dfs, ignore_index=True)
+    if t0 is not None:
+        df = df[df[t_col] >= t0]
+    if t1 is not None:
+        df = df[df[t_col] <= t1]
+
+    return df.reset_index(drop=True)
+
+# =============================================================================
+# Import Parquet files saved by Titta
+# =============================================================================
+def Titta_parquet(path, key='gaze', columns=None, filters=None):
+    '''
+    Imports one table (e.g., gaze or messages) from a folder with Parquet
+    files saved by Titta (settings.DATA_STORAGE_FORMAT = 'parquet'), or
+    converted with titta.storage.h5_to_parquet. Only the requested columns,
+    and row groups that pass the filters, are read from file.
+
+
+    Parameters
+    ----------
+    path : string
+        The folder with Parquet files
+    key : string
+        Name of the table, e.g., 'gaze', 'msg', or 'time_sync'
+    columns : list of strings
+        (optional) Columns to read. Default: all columns
+    filters : list of tuples
+        (optional) Rows to read, e.g., [('system_time_stamp', '>=', t0),
+        ('system_time_stamp', '<', t1)]. Default: all rows
+
+    Returns
+    -------
+    df : pandas.DataFrame
+         Table with the requested columns and rows
+    '''
+
+    return pd.read_parquet(Path(path) / (key + '.parquet'),
+                           columns=columns, filters=filters)
+
 # =============================================================================
 # Import Tobii TX300
 # =============================================================================
@@ -1,8 +1,6 @@
+import math
 import numpy as np
-import typing
-from collections import namedtuple
-
-Sample = namedtuple('Sample', 'ts, x, y')
+from collections import deque
 
 
 class Filter:
@@ -18,9 +16,19 @@ class Filter:
         self._t         = 0.
         self._tLastStep = -np.inf
         self._interval  = None
-        self._buffer: typing.List[Sample] = []
         self._Tacc      = None      # acceleration of exponential reset curve
 
+        # valid samples (ts, x, y) of the two time windows: the last
+        # timeWindow ms (A), and the timeWindow ms before that (B), with
+        # running sums of x and y, so their means cost the same regardless
+        # of the sampling rate
+        self._winA      = deque()
+        self._winB      = deque()
+        self._sumA      = [0., 0.]
+        self._sumB      = [0., 0.]
+        self._nAdded    = 0         # sums are recomputed every _resumInterval samples,
+        self._resumInterval = 10000 # so rounding errors do not accumulate
+
         self._recalculateResetAcc()
 
     def _recalculateResetAcc(self):
@@ -51,36 +59,41 @@ class Filter:
         #  x: horizontal x position
         #  y: horizontal y position
 
-        if np.isnan(self._x) and np.isnan(self._y) and self._t == 0:
+        if math.isnan(self._x) and math.isnan(self._y) and self._t == 0:
             self._x = x
             self._y = y
             self._t = self.Tslow
 
         # if nan input, just return last value
-        # TODO: optionally, if obj last value is too old (look at
-        # latest sample in buffer compared to incoming timestamp),
-        # stop showing data
-        if np.isnan(x) or np.isnan(y):
+        if math.isnan(x) or math.isnan(y):
             return self._x, self._y
-            
-        # add incoming data to buffer
-        self._buffer.append(Sample(ts, x, y))
-
-        # run through available data and divide up into time windows
-        dt = np.array([ts-s.ts for s in self._buffer])
-        # throw out data older than we're interested in
-        remove = dt > 2*self.timeWindow
-        self._buffer = [s for s,r in zip(self._buffer,remove) if not r]
-        dt = dt[np.logical_not(remove)]
-
-        # split up buffer into two time windows
-        qdt = dt>self.timeWindow
-        xs  = np.array([s.x for s in self._buffer])
-        ys  = np.array([s.y for s in self._buffer])
-        avgXB = xs[qdt].mean()
-        avgYB = ys[qdt].mean()
-        avgXA = xs[np.logical_not(qdt)].mean()
-        avgYA = ys[np.logical_not(qdt)].mean()
+
+        # add incoming data to the newest time window, move data older than
+        # timeWindow to the other window, and throw out data older than
+        # 2*timeWindow
+        self._winA.append((ts, x, y))
+        self._sumA[0] += x
+        self._sumA[1] += y
+        while ts-self._winA[0][0] > self.timeWindow:
+            s = self._winA.popleft()
+            self._sumA[0] -= s[1]
+            self._sumA[1] -= s[2]
+            self._winB.append(s)
+            self._sumB[0] += s[1]
+            self._sumB[1] += s[2]
+        removed = False
+        while self._winB and ts-self._winB[0][0] > 2*self.timeWindow:
+            s = self._winB.popleft()
+            self._sumB[0] -= s[1]
+            self._sumB[1] -= s[2]
+            removed = True
+
+        self._nAdded += 1
+        if self._nAdded % self._resumInterval == 0:
+            self._sumA = [math.fsum(s[1] for s in self._winA), math.fsum(s[2] for s in self._winA)]
+            self._sumB = [math.fsum(s[1] for s in self._winB), math.fsum(s[2] for s in self._winB)]
+
+        nA, nB = len(self._winA), len(self._winB)
 
         # if we swap to Tfast, we exponentially return to Tslow. We do
         # so over a hardcoded period of 100 ms. Compute current T
@@ -90,19 +103,19 @@ class Filter:
         else:
             self._t = self.Tslow
         # check for fast movement, reset T to Tfast if there is
-        if not np.isnan(avgXA) and not np.isnan(avgXB):
-            dist = np.hypot(avgXB-avgXA,avgYB-avgYA)
+        if nB > 0:
+            dist = math.hypot(self._sumB[0]/nB-self._sumA[0]/nA, self._sumB[1]/nB-self._sumA[1]/nA)
             if dist > self.distT:
                 self._t          = self.Tfast
                 self._tLastStep  = ts
-        
+
         # if we don't know the sampling interval yet, determine it
         # from the data
         # check if we have enough data to start the filter. We do that by checking if we just threw out a sample because its too old, that means the buffer is fully filled.
         # (actually its ready one sample earlier, but thats hard to detect)
-        validFilter = np.any(remove)
-        if validFilter and self._interval is None and len(self._buffer)>1:
-            self._interval  = -np.diff(dt).mean()
+        if removed and self._interval is None and nA+nB > 1:
+            tFirst = self._winB[0][0] if nB > 0 else self._winA[0][0]
+            self._interval = (ts-tFirst)/(nA+nB-1)
 
         # smooth based on new incoming sample
         if self._interval is not None:
@@ -112,7 +125,21 @@ class Filter:
         else:
             # return average of data we have seen so far, best we can
             # do until we have seen enough data to really go at it
-            self._x = np.nanmean(xs)
-            self._y = np.nanmean(ys)
-        
-        return self._x, self._y
\ No newline at end of file
+            self._x = (self._sumA[0]+self._sumB[0])/(nA+nB)
+            self._y = (self._sumA[1]+self._sumB[1])/(nA+nB)
+
+        return self._x, self._y
+
+    def add_samples(self, ts, x, y):
+        # ts: timestamps in ms (increasing)
+        #  x: horizontal x positions
+        #  y: horizontal y positions
+        # returns the filtered x and y position after each sample
+        fx = np.empty(len(ts))
+        fy = np.empty(len(ts))
+        for i, (t, xi, yi) in enumerate(zip(np.asarray(ts, dtype=float).tolist(),
+                                            np.asarray(x, dtype=float).tolist(),
+                                            np.asarray(y, dtype=float).tolist())):
+            fx[i], fy[i] = self.add_sample(t, xi, yi)
+
+        return fx, fy
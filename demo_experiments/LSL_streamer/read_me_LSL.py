@@ -46,24 +46,20 @@ def get_color(i):
     return dot_col[i % len(dot_col)]
 
 def tobii_get_gaze(samples, filter=None, ts_field='system_time_stamp'):
-    def get_sample(samples,idx,ts_field):
-        lx = samples['left_gaze_point_on_display_area_x'][idx]
-        ly = samples['left_gaze_point_on_display_area_y'][idx]
-        rx = samples['right_gaze_point_on_display_area_x'][idx]
-        ry = samples['right_gaze_point_on_display_area_y'][idx]
-        x,y = np.nanmean([lx, rx]), np.nanmean([ly, ry])
-        return samples[ts_field][idx]/1000, x*SCREEN_RES[0], y*SCREEN_RES[1] # convert us->ms, and norm to pixels
-    
     if len(samples[ts_field])==0:
         return np.nan,np.nan
 
+    # average of the two eyes, all samples at once
+    x = np.nanmean([samples['left_gaze_point_on_display_area_x'],
+                    samples['right_gaze_point_on_display_area_x']], axis=0)*SCREEN_RES[0]  # convert norm to pixels
+    y = np.nanmean([samples['left_gaze_point_on_display_area_y'],
+                    samples['right_gaze_point_on_display_area_y']], axis=0)*SCREEN_RES[1]
+
     if filter is None:
-        return get_sample(samples,-1,ts_field)[1:]
+        return x[-1], y[-1]
 
-    for i in range(len(samples[ts_field])):
-        ts,x,y = get_sample(samples,i,ts_field)
-        fx,fy = filter.add_sample(ts,x,y)
-    return fx, fy
+    fx,fy = filter.add_samples(np.asarray(samples[ts_field])/1000, x, y)  # convert us->ms
+    return fx[-1], fy[-1]
 
 def draw_sample(dot, x, y):
     dot.pos = (x-SCREEN_RES[0]/2, SCREEN_RES[1]/2-y)
@@ -3,7 +3,7 @@ import pandas as pd
 from psychopy import visual, monitors, core
 import numpy as np
 import matplotlib.pyplot as plt
-from titta import Titta, helpers_tobii as helpers
+from titta import Titta, helpers_tobii as helpers, storage
 import h5py
 
 dummy_mode = False
@@ -192,22 +192,32 @@ if not dummy_mode:
     if "notification" in keys:
         df_notification = pd.read_hdf(filename, 'notification')
 
+    # Enums (e.g., notification_type or the level of a log entry) are stored
+    # as integer codes. Convert them back to names with the lookup table
+    if "enum_lookup" in keys:
+        lookups = storage.read_enum_lookup(pd.read_hdf(filename, 'enum_lookup'))
+        df_log = storage.decode_enums(df_log, lookups, 'log')
+        if "external_signal" in keys:
+            df_external_signal = storage.decode_enums(df_external_signal, lookups, 'external_signal')
+        if "notification" in keys:
+            df_notification = storage.decode_enums(df_notification, lookups, 'notification')
+
     # Read eye images (if recorded)
     if "eye_image" in keys:
-        with h5py.File(filename, "r") as f:
-            # Print all root level object names (aka keys)
-            # these can be group or dataset names
-            print("Keys: %s" % f.keys())
+        # One row per eye image, in the order they were recorded
+        eye_image_metadata = pd.read_hdf(filename, 'eye_metadata')
 
-            # Read the eye_image group
+        with h5py.File(filename, "r") as f:
+            # Read the eye_image group. Images of the same size are stacked
+            # in one N x H x W dataset per size, e.g., '512x640'
             eye_image_group = f.get('eye_image')
             print("Groupe items: %s" % eye_image_group.items())
 
-            # Read eye images from group (each image is a HDF dataset)
+            # Image i is row image_index[i] of the dataset image_stack[i]
             # eye_images is a list of 2D arrays (the eye images)
-            eye_images = [i[:] for i in eye_image_group.values()] # Gives list of arrays with eye images
-
-        eye_image_metadata = pd.read_hdf(filename, 'eye_metadata')
+            eye_images = [eye_image_group[stack][index] for stack, index in
+                          zip(eye_image_metadata['image_stack'],
+                              eye_image_metadata['image_index'])]
 
     # %% Plot some data
 
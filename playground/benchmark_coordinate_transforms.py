@@ -0,0 +1,60 @@
+'''
+Measures the time per call to convert gaze positions from Tobii's coordinate
+system to PsychoPy pixels, with helpers.tobii2pix and with a cached
+helpers.CoordinateTransform (with and without a preallocated output array).
+
+A single sample (1 x 2, as when drawing gaze every frame) and a block of
+samples (N x 2) are converted. tobii2pix_old is the implementation
+tobii2pix had before it used CoordinateTransform (deepcopy of the input and
+column-wise arithmetic).
+
+'''
+# Import modules
+import copy
+import timeit
+import numpy as np
+from titta import helpers_tobii as helpers
+
+#%% Settings
+n_calls = 100000
+sizes = [1, 600]                # Number of samples per call
+
+#%%
+class Window(object):
+    ''' Stands in for a PsychoPy window (only size and units are used)
+    '''
+    def __init__(self, size, units):
+        self.size = size
+        self.units = units
+
+win = Window((1920, 1080), 'pix')
+
+#%%
+def tobii2pix_old(pos, win):
+    pos_temp = copy.deepcopy(pos)
+
+    pos_temp[:, 0] = pos_temp[:, 0] - 0.5
+    pos_temp[:, 1] = (pos_temp[:, 1] - 0.5) * -1
+
+    pos_temp[:, 0] = pos_temp[:, 0] * win.size[0]
+    pos_temp[:, 1] = pos_temp[:, 1] * win.size[1]
+
+    return pos_temp
+
+#%% Run benchmark
+print(f'{"method":>32} {"samples":>8} {"us/call":>8}')
+for n in sizes:
+    pos = np.random.rand(n, 2)
+    out = np.empty_like(pos)
+    transform = helpers.CoordinateTransform.for_window(win, 'pix')
+
+    assert np.allclose(tobii2pix_old(pos, win), transform.apply(pos))
+
+    methods = {'tobii2pix (before)': lambda: tobii2pix_old(pos, win),
+               'tobii2pix': lambda: helpers.tobii2pix(pos, win),
+               'CoordinateTransform.apply': lambda: transform.apply(pos),
+               'CoordinateTransform.apply(out)': lambda: transform.apply(pos, out=out)}
+
+    for name, f in methods.items():
+        t = min(timeit.repeat(f, number=n_calls, repeat=3)) / n_calls
+        print(f'{name:>32} {n:>8} {t * 1e6:>8.2f}')
@@ -0,0 +1,100 @@
+'''
+Measures how long sending a message takes while the journal
+(settings.JOURNAL_DATA) copies samples and fsyncs the journal in its
+thread.
+
+send_message appends the message to the journal with Journal.write_message,
+which is timed here (the other work done by send_message does not depend on
+the journal). Messages are sent at about the rate of a 120 Hz display, while
+a simulated buffer delivers gaze samples at 1200 Hz. The duration of each
+fsync is reported as well: messages should not wait for it.
+
+'''
+# Import modules
+import numpy as np
+import tempfile
+import threading
+import time
+from pathlib import Path
+from titta import journal
+
+#%% Settings
+Fs = 1200                   # Sampling rate (Hz)
+duration = 10               # Duration of the test (s)
+message_interval = 1 / 120  # Time between messages (s)
+journal_interval = 0.5      # Same as the default settings.JOURNAL_INTERVAL
+
+columns = ['device_time_stamp', 'system_time_stamp']
+for eye in ['left', 'right']:
+    columns += [f'{eye}_gaze_point_on_display_area_{c}' for c in 'xy']
+    columns += [f'{eye}_gaze_point_in_user_coordinates_{c}' for c in 'xyz']
+    columns += [f'{eye}_gaze_point_valid', f'{eye}_pupil_diameter']
+    columns += [f'{eye}_gaze_origin_in_user_coordinates_{c}' for c in 'xyz']
+
+#%%
+class SimulatedBuffer(object):
+    ''' Returns the gaze samples that would have been recorded until now
+    '''
+    def __init__(self):
+        self.t0 = time.perf_counter()
+
+    def has_stream(self, stream):
+        return stream == 'gaze'
+
+    def peek_time_range(self, stream, t0):
+        t1 = int((time.perf_counter() - self.t0) * 1e6)
+        ts = np.arange(max(t0, 0), t1, int(1e6 / Fs), dtype=np.int64)
+
+        data = {}
+        for c in columns:
+            if 'time_stamp' in c:
+                data[c] = ts
+            elif c.endswith('_valid'):
+                data[c] = np.ones(len(ts), dtype=bool)
+            else:
+                data[c] = np.random.rand(len(ts))
+
+        return data
+
+#%%
+class TimedJournal(journal.Journal):
+    ''' Journal that records how long each fsync takes
+    '''
+    fsync_durations = []
+
+    def _drain(self):
+        fsync = journal.os.fsync
+        def timed_fsync(fd):
+            t0 = time.perf_counter()
+            fsync(fd)
+            self.fsync_durations.append(time.perf_counter() - t0)
+
+        journal.os.fsync = timed_fsync
+        try:
+            super()._drain()
+        finally:
+            journal.os.fsync = fsync
+
+#%%
+with tempfile.TemporaryDirectory() as folder:
+    j = TimedJournal(SimulatedBuffer(), str(Path(folder) / 'benchmark'),
+                     interval=journal_interval)
+    j.start()
+
+    latencies = []
+    t_end = time.perf_counter() + duration
+    while time.perf_counter() < t_end:
+        t0 = time.perf_counter()
+        j.write_message(int(t0 * 1e6), 'onset trial_1 stimulus.png')
+        latencies.append(time.perf_counter() - t0)
+        time.sleep(message_interval)
+
+    j.stop()
+
+latencies = np.array(latencies) * 1e6
+fsync_durations = np.array(TimedJournal.fsync_durations) * 1e6
+print(f'{len(latencies)} messages, {len(fsync_durations)} fsyncs')
+print('write_message (us): median {:.1f}, 99th percentile {:.1f}, max {:.1f}'.format(
+      np.median(latencies), np.percentile(latencies, 99), np.max(latencies)))
+print('fsync (us): median {:.1f}, max {:.1f}'.format(
+      np.median(fsync_durations), np.max(fsync_durations)))
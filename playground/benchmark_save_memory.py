@@ -0,0 +1,104 @@
+'''
+Measures the peak memory used when saving gaze data, for recordings of
+different durations, with and without consuming the buffer in chunks
+(settings.SAVE_CHUNK_SIZE).
+
+The samples are generated on the fly by a simulated buffer. A real TittaPy
+buffer keeps its samples in C++ memory, which is not seen by tracemalloc,
+so the reported peak is the memory used by the saving itself. With chunks,
+the peak should stay the same regardless of the duration of the recording.
+
+'''
+# Import modules
+import numpy as np
+import tempfile
+import tracemalloc
+import time
+import h5py
+from pathlib import Path
+from titta import storage
+
+#%% Settings
+Fs = 600                        # Sampling rate (Hz)
+durations = [2, 5, 10, 20]      # Duration of recordings (minutes)
+chunk_size = 100000             # Same as the default settings.SAVE_CHUNK_SIZE
+
+columns = ['device_time_stamp', 'system_time_stamp']
+for eye in ['left', 'right']:
+    columns += [f'{eye}_gaze_point_on_display_area_{c}' for c in 'xy']
+    columns += [f'{eye}_gaze_point_in_user_coordinates_{c}' for c in 'xyz']
+    columns += [f'{eye}_gaze_point_valid', f'{eye}_gaze_point_available']
+    columns += [f'{eye}_pupil_diameter', f'{eye}_pupil_valid', f'{eye}_pupil_available']
+    columns += [f'{eye}_gaze_origin_in_user_coordinates_{c}' for c in 'xyz']
+    columns += [f'{eye}_gaze_origin_in_track_box_coordinates_{c}' for c in 'xyz']
+    columns += [f'{eye}_gaze_origin_valid', f'{eye}_gaze_origin_available']
+    columns += [f'{eye}_eye_openness_diameter', f'{eye}_eye_openness_valid',
+                f'{eye}_eye_openness_available']
+
+#%%
+class SimulatedBuffer(object):
+    ''' Generates gaze samples when they are consumed
+    '''
+    def __init__(self, n_samples):
+        self.n_left = n_samples
+        self.t = 0
+
+    def has_stream(self, stream):
+        return stream == 'gaze'
+
+    def consume_N(self, stream, N):
+        n = min(N, self.n_left)
+        self.n_left -= n
+
+        data = {}
+        ts = self.t + np.arange(n, dtype=np.int64) * int(1e6 / Fs)
+        for c in columns:
+            if 'time_stamp' in c:
+                data[c] = ts
+            elif c.endswith('_valid') or c.endswith('_available'):
+                data[c] = np.ones(n, dtype=bool)
+            else:
+                data[c] = np.random.rand(n)
+        self.t += n * int(1e6 / Fs)
+
+        return data
+
+#%%
+def save(fname, n_samples, storage_format, chunk_size):
+    ''' Saves all samples in the simulated buffer, returns peak memory (MB)
+    and time (s) taken
+    '''
+    buffer = SimulatedBuffer(n_samples)
+
+    tracemalloc.start()
+    t0 = time.perf_counter()
+
+    # Consuming the samples from the buffer is part of the memory used
+    if chunk_size is None:
+        chunks = [buffer.consume_N('gaze', n_samples)]
+    else:
+        chunks = storage.iter_chunks(buffer, 'gaze', chunk_size)
+
+    if storage_format == 'columnar':
+        with h5py.File(fname, 'a') as hf:
+            for temp in chunks:
+                storage.write_stream(hf, 'gaze', temp)
+    else:
+        storage.write_stream_pandas(fname, 'gaze', chunks)
+    dur = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return peak / 1024 / 1024, dur
+
+#%% Run benchmark
+print(f'{"format":>10} {"minutes":>8} {"chunked":>8} {"peak (MB)":>10} {"time (s)":>9}')
+with tempfile.TemporaryDirectory() as tmp_dir:
+    for storage_format in ['pandas', 'columnar']:
+        for minutes in durations:
+            n_samples = int(minutes * 60 * Fs)
+            for chunked in [False, True]:
+                fname = str(Path(tmp_dir) / f'{storage_format}_{minutes}_{chunked}.h5')
+                peak, dur = save(fname, n_samples, storage_format,
+                                 chunk_size if chunked else None)
+                print(f'{storage_format:>10} {minutes:>8} {str(chunked):>8} {peak:>10.1f} {dur:>9.2f}')
@@ -24,6 +24,8 @@ et_name = 'Tobii Pro Spectrum'
 # Change any of the default dettings?e
 settings = Titta.get_defaults(et_name)
 settings.FILENAME = 'testfile'
+settings.LATENCY_MONITOR = True
+settings.MONITOR_INTERVAL = 0.002
 
 #%% Connect to eye tracker and calibrate
 tracker = Titta.Connect(settings)
@@ -37,7 +39,6 @@ n_samples = int(tracker.get_sample_rate() * dur)
 
 out = []
 k = 0
-ts_old = 0
 
 tracker.start_recording(gaze=True,
                             time_sync=True,
@@ -48,28 +49,30 @@ tracker.start_recording(gaze=True,
 
 t0 = time.perf_counter()
 out = np.zeros((n_samples, 2))
+tracker.reset_cursor('gaze')
 while k < n_samples:
 
-    # Grab teh most recent sample
-    samples = tracker.buffer.peek_N('gaze', 1, 'end')
+    # Grab all samples that arrived since the previous iteration
+    # (the samples are not consumed, so they are still saved)
+    samples = tracker.read_new('gaze')
+    ts = samples['system_time_stamp']
 
-    # is there a sample?
-    if len(samples['system_time_stamp']) > 0:
-        ts = samples['system_time_stamp'][0]
-    else:
+    # are there new samples?
+    if len(ts) == 0:
         continue
 
-    # is it a new sample?
-    if ts == ts_old:
-        continue
-
-    out[k, 0] = time.perf_counter()
-    out[k, 1] = ts
+    n = min(len(ts), n_samples - k)
+    out[k:k + n, 0] = time.perf_counter()
+    out[k:k + n, 1] = ts[:n]
 
-    k += 1
-    ts_old = ts
+    k += n
 
 print(time.perf_counter() - t0)
+
+# Latency of the samples and intervals between samples, as measured
+# in the background while recording
+for key, value in tracker.latency_summary().items():
+    print(key, value)
 tracker.stop_recording(gaze=True,
                             time_sync=True,
                             eye_image=True,
@@ -0,0 +1,119 @@
+'''
+Checks that the Olsson filter used by the LSL streamer
+(demo_experiments/LSL_streamer/OlssonFilter.py), which keeps running sums
+of its two time windows, gives the same output as the implementation it
+replaced. FilterOld is that implementation: it rebuilt both windows from a
+list of all samples in the last 2*timeWindow ms for each new sample.
+
+Synthetic gaze data (fixations with noise, saccades, and periods of data
+loss) are filtered one sample at a time and in batches of different sizes,
+and the time per sample is reported.
+
+'''
+# Import modules
+import sys
+import time
+import numpy as np
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'demo_experiments' / 'LSL_streamer'))
+import OlssonFilter
+
+#%% Settings
+Fs = 1200                   # Sampling rate (Hz)
+n_samples = 20000
+batch_sizes = [1, 7, 64]
+tolerance = 1e-9            # Maximum difference (pixels)
+
+#%%
+class FilterOld(OlssonFilter.Filter):
+    ''' Previous implementation of add_sample
+    '''
+    def __init__(self):
+        super().__init__()
+        self._buffer = []
+
+    def add_sample(self, ts, x, y):
+        if np.isnan(self._x) and np.isnan(self._y) and self._t == 0:
+            self._x = x
+            self._y = y
+            self._t = self.Tslow
+
+        if np.isnan(x) or np.isnan(y):
+            return self._x, self._y
+
+        self._buffer.append((ts, x, y))
+
+        dt = np.array([ts-s[0] for s in self._buffer])
+        remove = dt > 2*self.timeWindow
+        self._buffer = [s for s,r in zip(self._buffer,remove) if not r]
+        dt = dt[np.logical_not(remove)]
+
+        qdt = dt>self.timeWindow
+        xs  = np.array([s[1] for s in self._buffer])
+        ys  = np.array([s[2] for s in self._buffer])
+        with np.errstate(invalid='ignore'):
+            avgXB = xs[qdt].mean() if np.any(qdt) else np.nan
+            avgYB = ys[qdt].mean() if np.any(qdt) else np.nan
+        avgXA = xs[np.logical_not(qdt)].mean()
+        avgYA = ys[np.logical_not(qdt)].mean()
+
+        if ts-self._tLastStep<=self.TresetTime:
+            self._t = min(self.Tfast+.5*self._Tacc*(ts-self._tLastStep)**2, self.Tslow)
+        else:
+            self._t = self.Tslow
+        if not np.isnan(avgXA) and not np.isnan(avgXB):
+            dist = np.hypot(avgXB-avgXA,avgYB-avgYA)
+            if dist > self.distT:
+                self._t          = self.Tfast
+                self._tLastStep  = ts
+
+        validFilter = np.any(remove)
+        if validFilter and self._interval is None and len(self._buffer)>1:
+            self._interval  = -np.diff(dt).mean()
+
+        if self._interval is not None:
+            alpha = self._t / self._interval
+            self._x = (x + alpha * self._x) / (1. + alpha)
+            self._y = (y + alpha * self._y) / (1. + alpha)
+        else:
+            self._x = np.nanmean(xs)
+            self._y = np.nanmean(ys)
+
+        return self._x, self._y
+
+#%% Synthetic data: fixations at random positions, and data loss
+rng = np.random.default_rng(0)
+ts = np.arange(n_samples) * 1000 / Fs + rng.normal(0, 0.02, n_samples)    # ms
+fix = np.repeat(rng.uniform(0, 1920, (n_samples // 300 + 1, 2)), 300, axis=0)[:n_samples]
+x = fix[:, 0] + rng.normal(0, 5, n_samples)
+y = fix[:, 1] + rng.normal(0, 5, n_samples)
+for start in rng.integers(0, n_samples, 20):
+    x[start:start + rng.integers(1, 200)] = np.nan
+    y[start:start + 10] = np.nan
+
+#%% Reference output
+f = FilterOld()
+t0 = time.perf_counter()
+ref = np.array([f.add_sample(*s) for s in zip(ts, x, y)])
+print('old filter: {:.1f} us per sample'.format((time.perf_counter() - t0) / n_samples * 1e6))
+
+for batch_size in batch_sizes:
+    f = OlssonFilter.Filter()
+    out = []
+    t0 = time.perf_counter()
+    if batch_size == 1:
+        out = np.array([f.add_sample(*s) for s in zip(ts, x, y)])
+    else:
+        for i in range(0, n_samples, batch_size):
+            out.append(np.column_stack(f.add_samples(ts[i:i + batch_size],
+                                                     x[i:i + batch_size],
+                                                     y[i:i + batch_size])))
+        out = np.vstack(out)
+    dt = time.perf_counter() - t0
+
+    diff = np.nanmax(np.abs(out - ref))
+    same_nan = np.array_equal(np.isnan(out), np.isnan(ref))
+    print('batch size {}: {:.1f} us per sample, max difference {:.2e} px, {}'.format(
+          batch_size, dt / n_samples * 1e6, diff,
+          'OK' if diff < tolerance and same_nan else 'FAILED'))
@@ -93,6 +93,57 @@ class Settings(object):
         # Default name of et-data file
         self.FILENAME                    = 'test'
 
+        # Format of the HDF5 container written by save_data
+        # 'pandas' - one pandas (PyTables) table per stream
+        # 'columnar' - one typed h5py dataset per column (always used when
+        #              STREAM_DATA_TO_DISK is True)
+        # 'parquet' - one Parquet file per table, in a folder named as the
+        #             data file (requires pyarrow)
+        self.DATA_STORAGE_FORMAT = 'pandas'
+        self.DATA_COMPRESSION = None          # None, 'gzip', or 'lzf' ('columnar')
+                                              # None, 'snappy', 'gzip', or 'zstd' ('parquet')
+
+        # save_data consumes and writes data in chunks, to keep memory use constant
+        self.SAVE_CHUNK_SIZE = 100000           # Samples per chunk
+        self.SAVE_CHUNK_SIZE_EYE_IMAGES = 200   # Eye images per chunk
+
+        # Write data to file while recording (instead of only when save_data is called)
+        self.STREAM_DATA_TO_DISK = False
+        self.STREAM_WRITE_INTERVAL = 1.0     # How often (s) data are written to file
+        self.STREAM_KEEP_IN_BUFFER = 2.0     # Most recent data (s) that are left in the buffer,
+                                             # e.g., for gaze contingent peeks
+
+        # Split data written while recording into segments (separate files,
+        # <FILENAME>_seg000.h5, ...), listed in <FILENAME>.manifest.json
+        # (requires STREAM_DATA_TO_DISK).
+        # Messages etc. are stored in <FILENAME>.h5. None means not used
+        self.SEGMENT_MAX_SAMPLES = None      # New segment after this many gaze samples
+        self.SEGMENT_MAX_DURATION = None     # New segment after this duration (s)
+        self.SEGMENT_ON_MESSAGE = None       # New segment when a message starting with
+                                             # this prefix is sent, e.g., 'onset_'
+
+        # Journal messages and samples to disk while recording, such that
+        # data can be recovered after a crash (titta.journal.recover_session)
+        self.JOURNAL_DATA = False
+        self.JOURNAL_INTERVAL = 0.5          # How often (s) the journal is flushed to disk
+
+        # Monitor the gaze stream while recording (titta.monitors)
+        self.MONITOR_INTERVAL = 0.1          # How often (s) new samples are read by the monitor
+        self.QUALITY_MONITOR = False         # Compute the data quality of the most recent samples
+                                             # (see tracker.quality_snapshot())
+        self.QUALITY_WINDOW = 2.0            # Duration (s) of the most recent data used
+        self.QUALITY_LOG_INTERVAL = None     # How often (s) the quality is logged as a message
+                                             # ('data_quality {...}'). None means not logged
+        self.LATENCY_MONITOR = False         # Histograms of the sample latency and intervals
+                                             # (see tracker.latency_summary(), saved as 'latency')
+        self.DROP_MONITOR = False            # Detect dropped samples from gaps in device_time_stamp
+                                             # (see tracker.dropped_samples()), and log the gaps
+                                             # as messages ('sample_gap {...}')
+        self.DROP_LOG_MIN_SAMPLES = 1        # Only log gaps with at least this many dropped samples
+        self.DROP_RATE_THRESHOLD = 0.01      # Call the callback set with tracker.set_drop_rate_callback()
+                                             # when the proportion of dropped samples exceeds this
+        self.DROP_RATE_WINDOW = 1.0          # Duration (s) over which the proportion is computed
+
         # Tracking parameters
         self.TRACKER_ADDRESS  = ''           # If none is given, find one on the network
         self.SAMPLING_RATE = 600             # Set sampling rate of tracker
@@ -17,9 +17,17 @@ import numpy as np
 import h5py
 import time
 import importlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
 import TittaPy_v2 as TittaPy
 import titta
 from titta import helpers_tobii as helpers
+from titta import storage
+from titta import journal
+from titta import monitors
+from titta import result_images
+from titta.messages import MessageLog
 
 # Suppress FutureWarning
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -128,8 +136,45 @@ class myTobii(object):
             if not (self.settings.eye_tracker_name == 'Tobii Pro Fusion' and self.settings.SAMPLING_RATE == 250):
                 self.buffer.set_include_eye_openness_in_gaze(True)
 
-        # Store timestamped messages in a list
-        self.msg_container = []
+        # Store timestamped messages (query with e.g., self.msg_container.find('onset_'))
+        self.msg_container = MessageLog()
+
+        # Background thread writing data to file while recording (optional)
+        self._stream_writer = None
+
+        # Worker thread used by save_data_async (created when first needed)
+        self._save_executor = None
+
+        # Names (without extension) of files that are still being written,
+        # such that _get_filename does not return them again
+        self._reserved_filenames = set()
+        self._reserved_lock = Lock()
+
+        # Renders and writes calibration/validation result images
+        self._image_writer = result_images.ResultImageWriter()
+
+        # Crash-safe journal of messages and samples (optional)
+        self._journal = None
+
+        # Background thread monitoring the gaze stream while recording (optional)
+        self._monitor = None
+        self._quality_monitor = None
+        self._latency_monitor = None
+        self._drop_monitor = None
+        self._drop_rate_callback = None
+
+        # Messages from the monitor thread, logged on the thread of the
+        # experiment (see _queue_message)
+        self._queued_messages = deque()
+
+        # Objects notified of each message (see add_message_listener)
+        self._message_listeners = []
+
+        # Time stamp of the last sample returned by read_new, per (stream, consumer)
+        self._cursors = {}
+
+        # Preallocated gaze position (left and right eye) drawn by _draw_gaze
+        self._gaze_pos = np.zeros((2, 2))
 
         self.user_position_guide_data = None
         self.all_validation_results = []
@@ -327,10 +372,15 @@ class myTobii(object):
                                                    pos=self.settings.graphics.EYE_IMAGE_POS_R_1,
                                                    image=np.zeros((512, 512)))
 
-        # Accuracy image
+        # Accuracy image (used for results that are read from file)
         self.accuracy_image = visual.ImageStim(self.win_temp, image=None,units='norm', size=(2,2),
                                           pos=(0, 0))
 
+        # Stimuli showing the calibration/validation results, per image
+        # file name (see _save_result_image), and those currently shown
+        self._result_screens = {}
+        self._result_stims = []
+
     #%%
     def start_recording(self,   gaze=False,
                                 time_sync=False,
@@ -357,24 +407,187 @@ class myTobii(object):
         if positioning and self.buffer.has_stream('positioning'):
             self.buffer.start('positioning')
 
+        # Start writing data to file while recording (if requested)
+        if self.settings.STREAM_DATA_TO_DISK and self._stream_writer is None:
+            self._stream_writer = storage.StreamWriter(self.buffer,
+                                                       self._get_filename(),
+                                                       self.get_system_time_stamp,
+                                                       interval=self.settings.STREAM_WRITE_INTERVAL,
+                                                       keep_in_buffer=self.settings.STREAM_KEEP_IN_BUFFER,
+                                                       compression=self.settings.DATA_COMPRESSION,
+                                                       segment_samples=self.settings.SEGMENT_MAX_SAMPLES,
+                                                       segment_duration=self.settings.SEGMENT_MAX_DURATION,
+                                                       segment_on_message=self.settings.SEGMENT_ON_MESSAGE)
+            self._stream_writer.start()
+
+        # Start copying messages and samples to the journal (if requested)
+        if self.settings.JOURNAL_DATA and self._journal is None:
+            self._start_journal()
+
+        # Start monitoring the gaze stream (if requested)
+        if gaze and self._monitor is None and (self.settings.QUALITY_MONITOR or
+                                               self.settings.LATENCY_MONITOR or
+                                               self.settings.DROP_MONITOR):
+            self._start_monitor()
+
+        # Block until new data are available
+        if block_until_data_available:
+            self.wait_for_data('gaze')
+
+
+    #%%
+    def wait_for_data(self, stream='gaze', timeout=5.0):
+        ''' Blocks until a sample recorded after this call is available
+        in the buffer.
+
+        The buffer is polled with short sleeps that start at a quarter
+        of the sampling interval and double (up to 10 ms) as long as no
+        data are available, so the TittaPy callback thread is not starved.
+
+        Args:
+            stream - name of the stream, e.g., 'gaze' or 'external_signal'.
+                     The positioning stream has no time stamps, so for
+                     this stream any sample in the buffer will do
+            timeout - maximum time to wait (s)
+
+        Returns:
+            dict with the new samples (not consumed from the buffer)
+
+        Raises:
+            TimeoutError - if no samples arrive within timeout s
         '''
-        # Block until new data are available. This happens either when
-        the most recent timestamp go from en empty list to a value, e.g.,
-            1) [], [], [], [],... ->   1230333548588
 
-            or to a new value, e.g.,
+        t0 = self.get_system_time_stamp()
+        t_stop = time.perf_counter() + timeout
+
+        min_sleep = 1 / (4 * self.settings.SAMPLING_RATE)
+        max_sleep = 0.01
+        sleep = min_sleep
+
+        while True:
+            if stream == 'positioning':
+                data = self.buffer.peek_N(stream, 1)
+                if len(data) > 0 and len(next(iter(data.values()))) > 0:
+                    return data
+            else:
+                data = self.buffer.peek_time_range(stream, t0)
+                if len(data[storage.time_column(stream)]) > 0:
+                    return data
+
+            if time.perf_counter() >= t_stop:
+                raise TimeoutError(f'No {stream} data arrived within {timeout} s. '
+                                   f'Has the stream been started with start_recording?')
+
+            time.sleep(min(sleep, max(t_stop - time.perf_counter(), 0)))
+            sleep = min(2 * sleep, max_sleep)
 
-            # 1230333548588, 1230333548588, 1230333548588...-> 1230333715267
+    #%%
+    def _start_monitor(self):
+        ''' Starts the thread that monitors the gaze stream, with the
+        processors requested in the settings
         '''
-        if block_until_data_available:
-            t0 = self.get_system_time_stamp()
-            while True:
-                sample = self.buffer.peek_N('gaze', 1)
-                ts = sample['system_time_stamp']
-                if ts.size > 0:
-                    if ts > t0:
-                        break
 
+        self._monitor = monitors.Monitor(self.buffer, self.get_system_time_stamp,
+                                         interval=self.settings.MONITOR_INTERVAL)
+
+        if self.settings.QUALITY_MONITOR:
+            self._quality_monitor = self._monitor.add(
+                monitors.QualityMonitor(window=self.settings.QUALITY_WINDOW,
+                                        log_interval=self.settings.QUALITY_LOG_INTERVAL,
+                                        send_message=self._queue_message))
+
+        if self.settings.LATENCY_MONITOR:
+            # Keep the histograms over recordings until the data are saved
+            if self._latency_monitor is None:
+                self._latency_monitor = monitors.LatencyMonitor()
+            self._monitor.add(self._latency_monitor)
+
+        if self.settings.DROP_MONITOR:
+            self._drop_monitor = self._monitor.add(
+                monitors.DropMonitor(self.settings.SAMPLING_RATE,
+                                     min_log_samples=self.settings.DROP_LOG_MIN_SAMPLES,
+                                     threshold=self.settings.DROP_RATE_THRESHOLD,
+                                     window=self.settings.DROP_RATE_WINDOW,
+                                     send_message=self._queue_message,
+                                     callback=self._on_drop_rate))
+
+        self._monitor.start()
+
+    #%%
+    def quality_snapshot(self):
+        ''' Returns the data quality of the most recent gaze samples
+        (settings.QUALITY_WINDOW s), computed while recording when
+        settings.QUALITY_MONITOR is True
+
+        Returns:
+            dict with the RMS-S2S (deg) and proportion of data loss per eye,
+            and the mean and SD of the intervals between samples (ms), or
+            None if no data have been monitored
+        '''
+
+        if self._quality_monitor is None:
+            return None
+
+        return self._quality_monitor.snapshot()
+
+    #%%
+    def latency_summary(self):
+        ''' Returns statistics of the latency of the gaze samples and of
+        the intervals between samples, recorded since the data were last
+        saved, when settings.LATENCY_MONITOR is True. The latency is the time
+        from the system time stamp of the newest sample read by the monitor
+        thread until it was read (delivery latency plus at most one sample
+        interval, see monitors.LatencyMonitor)
+
+        Returns:
+            dict with the number of samples and of batches, and the mean, SD, minimum,
+            percentiles and maximum of the latency and the intervals (ms),
+            or None if the latency is not monitored
+        '''
+
+        if self._latency_monitor is None:
+            return None
+
+        return self._latency_monitor.summary()
+
+    #%%
+    def dropped_samples(self):
+        ''' Returns the number of dropped gaze samples, detected while
+        recording from gaps in device_time_stamp when settings.DROP_MONITOR
+        is True
+
+        Returns:
+            dict with the number of received and dropped samples and of
+            gaps, and the proportion of dropped samples over the last
+            settings.DROP_RATE_WINDOW s, or None if drops are not monitored
+        '''
+
+        if self._drop_monitor is None:
+            return None
+
+        return self._drop_monitor.summary()
+
+    #%%
+    def set_drop_rate_callback(self, callback):
+        ''' Sets a function that is called when the proportion of dropped
+        samples rises above settings.DROP_RATE_THRESHOLD (requires
+        settings.DROP_MONITOR). It is called from the monitor thread, so it
+        should return quickly (e.g., set a flag checked by the experiment)
+
+        Args:
+            callback - function(drop_rate, system_time_stamp), or None
+        '''
+
+        self._drop_rate_callback = callback
+
+    #%%
+    def _on_drop_rate(self, drop_rate, ts):
+        ''' Called by the drop monitor when the drop rate crosses the threshold
+        '''
+
+        self._queue_message(f'drop_rate_exceeded {drop_rate:.4f}', ts)
+        if self._drop_rate_callback is not None:
+            self._drop_rate_callback(drop_rate, ts)
 
     #%%
     def stop_recording(self,    gaze=False,
@@ -389,6 +602,10 @@ class myTobii(object):
             self.buffer.stop('positioning')
         if gaze and self.buffer.has_stream('gaze'):
             self.buffer.stop('gaze')
+        if gaze and self._monitor is not None:
+            self._monitor.stop()
+            self._monitor = None
+            self._log_queued_messages()
         if time_sync and self.buffer.has_stream('time_sync'):
             self.buffer.stop('time_sync')
         if eye_image and self.buffer.has_stream('eye_image'):
@@ -589,16 +806,18 @@ class myTobii(object):
 
         d = self.buffer.peek_N('gaze',1)
 
-        lx = d['left_gaze_point_on_display_area_x'][0]
-        ly = d['left_gaze_point_on_display_area_y'][0]
-        rx = d['right_gaze_point_on_display_area_x'][0]
-        ry = d['right_gaze_point_on_display_area_y'][0]
+        # Left and right eye in one (preallocated) array
+        self._gaze_pos[0, 0] = d['left_gaze_point_on_display_area_x'][0]
+        self._gaze_pos[0, 1] = d['left_gaze_point_on_display_area_y'][0]
+        self._gaze_pos[1, 0] = d['right_gaze_point_on_display_area_x'][0]
+        self._gaze_pos[1, 1] = d['right_gaze_point_on_display_area_y'][0]
+
+        transform = helpers.CoordinateTransform.for_window(self.win_temp, 'pix')
+        transform.apply(self._gaze_pos, out=self._gaze_pos)
 
-        self.et_sample_l.pos = helpers.tobii2pix(np.array([[lx, ly]]),
-                                                 self.win_temp)
+        self.et_sample_l.pos = self._gaze_pos[0]
         self.et_sample_l.draw()
-        self.et_sample_r.pos = helpers.tobii2pix(np.array([[rx, ry]]),
-                                                 self.win_temp)
+        self.et_sample_r.pos = self._gaze_pos[1]
         self.et_sample_r.draw()
 
    #%%
@@ -630,6 +849,10 @@ class myTobii(object):
             self.win.close()
             raise Exception('Eye tracker switched on?')
 
+        # Wait until there are samples to show (without spinning on the buffer)
+        self.wait_for_data('gaze')
+        self.wait_for_data('positioning')
+
         # Initiate parameters of head class (shown on participant screen)
         et_head = helpers.EThead(self.win, self.settings.HEAD_BOX_CENTER, self.settings.graphics.HEAD_POS_CIRCLE_FIXED_COLOR, self.settings.graphics.HEAD_POS_CIRCLE_MOVING_COLOR)
 
@@ -662,14 +885,13 @@ class myTobii(object):
                     show_eye_images = not show_eye_images
                     image_button_pressed = True
 
-             # Get position of eyes in track box (wait for valid samples)
-            sample = self.buffer.peek_N('gaze',1)
-            while len(sample['left_pupil_diameter']) == 0:
-                sample = self.buffer.peek_N('gaze',1)
-
-            sample_user_position = self.buffer.peek_N('positioning',1)
-            while len(sample_user_position['left_user_position_x']) == 0:
-                sample_user_position = self.buffer.peek_N('positioning',1)
+            # Get position of eyes in track box
+            aligned = self.peek_aligned(['gaze', 'positioning'])
+            while len(aligned['system_time_stamp']) == 0:
+                time.sleep(1 / self.settings.SAMPLING_RATE)
+                aligned = self.peek_aligned(['gaze', 'positioning'])
+            sample = aligned['gaze']
+            sample_user_position = aligned['positioning']
 
             # Draw et head on participant screen
             et_head.update(sample, sample_user_position, eye=self.eye)
@@ -714,7 +936,7 @@ class myTobii(object):
                 if self.buffer.has_stream('eye_image') and not self.buffer.is_recording('eye_image'):
                     self.buffer.start('eye_image')
 
-                self._draw_eye_image()
+                self._draw_eye_image(self._peek_eye_images())
             else:
                 if self.buffer.has_stream('eye_image') and self.buffer.is_recording('eye_image'):
                     self.buffer.stop('eye_image')
@@ -769,34 +991,45 @@ class myTobii(object):
         return action
 
     #%% _
-    def _draw_operator_screen(self, pos, sample):
+    def _draw_operator_screen(self, pos, sample, eye_images):
         ''' Draws what the operator sees in dual screen mode
 
         Args:
             bg - background (either image with calibration points or validation points)
             pos - current position of calibration / validation dot
             sample - dict with eye tracker sample
+            eye_images - dict with eye images (see _peek_eye_images)
         '''
 
         # Draw calibration / validation dots
         # self.bg.draw()
 
         # Draw current target (red cicle)
-        self.current_point.set_pos(helpers.tobii2norm(np.expand_dims(pos, axis=0)))
+        transform = helpers.CoordinateTransform.for_window(self.win_operator, 'norm')
+        self.current_point.set_pos(transform.apply(pos))
         self.current_point.draw()
 
         # Draw data for the left and right eyes
-        self.raw_et_sample_l.pos = helpers.tobii2norm(np.expand_dims((sample['left_gaze_point_on_display_area_x'][0],
-                                                                      sample['left_gaze_point_on_display_area_y'][0]),
-                                                                      axis=0))
-        self.raw_et_sample_r.pos = helpers.tobii2norm(np.expand_dims((sample['right_gaze_point_on_display_area_x'][0],
-                                                                      sample['right_gaze_point_on_display_area_y'][0]),
-                                                                      axis=0))
+        self.raw_et_sample_l.pos = transform.apply((sample['left_gaze_point_on_display_area_x'][0],
+                                                    sample['left_gaze_point_on_display_area_y'][0]))
+        self.raw_et_sample_r.pos = transform.apply((sample['right_gaze_point_on_display_area_x'][0],
+                                                    sample['right_gaze_point_on_display_area_y'][0]))
         self.raw_et_sample_l.draw()
         self.raw_et_sample_r.draw()
 
         # Draw eye images for the left and right eyes
-        self._draw_eye_image()
+        self._draw_eye_image(eye_images)
+
+    #%%
+    def _peek_operator_data(self):
+        ''' Peeks the data shown on the operator screen, once per frame
+
+        Returns:
+            sample - dict with the most recent gaze sample
+            eye_images - dict with the most recent eye images (see _peek_eye_images)
+        '''
+
+        return self.buffer.peek_N('gaze', 1), self._peek_eye_images()
 
     #%%
     def _wait_for_action_complete(self):
@@ -873,8 +1106,7 @@ class myTobii(object):
                 self.cal_dot.draw()
 
             if self.win_operator:
-                self._draw_operator_screen(tobii_data,
-                                           self.buffer.peek_N('gaze', 1))
+                self._draw_operator_screen(tobii_data, *self._peek_operator_data())
                 self.win_temp.flip()
 
             self.win.flip()
@@ -968,77 +1200,37 @@ class myTobii(object):
         '''
 
         cal_data = []   # where calibration deviations are stored
-        xys_left = []   # container for gaze data (left eye)
-        xys_right = []  # container for gaze data (right eye)
+        xys = {'left': [], 'right': []}  # gaze data per eye
 
-        # Display the results to the user (loop over each calibration point)
+        # Loop over each calibration point
+        dot_positions = []
         for p in calibration_result['calibration_result']['points']:
 
-            # Draw calibration dots
+            # Calibration dots
             x_dot = p['position_on_display_area_x']
             y_dot = p['position_on_display_area_y']
-            self.cal_dot.fillColor = 'white'
-            xy_dot = helpers.tobii2pix(np.array([[x_dot, y_dot]]),
-                                       self.win)
-            self.cal_dot.set_pos(xy_dot) # Tobii and psychopy have different coord systems
-            self.cal_dot.draw()
-
-            if self.eye == 'both' or self.eye == 'left':
-                # Save gaze data for left eye to list
-                x = p['samples_left_position_on_display_area_x']
-                y = p['samples_left_position_on_display_area_y']
-                xy_sample = helpers.tobii2pix(np.column_stack((x, y)),
-                                              self.win) # Tobii and psychopy have different coord systems
-                for xy in xy_sample:
-                    xys_left.append([xy[0], xy[1]])
-                    cal_data.append([x_dot, y_dot, xy[0], xy[1], 'left'])
-
-            if self.eye == 'both' or self.eye == 'right':
-                 # Save gaze data for right eye to list
-                 x = p['samples_right_position_on_display_area_x']
-                 y = p['samples_right_position_on_display_area_y']
-                 xy_sample = helpers.tobii2pix(np.column_stack((x, y)),
-                                               self.win) # Tobii and psychopy have different coord systems
-                 for xy in xy_sample:
-                     xys_right.append([xy[0], xy[1]])
-                     cal_data.append([x_dot, y_dot, xy[0], xy[1], 'right'])
-
-        # Draw calibration gaze data samples for left eye and right eyes
-        if self.eye == 'both' or self.eye == 'left':
-            samples_l = visual.ElementArrayStim(self.win,
-                                              sizes=self.settings.graphics.ET_SAMPLE_RADIUS,
-                                              fieldSize=(100, 100),
-                                              elementTex=None,
-                                              nElements=len(xys_left),
-                                              elementMask='circle',
-                                              xys=xys_left,
-                                              colors='red',
-                                              units='pix')
-            samples_l.draw()
+            dot_positions.append([x_dot, y_dot])
+
+            for eye in ['left', 'right']:
+                if self.eye == 'both' or self.eye == eye:
+                    # Save gaze data for the eye
+                    x = p[f'samples_{eye}_position_on_display_area_x']
+                    y = p[f'samples_{eye}_position_on_display_area_y']
+                    xy_sample = helpers.tobii2pix(np.column_stack((x, y)),
+                                                  self.win) # Tobii and psychopy have different coord systems
+                    xys[eye].append(xy_sample)
+                    cal_data += [[x_dot, y_dot, xy[0], xy[1], eye] for xy in xy_sample.tolist()]
+
+        dot_positions = helpers.tobii2pix(np.array(dot_positions), self.win)
+
+        # Save calibration results as image (in the background)
+        samples = []
+        for eye, color in zip(['left', 'right'], ['red', 'blue']):
+            if len(xys[eye]) > 0:
+                samples.append((np.vstack(xys[eye]), color))
 
-        if self.eye == 'both' or self.eye == 'right':
-            samples_r = visual.ElementArrayStim(self.win,
-                                              sizes=self.settings.graphics.ET_SAMPLE_RADIUS,
-                                              fieldSize=(100, 100),
-                                              elementTex=None,
-                                              nElements=len(xys_right),
-                                              elementMask='circle',
-                                              xys=xys_right,
-                                              colors='blue',
-                                              units='pix')
-            samples_r.draw()
-
-        # Save validation results as image
-        # nCalibrations = len(self.deviations) + 1
         fname = 'calibration_image' + str(self.selected_calibration)+'.png'
-        fname = self._add_to_name(fname)
-        self.win.getMovieFrame(buffer='back')
-        self.win.saveMovieFrames(fname)
-
-        # Clear the back buffer without flipping the window
-        self.win.clearBuffer()
-
-        del samples_l, samples_r
+        self._save_result_image(self._add_to_name(fname), dot_positions, samples)
 
         return cal_data
 
@@ -1125,6 +1317,7 @@ class myTobii(object):
         xy_pos = []
         animation_state = 'move'
         tick = 0
+        t_onset = None
         while True:
 
             k = event.getKeys()
@@ -1143,12 +1336,12 @@ class myTobii(object):
                 else:
                     self.animator.animate_point(0, (pos[0], pos[1]), tick)
             else:
-                animation_state == 'static'
+                animation_state = 'static'
                 self.cal_dot.set_pos(pos)
                 self.cal_dot.draw()
 
             if self.win_operator:
-                self._draw_operator_screen(target_pos[i, :2], self.buffer.peek_N('gaze',1))
+                self._draw_operator_screen(target_pos[i, :2], *self._peek_operator_data())
                 self.win_temp.flip()
 
             self.win.flip()
@@ -1158,34 +1351,34 @@ class myTobii(object):
             # animation_state 'static' means that the dot has completed the
             # movement to a new location.
             if tick == 0 and animation_state == 'static':
-                self.send_message('validation point {} at position {} {}'.format(i, pos[0], pos[1]))
-
-            # # Start collecting validation data for a point 500 ms after its onset
-            # if (self.clock.getTime() >= 0.500 and self.clock.getTime() < 0.800) and not buffer_started:
-            #     self.start_ring_buffer(sample_buffer_length=300)
-            #     buffer_started = True
-
-            # Get the last 300 ms of data from the buffer
-            if self.clock.getTime() >= 0.800:
-                sample = self.buffer.peek_N('gaze',
-                                             int(self.buffer.frequency * 0.300))
+                t_onset = self.get_system_time_stamp()
+                self.send_message('validation point {} at position {} {}'.format(i, pos[0], pos[1]), t_onset)
 
             # Time to switch to a new point
             if self.settings.AUTO_PACE > 0 or 'space' in k:
                 if self.clock.getTime() > paval:
 
-                    # Collect validation data from this point
+                    # Collect validation data from this point: the last
+                    # 300 ms before the point was accepted (but not from
+                    # before its onset)
+                    t_offset = self.get_system_time_stamp()
+                    t_start = t_offset - 300000
+                    if t_onset is not None:
+                        t_start = max(t_start, t_onset)
+                    sample = self.buffer.peek_time_range('gaze', t_start, t_offset)
                     validation_data.append(sample)
 
-                    # Save data as xy list (Change so it's saved to a np.array directly)
-                    for ii in range(len(sample['system_time_stamp'])):
-                        xy_pos.append([sample['system_time_stamp'][ii],
-                                       sample['left_gaze_point_on_display_area_x'][ii],
-                                       sample['left_gaze_point_on_display_area_y'][ii],
-                                       sample['right_gaze_point_on_display_area_x'][ii],
-                                       sample['right_gaze_point_on_display_area_y'][ii],
-                                       pos[0], pos[1]])
+                    # Save data as t, lx, ly, rx, ry, dot x, dot y
+                    n_samples = len(sample['system_time_stamp'])
+                    xy_pos.append(np.column_stack((sample['system_time_stamp'],
+                                                   sample['left_gaze_point_on_display_area_x'],
+                                                   sample['left_gaze_point_on_display_area_y'],
+                                                   sample['right_gaze_point_on_display_area_x'],
+                                                   sample['right_gaze_point_on_display_area_y'],
+                                                   np.full(n_samples, pos[0]),
+                                                   np.full(n_samples, pos[1]))))
                     pos_old = pos[:]
+                    t_onset = None
 
                     self.clock.reset()
                     tick = 0
@@ -1214,13 +1407,16 @@ class myTobii(object):
         self.win.flip()
 
         # Convert data from Tobii coord system to PsychoPy coordinates
-        gaze_pos = np.array(xy_pos)
+        gaze_pos = np.vstack(xy_pos).astype(float)
         gaze_pos[:, 1:3] = helpers.tobii2pix(gaze_pos[:, 1:3], self.win)
         gaze_pos[:, 3:5] = helpers.tobii2pix(gaze_pos[:, 3:5], self.win)
 
         # Compute data quality per validation point
-        deviation_l, rms_l, sd_l, data_loss_l = self._compute_data_quality(validation_data, target_pos[:, :2], 'left')
-        deviation_r, rms_r, sd_r, data_loss_r = self._compute_data_quality(validation_data, target_pos[:, :2], 'right')
+        deviation, rms, sd, data_loss = self._compute_data_quality(validation_data, target_pos[:, :2])
+        deviation_l, deviation_r = deviation
+        rms_l, rms_r = rms
+        sd_l, sd_r = sd
+        data_loss_l, data_loss_r = data_loss
 
         if self.eye == 'left':
             deviation_r = np.nan
@@ -1276,54 +1472,108 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
         All values should be in the current screen units
         '''
 
-        # Used to draw many dots
-        samples = visual.ElementArrayStim(self.win,
-                                          sizes=self.settings.graphics.ET_SAMPLE_RADIUS,
-                                          fieldSize = (100, 100),  #self.settings.SAMPLE_DOT_SIZE,
-                                          nElements = gaze_positions.shape[0],
-                                          elementTex=None, elementMask='circle', units='pix')
+        samples = []
+        if self.eye == 'both' or self.eye == 'left':
+            samples.append((gaze_positions[:, 1:3], 'red'))
+        if self.eye == 'both' or self.eye == 'right':
+            samples.append((gaze_positions[:, 3:5], 'blue'))
 
-        # Show all dots...
-        for p in dot_positions:
-            self.cal_dot.set_pos(p )
-            self.cal_dot.draw()
+        # Save validation results as image (in the background)
+        fname = 'validation_image' + str(self.selected_calibration) + '.png'
+        self._save_result_image(self._add_to_name(fname), dot_positions, samples)
 
-        #... and collected validation samples for left...
-        if self.eye == 'both' or self.eye == 'left':
-            samples.xys = gaze_positions[:, 1:3]
-            samples.colors = 'red'
-            samples.draw()
+    #%%
+    def _save_result_image(self, fname, dot_positions, samples):
+        ''' Renders a calibration/validation result image offscreen and
+        writes it to file in the background (see result_images), so the
+        display is not blocked. The results screen draws the same dots and
+        samples directly (see _result_screen), without waiting for the file
 
-        #... and right eye
-        if self.eye == 'both' or self.eye == 'right':
-            samples.xys = gaze_positions[:, 3:5]
-            samples.colors = 'blue'
-            samples.draw()
+        Args:
+            fname - name of the PNG file
+            dot_positions - n x 2 array with x, y location of the dots (pix)
+            samples - list with (n x 2 array with gaze positions (pix), color)
+        '''
 
-        # Save validation results as image
-        # nCalibrations = len(self.deviations)
+        # Copies, since the arrays may change before the image is rendered.
+        # Colors are converted here, from the color space of the window
+        # (or of the shapes of the target)
+        layers = [(np.array(dot_positions, dtype=float), result_images.target_shapes(self.cal_dot))]
+        for xy, color in samples:
+            layers.append((np.array(xy, dtype=float), [('disk', self.settings.graphics.ET_SAMPLE_RADIUS,
+                                 self.settings.graphics.ET_SAMPLE_RADIUS,
+                                 result_images.rgb255(color, self.win.colorSpace))]))
 
-        fname = 'validation_image' + str(self.selected_calibration) + '.png'
-        fname = self._add_to_name(fname)
+        background = result_images.rgb255(self.win.color, self.win.colorSpace)
+        self._image_writer.submit(fname, self.win.size, background, layers)
+
+        self._result_screens[fname] = self._result_screen(background, layers)
+
+    #%%
+    def _result_screen(self, background, layers):
+        ''' Creates the stimuli that show a calibration/validation result
+        on the results screen (self.win_temp), with the same layout as the
+        result image: positions and sizes in pixels of the participant
+        screen (self.win) are scaled to the full window
+
+        Args:
+            background - background color (0 -> 255 rgb)
+            layers - list with (xy, shapes), see result_images.render
 
-        self.win.getMovieFrame(buffer='back')
-        self.win.saveMovieFrames(fname)
+        Returns:
+            list with stimuli, drawn in order
+        '''
 
-        # Clear the back buffer without flipping the window
-        self.win.clearBuffer()
+        # From pixels of the participant screen to 'norm' units
+        scale = 2 / np.asarray(self.win.size, dtype=float)
 
-        # Delete samples
-        del samples
+        stims = [visual.Rect(self.win_temp, width=2, height=2, units='norm',
+                             fillColor=background.tolist(), lineColor=background.tolist(),
+                             colorSpace='rgb255')]
+        for xy, shapes in layers:
+            xy = xy[~np.any(np.isnan(xy), axis=1)]
+            if len(xy) == 0:
+                continue
+
+            # One element per position, for each shape
+            for shape, width, height, color in shapes:
+                if color is None:
+                    continue
+                stims.append(visual.ElementArrayStim(self.win_temp, units='norm',
+                                                     nElements=len(xy),
+                                                     xys=xy * scale,
+                                                     sizes=(width * scale[0], height * scale[1]),
+                                                     fieldSize=(2, 2),
+                                                     elementTex=None,
+                                                     elementMask='circle' if shape == 'disk' else None,
+                                                     colors=color.tolist(), colorSpace='rgb255'))
+
+        return stims
+
+    #%%
+    def _show_result_image(self, fname):
+        ''' Selects the calibration/validation result shown on the results
+        screen. Results saved since the calibration started are drawn from
+        their dots and samples; other results are read from the image file,
+        once it has been written
+        '''
+
+        if fname in self._result_screens:
+            self._result_stims = self._result_screens[fname]
+        else:
+            self.accuracy_image.image = self._image_writer.wait(fname)
+            self._result_stims = [self.accuracy_image]
 
     #%%
     def _adcs2ucs(self, v):
         ''' Convert 2D point from Active Display Coordinate System (ADCS) to
         3D point in Tobii User Coordinate System (USC)
         Args:
-            v - (x, y) in ADCS, e.g, (0.54, 0.1), norm [0 -> 1]
+            v - (x, y) in ADCS, e.g, (0.54, 0.1), norm [0 -> 1], or
+                n x 2 array with one point per row
 
         Returns
-            u - (x, y, z) in UCS in mm
+            u - (x, y, z) in UCS in mm (n x 3 array for n x 2 input)
         '''
 
         display_area = self.buffer.display_area
@@ -1335,69 +1585,43 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
 #        print("Top Right: {0}".format(display_area.top_right))
 #        print("Width: {0}".format(display_area.width))
 
-        dx = (np.array(display_area['top_right']) - np.array(display_area['top_left'])) * v[0]
-        dy = (np.array(display_area['bottom_left']) - np.array(display_area['top_left'])) * v[1]
+        v = np.asarray(v, dtype=float)
+        dx = np.multiply.outer(v[..., 0], np.array(display_area['top_right']) - np.array(display_area['top_left']))
+        dy = np.multiply.outer(v[..., 1], np.array(display_area['bottom_left']) - np.array(display_area['top_left']))
 
         u = np.array(display_area['top_left']) + dx + dy
 
         return u
     #%%
-    def _compute_data_quality(self, validation_data, val_point_positions, eye):
-        ''' Computes data quality (deviation, rms) per validation point
+    def _compute_data_quality(self, validation_data, val_point_positions):
+        ''' Computes data quality (deviation, rms, sd, data loss) per
+        validation point, for both eyes at once
 
         Args:
             validation_data - list with validation data per validation point
             val_point_positions - list with [x, y] pos of validation point
                                     in ADCS
-            eye - 'left' or 'right'
+
+        Returns:
+            deviation, rms, sd, data_loss - 2 x n arrays (left and right eye,
+                                            one column per validation point)
         '''
-        # For each point
-        deviation_per_point = []
-        rms_per_point = []
-        sd_per_point = []
-        data_loss_point = []
-        for p, point_data in enumerate(validation_data):
-
-            val_point_position = self._adcs2ucs(val_point_positions[p])
-
-            # For each sample (in a validation point)
-            deviation_per_sample = []
-            angle_between_samples = []
-            gaze_vector_old = 0
-            n_samples = len(point_data['system_time_stamp'])
-            n_invalid_samples = 0
-            for i in range(n_samples):
-                gaze_vector = (point_data[f"{eye}_gaze_point_in_user_coordinates_x"][i] -
-                               point_data[f"{eye}_gaze_origin_in_user_coordinates_x"][i],
-                               point_data[f"{eye}_gaze_point_in_user_coordinates_y"][i] -
-                               point_data[f"{eye}_gaze_origin_in_user_coordinates_y"][i],
-                               point_data[f"{eye}_gaze_point_in_user_coordinates_z"][i] -
-                               point_data[f"{eye}_gaze_origin_in_user_coordinates_z"][i])
-
-                if np.any(np.isnan(gaze_vector)):
-                    n_invalid_samples += 1
-
-                eye_to_valpoint_vector = (val_point_position[0] -
-                               point_data[f"{eye}_gaze_origin_in_user_coordinates_x"][i],
-                               val_point_position[1] -
-                               point_data[f"{eye}_gaze_origin_in_user_coordinates_y"][i],
-                               val_point_position[2] -
-                               point_data[f"{eye}_gaze_origin_in_user_coordinates_z"][i])
-
-                # Compute RMS (diff between consecutive samples) and deviation
-                deviation_per_sample.append(helpers.angle_between(gaze_vector, eye_to_valpoint_vector))
-                if i > 0:
-                    angle_between_samples.append(helpers.angle_between(gaze_vector, gaze_vector_old))
-
-                gaze_vector_old = gaze_vector
-
-            # Compute averages per point
-            deviation_per_point.append(np.rad2deg(np.nanmedian(deviation_per_sample)))
-            rms_per_point.append(np.rad2deg(helpers.rms(angle_between_samples)))
-            sd_per_point.append(np.rad2deg(helpers.sd(angle_between_samples)))
-            data_loss_point.append(n_invalid_samples / float(n_samples))
-
-        return deviation_per_point, rms_per_point, sd_per_point, data_loss_point
+
+        n_samples = [len(point_data['system_time_stamp']) for point_data in validation_data]
+
+        # Samples of all points, one array per eye
+        gaze_origin = np.empty((2, sum(n_samples), 3))
+        gaze_point = np.empty((2, sum(n_samples), 3))
+        for e, eye in enumerate(['left', 'right']):
+            for c, letter in enumerate(['x', 'y', 'z']):
+                gaze_origin[e, :, c] = np.concatenate([point_data[f"{eye}_gaze_origin_in_user_coordinates_{letter}"]
+                                                       for point_data in validation_data])
+                gaze_point[e, :, c] = np.concatenate([point_data[f"{eye}_gaze_point_in_user_coordinates_{letter}"]
+                                                      for point_data in validation_data])
+
+        return helpers.validation_quality(gaze_origin, gaze_point,
+                                          self._adcs2ucs(val_point_positions[:len(n_samples)]),
+                                          n_samples)
 
 
     #%%
@@ -1422,7 +1646,7 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
         fname = 'validation_image' + str(self.selected_calibration)+'.png'
         fname = self._add_to_name(fname)
 
-        self.accuracy_image.image = fname
+        self._show_result_image(fname)
         show_validation_image = True    # Default is to show validation results,
                                         # not calibration results
 
@@ -1528,7 +1752,8 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
             t0 = self.clock.getTime()
 
             # Draw validation results image
-            self.accuracy_image.draw()
+            for stim in self._result_stims:
+                stim.draw()
 
             # Draw buttons (re-calibrate, accept and move on, show gaze)
             self.recalibrate_button.draw()
@@ -1580,7 +1805,7 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
                         fname = 'calibration_image' + str(i + 1) + '.png'
                     fname = self._add_to_name(fname)
 
-                    self.accuracy_image.image = fname
+                    self._show_result_image(fname)
                     self.selected_calibration = int(i + 1)
                     break
 
@@ -1607,7 +1832,7 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
                         self._load_calibration(k[0])  # Load the selected calibration
                         fname = 'validation_image' + str(k[0]) + '.png'
                         fname = self._add_to_name(fname)
-                        self.accuracy_image.image = fname
+                        self._show_result_image(fname)
                         self.selected_calibration = int(k[0])
 
             elif 'escape' in k:
@@ -1637,12 +1862,12 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
                     if show_validation_image:
                         fname = 'validation_image' + str(self.selected_calibration)+'.png'
                         fname = self._add_to_name(fname)
-                        self.accuracy_image.image = fname
+                        self._show_result_image(fname)
                         self.calibration_image_text.text = self.settings.graphics.CAL_IMAGE_BUTTON_TEXT
                     else:
                         fname = 'calibration_image' + str(self.selected_calibration)+'.png'
                         fname = self._add_to_name(fname)
-                        self.accuracy_image.image = fname
+                        self._show_result_image(fname)
                         self.calibration_image_text.text = 'Show validation (s)'
 
                     cal_image_button_pressed = True
@@ -1721,22 +1946,239 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
 
         if not ts:
             ts = self.get_system_time_stamp()
-        self.msg_container.append([ts, msg])
 
+        self._log_queued_messages()
+        self._log_message(ts, msg)
 
     #%%
-    def _draw_eye_image(self):
-        ''' Draw left and right eye image
+    def _queue_message(self, msg, ts=None):
+        ''' Used instead of send_message by the monitors, which run in a
+        background thread. The messages are logged (and passed to the
+        message listeners) on the thread of the experiment, the next time
+        a message is sent, data are read with read_new, recording is
+        stopped or the data are saved
         '''
 
-        if self.buffer.has_stream('eye_image'):
+        if not ts:
+            ts = self.get_system_time_stamp()
+        self._queued_messages.append((ts, msg))
 
-            # Grab the two most recent eye images from the buffer
-            if self.settings.eye_tracker_name == 'Tobii Pro Fusion':
-                eye_images = self.buffer.peek_N('eye_image', 4, 'end')
+    #%%
+    def _log_queued_messages(self):
+        ''' Logs the messages queued by the monitors
+        '''
+
+        while self._queued_messages:
+            self._log_message(*self._queued_messages.popleft())
+
+    #%%
+    def _log_message(self, ts, msg):
+        ''' Adds a message to the data, and passes it to the listeners
+        '''
+
+        self.msg_container.append(ts, msg)
+
+        # Start a new segment (if requested)
+        if self._stream_writer is not None:
+            self._stream_writer.message(ts, msg)
+
+        # Messages are journaled while recording (see start_recording)
+        if self._journal is not None:
+            self._journal.write_message(ts, msg)
+
+        for listener in self._message_listeners:
+            listener.message(ts, msg)
+
+    #%%
+    def add_message_listener(self, listener):
+        ''' Passes each message sent with send_message to listener,
+        e.g., to reset a titta.aoi.DwellAccumulator at trial markers
+
+        Args:
+            listener - object with a method message(ts, msg)
+        '''
+
+        self._message_listeners.append(listener)
+
+    #%%
+    def remove_message_listener(self, listener):
+        ''' Stops passing messages to listener
+        '''
+
+        self._message_listeners.remove(listener)
+
+
+    #%%
+    def read_new(self, stream='gaze', consumer='default'):
+        ''' Returns the samples added to the buffer since the last call
+        (by the same consumer), without consuming them. Each consumer has its
+        own cursor, so several readers (and save_data) get all samples.
+
+        Args:
+            stream - name of the stream, e.g., 'gaze' or 'external_signal'
+            consumer - (optional) name of the reader
+
+        Returns:
+            dict with one entry per column. The first call returns all
+            samples in the buffer, unless reset_cursor was called.
+        '''
+
+        if stream == 'positioning':
+            raise ValueError('The positioning stream has no time stamps, use buffer.peek_N instead')
+
+        t_col = storage.time_column(stream)
+        watermark = self._cursors.get((stream, consumer), -1)
+
+        data = self.buffer.peek_time_range(stream, watermark + 1)
+        if len(data[t_col]) > 0:
+            self._cursors[(stream, consumer)] = int(data[t_col][-1])
+
+        self._log_queued_messages()
+
+        return data
+
+    #%%
+    def reset_cursor(self, stream='gaze', consumer='default'):
+        ''' Moves the cursor of a consumer to the most recent sample, such
+        that the next call to read_new only returns samples that arrive after
+        this call
+
+        Args:
+            stream - name of the stream, e.g., 'gaze' or 'external_signal'
+            consumer - (optional) name of the reader
+        '''
+
+        t_col = storage.time_column(stream)
+        sample = self.buffer.peek_N(stream, 1)
+        if len(sample[t_col]) > 0:
+            self._cursors[(stream, consumer)] = int(sample[t_col][-1])
+        else:
+            self._cursors[(stream, consumer)] = -1
+
+    #%%
+    def iter_new_samples(self, stream='gaze', consumer='default'):
+        ''' Yields the samples added to the buffer since the previous
+        iteration (see read_new), as soon as they arrive. Only batches with
+        at least one sample are yielded.
+
+        Example:
+            tracker.reset_cursor('gaze')
+            for samples in tracker.iter_new_samples('gaze'):
+                x = samples['left_gaze_point_on_display_area_x']
+                ...
+                if done:
+                    break
+
+        Args:
+            stream - name of the stream, e.g., 'gaze' or 'external_signal'
+            consumer - (optional) name of the reader
+        '''
+
+        t_col = storage.time_column(stream)
+
+        # Poll at twice the sampling rate
+        poll_interval = 1 / (2 * self.settings.SAMPLING_RATE)
+        while True:
+            data = self.read_new(stream, consumer)
+            if len(data[t_col]) > 0:
+                yield data
             else:
-                eye_images = self.buffer.peek_N('eye_image', 2, 'end')
+                time.sleep(poll_interval)
+
+    #%%
+    def peek_aligned(self, streams, t0=None, t1=None, method='nearest', max_offset=0.1):
+        ''' Returns the data from several streams on a common timeline,
+        without consuming them. The timeline is given by the time stamps of
+        the first stream, and the samples of the other streams are aligned
+        to it (see storage.align_stream). The positioning stream has no time
+        stamps; its most recent sample is used for all time stamps.
+
+        Example:
+            d = tracker.peek_aligned(['gaze', 'external_signal'], t0, t1, method='previous')
+            d['gaze']['left_pupil_diameter'], d['external_signal']['value']
+
+        Eye openness is not a separate stream: it is part of the gaze
+        samples (d['gaze']['left_eye_openness_diameter']) when enabled with
+        set_include_eye_openness_in_gaze.
+
+        Args:
+            streams - list with names of streams, e.g., ['gaze', 'positioning']
+            t0, t1 - (optional) time range (system time stamps, us). If both
+                     are None, only the most recent sample of the first
+                     stream is returned
+            method - 'nearest', 'previous', or 'linear' (see storage.align_stream)
+            max_offset - (optional) maximum time (s) between a time stamp and
+                         the sample aligned to it, None for no limit
 
+        Returns:
+            dict with the timeline ('system_time_stamp'), and one entry per
+            stream with a dict with one entry per column. Time stamps without
+            a sample within max_offset get missing values. If the first stream
+            or the positioning stream has no data yet, the timeline is empty.
+        '''
+
+        ref = streams[0]
+        if ref == 'positioning':
+            raise ValueError('The positioning stream has no time stamps, and cannot be used as timeline')
+
+        if t0 is None and t1 is None:
+            ref_data = self.buffer.peek_N(ref, 1)
+        elif t1 is None:
+            ref_data = self.buffer.peek_time_range(ref, t0)
+        else:
+            ref_data = self.buffer.peek_time_range(ref, -1 if t0 is None else t0, t1)
+        timeline = np.asarray(ref_data[storage.time_column(ref)], dtype=np.int64)
+
+        out = {'system_time_stamp': timeline, ref: ref_data}
+        max_offset_us = None if max_offset is None else int(max_offset * 1e6)
+        complete = len(timeline) > 0
+        for stream in streams[1:]:
+            if stream == 'positioning':
+                data = self.buffer.peek_N(stream, 1)
+                out[stream] = {k: np.repeat(np.asarray(v), len(timeline)) for k, v in data.items()}
+                complete = complete and len(next(iter(data.values()))) > 0
+            else:
+                # Samples from the range of the timeline, with margins for the
+                # samples closest to its first and last time stamps
+                margin = 10**6 if max_offset_us is None else max_offset_us
+                t_first = int(timeline[0]) if len(timeline) > 0 else 0
+                t_last = int(timeline[-1]) if len(timeline) > 0 else 0
+                data = self.buffer.peek_time_range(stream, t_first - margin, t_last + margin)
+                out[stream] = storage.align_stream(timeline, stream, data,
+                                                   method=method, max_offset=max_offset_us)
+
+        if not complete:
+            # Nothing to align to yet
+            out = {key: (value[:0] if key == 'system_time_stamp' else
+                         {k: v[:0] for k, v in value.items()})
+                   for key, value in out.items()}
+
+        return out
+
+    #%%
+    def _peek_eye_images(self):
+        ''' Returns the most recent eye image of each camera (and region),
+        or None if the eye tracker has no eye image stream
+        '''
+
+        if not self.buffer.has_stream('eye_image'):
+            return None
+
+        # The Fusion has 4 eye images, while Spectrum only 2
+        if self.settings.eye_tracker_name == 'Tobii Pro Fusion':
+            return self.buffer.peek_N('eye_image', 4, 'end')
+        else:
+            return self.buffer.peek_N('eye_image', 2, 'end')
+
+    #%%
+    def _draw_eye_image(self, eye_images):
+        ''' Draw left and right eye image
+
+        Args:
+            eye_images - dict with eye images (see _peek_eye_images), or None
+        '''
+
+        if eye_images is not None:
 
             for i in range(len(eye_images['image'])):
 
@@ -1783,19 +2225,20 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
         return self.buffer.frequency
 
     #%%
-    def save_data(self, filename=None, append_version=True):
-        ''' Saves the data to HDF5 container
-        If you want to read the data, see the 'resources' folder
+    def _get_filename(self, filename=None, append_version=True, ignore=None):
+        ''' Returns the name (including path, but without extension) of the
+        file where data are stored
 
         Args:
             filename - if a filename is given, it overrides the name stored
                 in self.settings.FILENAME
             append_version : if file exists, it is appended with filename_1 etc.
                 THis is to prevent file from being overwritten
+            ignore - (optional) name of a file (including extension) that
+                does not count as existing, e.g., the journal of the session
+                that is saved
         '''
 
-        t0 = time.time()
-
         if filename:
             fname = filename
         else:
@@ -1807,79 +2250,293 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
 
         # If a path for data storage is given, use that, otherwise save data
         # in current working directory
+        # (the .json file is written for all storage formats, and the
+        # .journal file may be all that is left of a crashed session)
         if self.settings.DATA_STORAGE_PATH.strip():
-            files = Path(self.settings.DATA_STORAGE_PATH).glob('*.h5')
+            folder = Path(self.settings.DATA_STORAGE_PATH)
         else:
-            files = Path.cwd().glob('*.h5')
-
-        #print(Path.cwd())
-        while True:
-
-            # Go through the files and look for a match
-            filename_exists = False
-            for f in files:
-                f_temp = str(f).split(os.sep)[-1].split('.')[0]
-                #print(f_temp, fname)
-
-                # if the file exists
-                if fname + filename_ext == f_temp:
-                    if not append_version:
-                        print('Warning! Filename already exists. Will be overwritten.')
-                    else: # append '_i to filename
-                        filename_ext = '_' + str(i)
-                        i += 1
-                    filename_exists = True
-                    break
-
-            # If we've gone through all files without
-            # a match, we ready!
-            if not filename_exists:
-                 break
+            folder = Path.cwd()
+        files = (list(folder.glob('*.h5')) + list(folder.glob('*.json')) +
+                 list(folder.glob('*.journal')))
+        if ignore is not None:
+            files = [f for f in files if os.path.abspath(f) != os.path.abspath(ignore)]
+        existing = set(str(f).split(os.sep)[-1].split('.')[0] for f in files)
+
+        # Files of earlier calls to save_data_async may not exist yet
+        with self._reserved_lock:
+            reserved = set(self._reserved_filenames)
+
+        def exists(name):
+            return (name in existing or
+                    self._add_to_name(name, append_name=False) in reserved)
+
+        if exists(fname):
+            if not append_version:
+                print('Warning! Filename already exists. Will be overwritten.')
+            else: # append '_i to filename
+                while exists(fname + filename_ext):
+                    filename_ext = '_' + str(i)
+                    i += 1
 
          # Add the new extension the the filename
         fname = os.sep.join([fname + filename_ext])
         fname = self._add_to_name(fname, append_name=False)
 
-        # Save gaze data to HDF5 container
-        temp = self.buffer.consume_N('gaze',sys.maxsize)
-        pd.DataFrame.from_dict(temp).to_hdf(fname + '.h5', key='gaze')
+        return fname
+
+    #%%
+    def _start_journal(self):
+        ''' Starts the journal, which is written to file while recording
+        and deleted when the data are saved. After a crash, the data can be
+        recovered with titta.journal.recover_session(<filename>.journal).
+        The journal gets the name of the file data are streamed to (if any),
+        otherwise a version of the filename that is not used by data files or
+        by the journal of an earlier (crashed) session
+        '''
+
+        if self._stream_writer is not None:
+            fname = self._stream_writer.fname
+        else:
+            fname = self._get_filename()
+        self._journal = journal.Journal(self.buffer, fname,
+                                        interval=self.settings.JOURNAL_INTERVAL)
+        self._journal.start()
+
+    #%%
+    def save_data(self, filename=None, append_version=True):
+        ''' Saves the data to HDF5 container
+        If you want to read the data, see the 'resources' folder
+
+        Args:
+            filename - if a filename is given, it overrides the name stored
+                in self.settings.FILENAME
+            append_version : if file exists, it is appended with filename_1 etc.
+                THis is to prevent file from being overwritten
+
+        If data were written to file during recording (settings.STREAM_DATA_TO_DISK),
+        only the remaining data are written and the file is finalized (and
+        renamed, if another filename is given).
+        '''
+
+        t0 = time.time()
+
+        session = self._snapshot_data(filename, append_version, in_chunks=True)
+        try:
+            self._write_data(session)
+        finally:
+            self._release_filename(session['fname'])
+
+        print(f'Took {time.time() - t0} s to save the data')
+
+    #%%
+    def save_data_async(self, filename=None, append_version=True):
+        ''' Saves the data to HDF5 container without blocking
+
+        The recorded data and messages are collected (and the containers
+        cleared) directly, while the data are written to file in a
+        worker thread. Recording can therefore continue, or a new block
+        start, as soon as this function returns. The name, format and
+        compression of the file are determined directly as well, so the
+        settings can be changed for the next block right away.
+
+        Args:
+            filename - if a filename is given, it overrides the name stored
+                in self.settings.FILENAME
+            append_version : if file exists, it is appended with filename_1 etc.
+                THis is to prevent file from being overwritten
+
+        Returns:
+            concurrent.futures.Future - its result() is a tuple with the
+                name of the saved HDF5 file (or folder with Parquet files) and
+                the time (s) it took to save the data
+        '''
+
+        t0 = time.time()
+
+        session = self._snapshot_data(filename, append_version)
+
+        # One worker, such that files are written in the order they were requested
+        if self._save_executor is None:
+            self._save_executor = ThreadPoolExecutor(max_workers=1)
+
+        return self._save_executor.submit(self._save_snapshot, session, t0)
+
+    #%%
+    def _save_snapshot(self, session, t0):
+        ''' Writes a snapshot to file (called from worker thread by save_data_async)
+        '''
+
+        try:
+            fname = self._write_data(session)
+        finally:
+            self._release_filename(session['fname'])
+
+        if session['format'] == 'parquet' and 'stream_writer' not in session:
+            return fname, time.time() - t0
+        else:
+            return fname + '.h5', time.time() - t0
+
+    #%%
+    def _release_filename(self, fname):
+        ''' Allows _get_filename to return a name reserved by _snapshot_data
+        again (once the file exists, or could not be written)
+        '''
+
+        with self._reserved_lock:
+            self._reserved_filenames.discard(fname)
+
+    #%%
+    def _snapshot_data(self, filename=None, append_version=True, in_chunks=False):
+        ''' Collects all data that should be saved, and clears the data containers.
+        The name of the file is determined (and reserved until the file has
+        been written, see _release_filename), as are its format and compression,
+        such that changing the settings afterwards does not affect the file
+
+        Args:
+            filename - see save_data
+            append_version - see save_data
+            in_chunks - if True, samples are not consumed from the buffer directly,
+                        but in chunks (of size settings.SAVE_CHUNK_SIZE) while they are
+                        written to file. This keeps memory use constant.
+
+        Returns:
+            session - dict with the collected data. session['streams'] contains
+                      an iterable of chunks per stream. session['fname'] is the
+                      name of the file (without extension)
+        '''
+
+        session = {'format': self.settings.DATA_STORAGE_FORMAT,
+                   'compression': self.settings.DATA_COMPRESSION}
+
+        # Messages from the monitor thread not yet logged
+        self._log_queued_messages()
+
+        # Close the journal before any data are consumed from the buffer.
+        # It is deleted when the data have been written to file. A journal
+        # that could not be written does not stop the data from being saved
+        journal_fname = None
+        if self._journal is not None:
+            journal_fname = self._journal.fname
+            try:
+                self._journal.stop()
+            except RuntimeError as e:
+                warnings.warn(f'{e} ({e.__cause__}). The data are saved anyway')
+            session['journal'] = self._journal
+            self._journal = None
+
+        if self._stream_writer is not None:
+            # Data are already being written to file; the writer only has to
+            # write the data recorded until now
+            session['stream_writer'] = self._stream_writer
+            session['t_end'] = self.get_system_time_stamp()
+            self._stream_writer = None
+
+            # The file is renamed if another filename is given
+            if filename and self._add_to_name(filename, append_name=False) != session['stream_writer'].fname:
+                session['fname'] = self._get_filename(filename, append_version, journal_fname)
+            else:
+                session['fname'] = session['stream_writer'].fname
+        else:
+            session['fname'] = self._get_filename(filename, append_version, journal_fname)
+
+            session['streams'] = {}
+            for stream in storage.STREAMS:
+                if not self.buffer.has_stream(stream):
+                    continue
+
+                if not in_chunks:
+                    session['streams'][stream] = [self.buffer.consume_N(stream, sys.maxsize)]
+                elif stream == 'eye_image':
+                    session['streams'][stream] = storage.iter_chunks(self.buffer, stream,
+                                                                     self.settings.SAVE_CHUNK_SIZE_EYE_IMAGES)
+                else:
+                    session['streams'][stream] = storage.iter_chunks(self.buffer, stream,
+                                                                     self.settings.SAVE_CHUNK_SIZE)
+
+        with self._reserved_lock:
+            self._reserved_filenames.add(session['fname'])
+
+        session['msg'] = self.msg_container
+        session['calibration_history'] = self.calibration_history()
+
+        if self._latency_monitor is not None:
+            session['latency'] = self._latency_monitor.summary()
+            self._latency_monitor.reset()
+        session['system_info'] = self.system_info()
+
+        # Clear data containers
+        self.msg_container = MessageLog()
+        self.all_validation_results = []
+
+        # Stop logging and get data from the python wrapper
+        TittaPy.stop_logging()
+        session['log'] = TittaPy.get_log(True)  # True means the log is consumed. False (default) its only peeked.
+
+        return session
+
+    #%%
+    def _write_data(self, session):
+        ''' Writes data collected by _snapshot_data to a HDF5 container.
+        Only the file name, format and compression in session are used (not
+        the current settings), since this may run in a worker thread
+
+        Returns:
+            fname - name of the file (without extension)
+        '''
+
+        streamed = 'stream_writer' in session
+        data_format = session['format']
+        parquet_compression = self._parquet_compression(session['compression'])
+
+        # Lookup tables of enum columns, which are stored as integer codes
+        lookups = {}
+        if streamed:
+            # Write remaining samples to the file that was created when
+            # recording started
+            session['stream_writer'].stop(session['t_end'])
+            fname = session['stream_writer'].fname
+        elif data_format == 'columnar':
+            fname = session['fname']
+
+            # Save each column of each stream as a separate typed dataset
+            with h5py.File(fname + '.h5', 'a') as hf:
+                for stream, chunks in session['streams'].items():
+                    for temp in chunks:
+                        storage.write_stream(hf, stream, temp,
+                                             session['compression'])
+        elif data_format == 'parquet':
+            fname = session['fname']
+
+            # Save each stream as a Parquet file in a folder named fname
+            for stream, chunks in session['streams'].items():
+                storage.write_stream_parquet(fname, stream, chunks,
+                                             parquet_compression)
+        else:
+            fname = session['fname']
+
+            # Save gaze data and all other streams in the same HDF5 container
+            for stream, chunks in session['streams'].items():
+                storage.write_stream_pandas(fname + '.h5', stream, chunks, lookups)
+
+        parquet = not streamed and data_format == 'parquet'
 
         # Save messages as HDF5 container
-        df_msg = pd.DataFrame(self.msg_container,  columns=['system_time_stamp', 'msg'])
-        df_msg.to_hdf(fname + '.h5', key='msg')
-
-        # Save all other gaze streams in the same HDF5 container
-        if self.buffer.has_stream('time_sync'):
-            temp = self.buffer.consume_N('time_sync',sys.maxsize)
-            pd.DataFrame.from_dict(temp).to_hdf(fname + '.h5', key='time_sync')
-        if self.buffer.has_stream('external_signal'):
-            temp = self.buffer.consume_N('external_signal',sys.maxsize)
-
-            # Change external_signal_change_type type into list
-            temp['change_type'] = [t.name for t in temp['change_type']]
-
-            pd.DataFrame.from_dict(temp).to_hdf(fname + '.h5', key='external_signal')
-        if self.buffer.has_stream('notification'):
-            '''
-            your performance may suffer as PyTables will pickle object types that it cannot
-            map directly to c-types [inferred_type->mixed,key->block2_values] [items->Index(['notification_type', 'display_area', 'errors_or_warnings'], dtype='object')]
-            '''
-            temp = self.buffer.consume_N('notification',sys.maxsize)
-
-            # Change notification type into list
-            temp['notification_type'] = [t.name for t in temp['notification_type']]
-
-            # Change change all others to strings to prevent above warning
-            # columns = ['errors_or_warnings', 'display_area', 'output_frequency']
-            # df.loc[:,columns] = df[columns].applymap(str)
-            temp['display_area'] = [repr(t) for t in temp['display_area']]
-            temp['output_frequency'] = [repr(t) for t in temp['output_frequency']]
-            temp['errors_or_warnings'] = [repr(t) for t in temp['errors_or_warnings']]
-
-            pd.DataFrame.from_dict(temp).to_hdf(fname + '.h5', key='notification')
+        df_msg = session['msg'].to_dataframe()
+        if parquet:
+            storage.write_table_parquet(fname, 'msg',
+                                        [{'system_time_stamp': df_msg.system_time_stamp.to_numpy(dtype=np.int64),
+                                          'msg': df_msg.msg.to_numpy(dtype=str)}],
+                                        parquet_compression)
+        elif streamed or data_format == 'columnar':
+            with h5py.File(fname + '.h5', 'a') as hf:
+                storage.append_columns(hf.require_group('msg'),
+                                       {'system_time_stamp': df_msg.system_time_stamp.to_numpy(dtype=np.int64),
+                                        'msg': df_msg.msg.to_numpy()})
+        else:
+            df_msg.to_hdf(fname + '.h5', key='msg')
 
        # Save calibration history to HDF5 container
-        df_cal = pd.DataFrame(self.calibration_history(),  columns=['offset_left_eye (deg)',
+        df_cal = pd.DataFrame(session['calibration_history'],  columns=['offset_left_eye (deg)',
                                                                   'offset_right_eye (deg)',
                                                                   'RMS_S2S_left_eye (deg)',
                                                                   'RMS_S2S_right_eye (deg)',
@@ -1888,59 +2545,80 @@ RMS_R: {:.2f}, LOSS_L: {:.1f}, LOSS_R: {:.1f}, SD_L: {:.2f}, SD_R: {:.2f}' \
                                                                   'SD_left_eye (deg)',
                                                                   'SD_right_eye (deg)',
                                                                   'Calibration used'])
-        df_cal.to_hdf(fname + '.h5', key='calibration_history')
+        if parquet:
+            storage.write_table_parquet(fname, 'calibration_history',
+                                        [{c: df_cal[c].to_numpy() for c in df_cal.columns}],
+                                        parquet_compression)
+        else:
+            df_cal.to_hdf(fname + '.h5', key='calibration_history')
+
+        # Save summary of the sample latency
+        if 'latency' in session:
+            df_latency = pd.DataFrame([session['latency']])
+            if parquet:
+                storage.write_table_parquet(fname, 'latency',
+                                            [{c: df_latency[c].to_numpy() for c in df_latency.columns}],
+                                            parquet_compression)
+            else:
+                df_latency.to_hdf(fname + '.h5', key='latency')
 
         # Save tracker/python version info as json
-        temp = self.system_info()
+        temp = session['system_info']
         with open(fname + '.json', "w") as outfile:
             json.dump(temp, outfile)
 
         # Also save tracker/python version to .h5-file as attributes
-        with h5py.File(fname + '.h5', 'a') as hf:
-            for a in temp:
-                if a in ('track_box', 'display_area'):
-                    continue
-                hf.attrs[a] = temp[a]
-
-        # Save image stream in the same HDF5 container
-        temp = self.buffer.consume_N('eye_image')
-        if len(temp['image']) > 0:
-
+        if not parquet:
             with h5py.File(fname + '.h5', 'a') as hf:
-                grp = hf.create_group('eye_image')
-
-                # Save each frame as a separate dataset in this group
-                # To access later, use [i[:] for i in grp.values()]
-                for k, im in enumerate(temp['image']):
-                    grp.create_dataset(str(k), data=im)
-
-            # # Remove the numpy image and save the rest
-            del temp['image']
-            temp['type'] = [t.name for t in temp['type']] # LIst of strings, e.g, "full_image", "cropped_image"
-            pd.DataFrame.from_dict(temp).to_hdf(fname + '.h5', key='eye_metadata')
+                for a in temp:
+                    if a in ('track_box', 'display_area'):
+                        continue
+                    hf.attrs[a] = temp[a]
 
-        # Clear data containers
-        self.msg_container = []
-        self.all_validation_results = []
-
-        # Stop logging and Save data from the python wrapper
-        TittaPy.stop_logging()
-        l=TittaPy.get_log(True)  # True means the log is consumed. False (default) its only peeked.
+        # Save data from the python wrapper
+        l = session['log']
         if len(l) > 0:
             d =  {}
             for key in list(l[0].keys()):
                 d[key] = [i[key] for i in l]
 
-            # Convert to prevent warning when saving to Hdf5 (see notifications above)
-            d['level'] = [t.name for t in d['level']]
-            d['source'] = [t.name for t in d['source']]
+            # Store level and source as integer codes
+            lookups['log'] = {}
+            d = storage.prepare_stream_data('log', d, lookups['log'])
 
             # Save log file
-            pd.DataFrame.from_dict(d).to_hdf(fname + '.h5', key='log')
-
-        print(f'Took {time.time() - t0} s to save the data')
+            if parquet:
+                storage.write_table_parquet(fname, 'log', [d],
+                                            parquet_compression,
+                                            lookups['log'])
+            else:
+                pd.DataFrame.from_dict(d).to_hdf(fname + '.h5', key='log')
 
+        # Save the lookup tables of the enum columns (in Parquet files, enum
+        # columns are dictionary encoded with the names)
+        if not parquet and len(lookups) > 0:
+            storage.enum_lookup_table(lookups).to_hdf(fname + '.h5', key='enum_lookup')
 
+        # Give the file the requested name if data were streamed to another file
+        if streamed and session['fname'] != fname:
+            fname_new = session['fname']
+            session['stream_writer'].rename(fname_new)
+            for ext in ('.h5', '.json'):
+                os.replace(fname + ext, fname_new + ext)
+            fname = fname_new
 
+        # The data are safely on disk, so the journal is no longer needed
+        if 'journal' in session:
+            session['journal'].remove()
 
+        return fname
 
+    #%%
+    def _parquet_compression(self, compression):
+        ''' Returns the compression codec used for Parquet files, given
+        settings.DATA_COMPRESSION
+        '''
+        if compression is None:
+            return 'snappy'
+        else:
+            return compression
@@ -11,7 +11,9 @@ import time
 from titta import helpers_tobii as helpers
 from threading import Thread
 import numpy as np
+import os
 import sys
+from concurrent.futures import Future
 
 sample_list = ['device_time_stamp', 'system_time_stamp',
        'left_gaze_point_on_display_area_x',
@@ -62,9 +64,21 @@ class Buffer(Thread):
         self.__stop = True
         self.sample = {}
 
+        # Number of samples removed from the start of the lists (by
+        # consume_N), such that sample i is at index i - n_removed
+        self.n_removed = 0
+
+        # Transform from mouse position to Tobii's coordinate system
+        if win.units == 'norm':
+            self._transform = helpers.CoordinateTransform.norm()
+        elif win.units == 'pix':
+            self._transform = helpers.CoordinateTransform.pix(win.monitor.getSizePix())
+        elif win.units == 'deg':
+            self._geometry = helpers.MonitorGeometry.from_monitor(win.monitor)
+
         # Initiate an empty sample dict
         for l in sample_list:
-            self.sample[l] = [0]
+            self.sample[l] = []
 
         self._start_sample_buffer()
 
@@ -92,7 +106,8 @@ class Buffer(Thread):
         temp = self.peek_N(stream, N)
 
         # Remove data from dict
-        self.sample = {k : [0] for k in self.sample}
+        self.n_removed += len(self.sample['system_time_stamp'])
+        self.sample = {k : [] for k in self.sample}
         return temp
 
     #%%
@@ -138,23 +153,31 @@ class Buffer(Thread):
         # norm coordinate system (currently supports 'norm' and 'deg')
 
         if self.win.units == 'norm':
-            xy = helpers.norm2tobii(np.array([x, y],ndmin=2))
+            xy = self._transform.inverse(np.array([x, y],ndmin=2))
         elif self.win.units == 'deg':
-            xy = helpers.deg2tobii(np.array([x, y],ndmin=2), self.win.monitor)
+            xy = self._geometry.deg2tobii(np.array([x, y],ndmin=2))
         elif self.win.units == 'pix':
-            xy = helpers.pix2tobii(np.array([x, y],ndmin=2), self.win.monitor)
+            xy = self._transform.inverse(np.array([x, y],ndmin=2))
         else:
             raise IOError ('Invalid unit of PsychoPy screen: Titta in dummy mode currently \
                            supports "norm", "pix", and "deg".')
+        # System time stamp in us (int64), as TittaPy
+        ts = int(ptb.GetSecs() * 1e6)
+
         for key in self.sample:
-            if '_x' in key:
+            if key == 'system_time_stamp':
+                continue
+            if key == 'device_time_stamp':
+                self.sample[key].append(ts)
+            elif '_x' in key:
                 self.sample[key].append(xy[0, 0])
             elif '_y' in key:
                 self.sample[key].append(xy[0, 1])
             else:
                 self.sample[key].append(np.random.rand())
 
-        self.sample['system_time_stamp'].append(ptb.GetSecs())
+        # Added last, so all other columns are complete up to its length
+        self.sample['system_time_stamp'].append(ts)
 
     #%%
     def _stop_sample_buffer(self):
@@ -174,6 +197,13 @@ class Connect(object):
         # clock
         self.clock = core.Clock()
 
+        # Cursor of each reader (see read_new), as the number of the next
+        # sample to return, per (stream, consumer)
+        self._cursors = {}
+
+        # Objects notified of each message (see add_message_listener)
+        self._message_listeners = []
+
     def init(self):
         ''' Connect to eye tracker
         and apply settings
@@ -201,10 +231,10 @@ class Connect(object):
 
     #%%
     def get_system_time_stamp(self):
-        ''' Get system time stamp
+        ''' Get system time stamp (in us, as TittaPy)
         '''
 
-        return ptb.GetSecs()
+        return int(ptb.GetSecs() * 1e6)
 
     #%%
     def start_recording(self,   gaze=False,
@@ -220,7 +250,26 @@ class Connect(object):
 
     #%%
     def send_message(self, msg, ts=None):
-        print(str(ptb.GetSecs()) + '_' + msg)
+        if not ts:
+            ts = self.get_system_time_stamp()
+        print(str(ts) + '_' + msg)
+
+        for listener in self._message_listeners:
+            listener.message(ts, msg)
+
+    #%%
+    def add_message_listener(self, listener):
+        ''' Passes each message to listener (see Tobii.myTobii)
+        '''
+
+        self._message_listeners.append(listener)
+
+    #%%
+    def remove_message_listener(self, listener):
+        ''' Stops passing messages to listener
+        '''
+
+        self._message_listeners.remove(listener)
 
 
     #%%
@@ -283,6 +332,106 @@ class Connect(object):
 
         print('save data')
 
+    #%%
+    def save_data_async(self, filename=None, append_version=True):
+        ''' Saves the data to HDF5 container without blocking
+        Returns a future, whose result() is a tuple with the name the HDF5
+        file would get (no data are saved in dummy mode) and the time (s) it
+        took to save the data
+        '''
+
+        print('save data async')
+
+        fname = filename if filename else self.settings.FILENAME
+        if self.settings.DATA_STORAGE_PATH.strip():
+            fname = self.settings.DATA_STORAGE_PATH + os.sep + fname
+
+        future = Future()
+        future.set_result((fname + '.h5', 0.0))
+        return future
+
+    #%%
+    def read_new(self, stream='gaze', consumer='default'):
+        ''' Returns the (simulated) samples added since the last call
+        by the same consumer, without consuming them
+        '''
+
+        # The cursor is the number of the next sample to return (samples
+        # consumed from the buffer are counted in n_removed)
+        n = len(self.buffer.sample['system_time_stamp'])
+        i = max(self._cursors.get((stream, consumer), 0) - self.buffer.n_removed, 0)
+        self._cursors[(stream, consumer)] = self.buffer.n_removed + n
 
+        return {key: np.array(values[i:n]) for key, values in self.buffer.sample.items()}
+
+    #%%
+    def reset_cursor(self, stream='gaze', consumer='default'):
+        ''' Moves the cursor of a consumer to the most recent (simulated) sample
+        '''
+
+        self._cursors[(stream, consumer)] = self.buffer.n_removed + len(self.buffer.sample['system_time_stamp'])
+
+    #%%
+    def iter_new_samples(self, stream='gaze', consumer='default'):
+        ''' Yields the (simulated) samples added since the previous iteration
+        '''
+
+        while True:
+            data = self.read_new(stream, consumer)
+            if len(data['system_time_stamp']) > 0:
+                yield data
+            else:
+                time.sleep(1 / (2 * self.settings.SAMPLING_RATE))
+
+    #%%
+    def peek_aligned(self, streams, t0=None, t1=None, method='nearest', max_offset=0.1):
+        ''' Returns the most recent (simulated) gaze sample. Only the gaze
+        stream is simulated, the other streams are empty
+        '''
+
+        sample = {key: np.array(values[-1:]) for key, values in self.buffer.sample.items()}
+        out = {'system_time_stamp': sample['system_time_stamp']}
+        for stream in streams:
+            out[stream] = sample if stream == 'gaze' else {}
+
+        return out
+
+    #%%
+    def quality_snapshot(self):
+        ''' Data quality is not monitored in dummy mode
+        '''
+
+        return None
+
+    #%%
+    def latency_summary(self):
+        ''' Latency is not monitored in dummy mode
+        '''
+
+        return None
+
+    #%%
+    def dropped_samples(self):
+        ''' Dropped samples are not monitored in dummy mode
+        '''
+
+        return None
+
+    #%%
+    def set_drop_rate_callback(self, callback):
+        ''' Dropped samples are not monitored in dummy mode
+        '''
+        pass
+
+    #%%
+    def wait_for_data(self, stream='gaze', timeout=5.0):
+        ''' Returns the most recent (simulated) sample, once there is one
+        '''
 
+        t_stop = time.perf_counter() + timeout
+        while len(self.buffer.sample['system_time_stamp']) == 0:
+            if time.perf_counter() >= t_stop:
+                raise TimeoutError(f'No {stream} data arrived within {timeout} s.')
+            time.sleep(1 / self.settings.SAMPLING_RATE)
 
+        return self.buffer.peek_N(stream, 1)
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""
+Areas of interest (AOIs) for gaze contingent experiments.
+
+AOIs (rectangles, polygons, binary masks or label maps) are rasterized into
+one label raster when they are added. Each cell of the raster holds the id
+of a region, i.e., of the set of AOIs covering the cell, so overlapping AOIs
+are supported. Which AOIs a gaze sample hits is then found with one lookup
+in the raster, whether there are 5 AOIs or 500.
+
+Positions are in pixels, with the origin in the top left corner of the
+screen (as gaze in Tobii's coordinate system multiplied by the resolution,
+and as the AOI images in demo_analyses/AOI_example).
+"""
+
+import numpy as np
+from threading import Lock
+
+# Region ids returned for samples without valid gaze, and outside all AOIs
+INVALID = -1
+NO_AOI = 0
+
+#%%
+def gaze_position(data, size):
+    ''' Gaze position (pixels) from gaze data: the average of the two eyes,
+    or the position of the only eye with valid data (nan if neither eye is
+    valid). An eye is valid if both its x and y coordinates are not nan, so
+    x and y always come from the same eye(s)
+
+    Args:
+        data - dict with gaze data (TittaPy format)
+        size - (width, height) of the screen (pixels)
+
+    Returns:
+        x, y - arrays with the gaze position
+    '''
+
+    xy = np.empty((2, 2, len(data['system_time_stamp'])))
+    for i, eye in enumerate(['left', 'right']):
+        xy[i, 0] = np.multiply(data[eye + '_gaze_point_on_display_area_x'], size[0])
+        xy[i, 1] = np.multiply(data[eye + '_gaze_point_on_display_area_y'], size[1])
+
+    # Use an eye only if both coordinates are valid
+    valid = ~np.any(np.isnan(xy), axis=1)
+    n = np.sum(valid, axis=0)
+    avg = np.sum(np.where(valid[:, None], xy, 0.0), axis=0) / np.maximum(n, 1)
+    avg[:, n == 0] = np.nan
+
+    return avg[0], avg[1]
+
+#%%
+class AOIMap(object):
+    """
+    Registry of AOIs, rasterized into a label raster for constant time
+    hit tests
+    """
+    def __init__(self, size, cell_size=1):
+        '''
+        Args:
+            size - (width, height) of the screen (pixels)
+            cell_size - size (pixels) of the cells of the raster. A cell
+                        belongs to an AOI if its center does. Larger
+                        cells use less memory
+        '''
+
+        self.size = (int(size[0]), int(size[1]))
+        self.cell_size = int(cell_size)
+
+        n_rows = -(-self.size[1] // self.cell_size)
+        n_cols = -(-self.size[0] // self.cell_size)
+        self._raster = np.zeros((n_rows, n_cols), dtype=np.int32)
+
+        # Cell centers (pixels)
+        self._cx = (np.arange(n_cols) + 0.5) * self.cell_size
+        self._cy = (np.arange(n_rows) + 0.5) * self.cell_size
+
+        # AOI names, and their indices
+        self.names = []
+        self._index = {}
+
+        # Set of AOIs (indices) of each region, and the id of each set
+        self._regions = [frozenset()]
+        self._region_id = {frozenset(): NO_AOI}
+
+        # Which AOIs each region belongs to (n_regions x n_aois),
+        # built when first needed
+        self._member = None
+
+    #%%
+    def add_rect(self, name, x, y, width, height):
+        ''' Adds a rectangle to an AOI
+
+        Args:
+            name - name of the AOI (shapes added with the same name
+                   belong to the same AOI)
+            x, y - top left corner (pixels)
+            width, height - size (pixels)
+        '''
+
+        cols = np.flatnonzero((self._cx >= x) & (self._cx < x + width))
+        rows = np.flatnonzero((self._cy >= y) & (self._cy < y + height))
+        if len(cols) == 0 or len(rows) == 0:
+            return
+
+        sl = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        self._paint(sl, np.ones((len(rows), len(cols)), dtype=np.int32),
+                    [self._aoi_index(name)])
+
+    #%%
+    def add_polygon(self, name, vertices):
+        ''' Adds a polygon to an AOI
+
+        Args:
+            name - name of the AOI
+            vertices - N x 2 array with the (x, y) positions (pixels) of
+                       the vertices
+        '''
+
+        v = np.asarray(vertices, dtype=float)
+
+        # Only test the cells within the bounding box of the polygon
+        cols = np.flatnonzero((self._cx >= v[:, 0].min()) & (self._cx <= v[:, 0].max()))
+        rows = np.flatnonzero((self._cy >= v[:, 1].min()) & (self._cy <= v[:, 1].max()))
+        if len(cols) == 0 or len(rows) == 0:
+            return
+
+        px, py = np.meshgrid(self._cx[cols], self._cy[rows])
+
+        # Even-odd rule: count the edges crossed by a ray from each cell center
+        inside = np.zeros(px.shape, dtype=bool)
+        for (x0, y0), (x1, y1) in zip(v, np.roll(v, -1, axis=0)):
+            if y0 == y1:
+                continue
+            crosses = (y0 > py) != (y1 > py)
+            x_cross = x0 + (py - y0) * (x1 - x0) / (y1 - y0)
+            inside ^= crosses & (px < x_cross)
+
+        sl = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        self._paint(sl, inside.astype(np.int32), [self._aoi_index(name)])
+
+    #%%
+    def add_mask(self, name, mask, offset=(0, 0)):
+        ''' Adds a binary mask (e.g., an AOI image, as in
+        demo_analyses/AOI_example) to an AOI
+
+        Args:
+            name - name of the AOI
+            mask - 2D array (rows x columns). If not boolean, pixels with
+                   the maximum value (e.g., white) belong to the AOI
+            offset - (x, y) position (pixels) of the top left corner of
+                     the mask on the screen
+        '''
+
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            mask = mask == mask.max()
+
+        self.add_label_map(mask.astype(np.int32), {1: name}, offset)
+
+    #%%
+    def add_label_map(self, label_map, names=None, offset=(0, 0)):
+        ''' Adds a label map, where each value (except 0) is an AOI
+
+        Args:
+            label_map - 2D array (rows x columns) of integers
+            names - (optional) dict with the name of each value. Default:
+                    the value as a string
+            offset - (x, y) position (pixels) of the top left corner of
+                     the label map on the screen
+        '''
+
+        label_map = np.asarray(label_map)
+        if label_map.ndim != 2:
+            raise ValueError('A label map should be a 2D array')
+        if names is None:
+            names = {}
+
+        # Cells whose centers are on the label map
+        px = self._cx - offset[0]
+        py = self._cy - offset[1]
+        cols = np.flatnonzero((px >= 0) & (px < label_map.shape[1]))
+        rows = np.flatnonzero((py >= 0) & (py < label_map.shape[0]))
+        if len(cols) == 0 or len(rows) == 0:
+            return
+
+        # Values at the cell centers, as consecutive labels (0 is no AOI)
+        sampled = label_map[np.ix_(py[rows].astype(int), px[cols].astype(int))]
+        values, inv = np.unique(sampled, return_inverse=True)
+        nonzero = values != 0
+        lut = np.zeros(len(values), dtype=np.int32)
+        lut[nonzero] = np.arange(1, np.count_nonzero(nonzero) + 1)
+        labels = lut[inv].reshape(sampled.shape)
+
+        indices = [self._aoi_index(names.get(val, str(val))) for val in values[nonzero].tolist()]
+
+        sl = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+        self._paint(sl, labels, indices)
+
+    #%%
+    def _aoi_index(self, name):
+        ''' Returns the index of an AOI (added if new)
+        '''
+
+        if name not in self._index:
+            self._index[name] = len(self.names)
+            self.names.append(name)
+            self._member = None
+
+        return self._index[name]
+
+    #%%
+    def _paint(self, sl, labels, indices):
+        ''' Adds AOIs to the cells of a part of the raster
+
+        Args:
+            sl - (rows, columns) slices of the raster
+            labels - array with a label per cell; 0 means no AOI, and j
+                     means AOI indices[j - 1]
+            indices - AOI index of each label
+        '''
+
+        sub = self._raster[sl]
+        n_labels = len(indices) + 1
+
+        # New region of each (old region, label) combination in one pass
+        combined = sub.astype(np.int64) * n_labels + labels
+        combinations, inv = np.unique(combined, return_inverse=True)
+
+        new_ids = np.empty(len(combinations), dtype=np.int32)
+        for i, c in enumerate(combinations.tolist()):
+            region, label = divmod(c, n_labels)
+            if label == 0:
+                new_ids[i] = region
+            else:
+                new_ids[i] = self._get_region(self._regions[region] | {indices[label - 1]})
+
+        self._raster[sl] = new_ids[inv].reshape(sub.shape)
+
+    #%%
+    def _get_region(self, aois):
+        ''' Returns the id of the region covered by a set of AOIs
+        '''
+
+        if aois not in self._region_id:
+            self._region_id[aois] = len(self._regions)
+            self._regions.append(aois)
+            self._member = None
+
+        return self._region_id[aois]
+
+    #%%
+    def lookup(self, x, y):
+        ''' Returns the region of each position
+
+        Args:
+            x, y - positions (pixels)
+
+        Returns:
+            array with region ids: INVALID (-1) for nan positions,
+            NO_AOI (0) outside all AOIs (and outside the screen), else
+            the id of the set of AOIs hit (see region_names)
+        '''
+
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        col = np.floor(x / self.cell_size)
+        row = np.floor(y / self.cell_size)
+        valid = ~(np.isnan(x) | np.isnan(y))
+        on_screen = valid & (col >= 0) & (col < self._raster.shape[1]) & \
+                            (row >= 0) & (row < self._raster.shape[0])
+
+        regions = np.where(valid, NO_AOI, INVALID).astype(np.int32)
+        regions[on_screen] = self._raster[row[on_screen].astype(np.intp),
+                                          col[on_screen].astype(np.intp)]
+
+        return regions
+
+    #%%
+    def lookup_gaze(self, data):
+        ''' Returns the region of each gaze sample (see lookup)
+
+        Args:
+            data - dict with gaze data (TittaPy format), e.g., from
+                   tracker.read_new('gaze')
+        '''
+
+        return self.lookup(*gaze_position(data, self.size))
+
+    #%%
+    def region_names(self, region):
+        ''' Returns the names of the AOIs of a region (an empty tuple
+        for NO_AOI and INVALID)
+        '''
+
+        if region < 0:
+            return ()
+
+        return tuple(self.names[i] for i in sorted(self._regions[region]))
+
+    #%%
+    def membership(self):
+        ''' Returns a boolean array (n_regions x n_aois) telling which AOIs
+        each region belongs to. Index it with the output of lookup
+        '''
+
+        if self._member is None:
+            member = np.zeros((len(self._regions), len(self.names)), dtype=bool)
+            for r, aois in enumerate(self._regions):
+                member[r, list(aois)] = True
+            self._member = member
+
+        return self._member
+
+    #%%
+    def contains(self, name, x, y):
+        ''' Returns True for positions within an AOI
+
+        Args:
+            name - name of the AOI
+            x, y - positions (pixels)
+        '''
+
+        regions = self.lookup(x, y)
+        hit = self.membership()[np.maximum(regions, 0), self._index[name]]
+
+        return hit & (regions > NO_AOI)
+
+#%%
+class DwellAccumulator(object):
+    """
+    Running dwell time, number of entries and first entry latency per AOI,
+    updated with each batch of new gaze samples (e.g., from
+    tracker.read_new('gaze')), in time proportional to the size of the batch.
+
+    Samples without valid gaze (see gaze_position) do not add to the dwell
+    time. A visit to an AOI continues over a period of invalid samples (e.g.,
+    a blink) shorter than max_gap, such that it is not counted as a new entry
+    if gaze returns to the same AOI.
+
+    To reset at the start of each trial, let the tracker pass its messages to
+    the accumulator:
+        dwell = aoi.DwellAccumulator(aois, tracker.settings.SAMPLING_RATE,
+                                     reset_on_message='onset_')
+        tracker.add_message_listener(dwell)
+    """
+    def __init__(self, aoi_map, sampling_rate, max_gap=0.1, reset_on_message=None):
+        '''
+        Args:
+            aoi_map - AOIMap
+            sampling_rate - sampling rate (Hz) of the eye tracker. Each
+                            sample adds 1 / sampling_rate s of dwell time
+            max_gap - longest period (s) without valid gaze that does not
+                      end a visit
+            reset_on_message - (optional) reset when a message starting
+                               with this prefix is sent, e.g., 'onset_'
+        '''
+
+        self.aoi_map = aoi_map
+        self.sample_interval = 1.0 / sampling_rate
+        self.max_gap = int(max_gap * 1e6)
+        self.reset_on_message = reset_on_message
+
+        self._lock = Lock()
+        self.reset()
+
+    #%%
+    def reset(self, ts=None):
+        ''' Sets all totals to zero
+
+        Args:
+            ts - (optional) time stamp of the start of the trial. Samples
+                 recorded before ts are ignored, and first entry latencies
+                 are relative to ts. Default: the first sample added
+        '''
+
+        with self._lock:
+            n = len(self.aoi_map.names)
+            self._samples = np.zeros(n, dtype=np.int64)
+            self._entries = np.zeros(n, dtype=np.int64)
+            self._first_entry = np.full(n, -1, dtype=np.int64)
+
+            self._t_start = ts
+            self._last_region = NO_AOI
+            self._last_ts = None
+
+    #%%
+    def message(self, ts, msg):
+        ''' Resets the totals if msg is a trial marker (called by the
+        tracker for each message, see tracker.add_message_listener)
+        '''
+
+        if self.reset_on_message is not None and msg.startswith(self.reset_on_message):
+            self.reset(ts)
+
+    #%%
+    def update(self, data):
+        ''' Adds a batch of gaze samples
+
+        Args:
+            data - dict with gaze data (TittaPy format)
+        '''
+
+        ts = np.asarray(data['system_time_stamp'], dtype=np.int64)
+        regions = self.aoi_map.lookup_gaze(data)
+
+        with self._lock:
+            # AOIs added since the last reset
+            n_new = len(self.aoi_map.names) - len(self._samples)
+            if n_new > 0:
+                self._samples = np.concatenate((self._samples, np.zeros(n_new, dtype=np.int64)))
+                self._entries = np.concatenate((self._entries, np.zeros(n_new, dtype=np.int64)))
+                self._first_entry = np.concatenate((self._first_entry, np.full(n_new, -1, dtype=np.int64)))
+
+            if self._t_start is not None:
+                keep = ts >= self._t_start
+                ts, regions = ts[keep], regions[keep]
+
+            valid = regions != INVALID
+            ts, regions = ts[valid], regions[valid]
+            if len(ts) == 0:
+                return
+            if self._t_start is None:
+                self._t_start = int(ts[0])
+
+            sets = self.aoi_map._regions
+
+            # Dwell: samples per region, added to the AOIs of each region
+            counts = np.bincount(regions)
+            for r in np.flatnonzero(counts[1:]) + 1:
+                self._samples[list(sets[r])] += counts[r]
+
+            # Entries: AOIs of a region that were not in the previous
+            # region (or that gaze returned to after max_gap)
+            prev = np.empty_like(regions)
+            prev[1:] = regions[:-1]
+            if self._last_ts is not None and ts[0] - self._last_ts <= self.max_gap:
+                prev[0] = self._last_region
+            else:
+                prev[0] = NO_AOI
+            prev[1:][np.diff(ts) > self.max_gap] = NO_AOI
+
+            for i in np.flatnonzero(regions != prev):
+                for k in sets[regions[i]] - sets[prev[i]]:
+                    self._entries[k] += 1
+                    if self._first_entry[k] < 0:
+                        self._first_entry[k] = ts[i]
+
+            self._last_region = int(regions[-1])
+            self._last_ts = int(ts[-1])
+
+    #%%
+    def dwell_time(self, name):
+        ''' Total dwell time (s) in an AOI since the last reset
+        '''
+
+        k = self.aoi_map._index[name]
+        if k >= len(self._samples):
+            return 0.0
+        return float(self._samples[k]) * self.sample_interval
+
+    #%%
+    def entries(self, name):
+        ''' Number of times gaze entered an AOI since the last reset
+        '''
+
+        k = self.aoi_map._index[name]
+        if k >= len(self._entries):
+            return 0
+        return int(self._entries[k])
+
+    #%%
+    def first_entry_latency(self, name):
+        ''' Time (s) from the start of the trial to the first entry into an
+        AOI, or None if gaze has not entered the AOI
+        '''
+
+        k = self.aoi_map._index[name]
+        if k >= len(self._first_entry) or self._first_entry[k] < 0:
+            return None
+        return float(self._first_entry[k] - self._t_start) / 1e6
+
+    #%%
+    def summary(self):
+        ''' Returns dwell time (s), entries and first entry latency (s)
+        per AOI, as a dict of dicts
+        '''
+
+        return {name: {'dwell_time': self.dwell_time(name),
+                       'entries': self.entries(name),
+                       'first_entry_latency': self.first_entry_latency(name)}
+                for name in self.aoi_map.names}
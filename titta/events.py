@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Online detection of fixations, saccades and blinks in live gaze data.
+
+Samples are classified with a velocity threshold (I-VT), where the threshold
+adapts to the noise in the data: it is kept at a number of standard deviations
+above the mean velocity during fixations (as in Nyström & Holmqvist, 2010,
+but estimated with exponentially weighted averages, so each sample costs the
+same, regardless of how long the recording is).
+
+New samples are added in batches (e.g., from tracker.read_new('gaze')), and
+the events that could be detected with the samples seen so far are returned.
+Each event has the time stamp of its onset, and the time stamp of the sample
+at which it was detected, so the detection latency can be measured, e.g.,
+by running the detector over recorded data (see
+demo_analyses/detect_events_online.py).
+"""
+
+import numpy as np
+from collections import namedtuple
+
+# type - 'fixation_start', 'fixation_end', 'saccade_start', 'saccade_end',
+#        'blink_start', or 'blink_end'
+# time_stamp - system time stamp (us) of the onset/offset of the event
+# detection_time_stamp - system time stamp (us) of the sample at which
+#                        the event was detected
+# x, y - position (Tobii's coordinate system) of the fixation, the
+#        saccade onset/offset, or the last sample before the blink
+# duration - duration of the fixation/saccade/blink (us), for the
+#            '_end' events (else None)
+Event = namedtuple('Event', 'type, time_stamp, detection_time_stamp, x, y, duration')
+
+UNKNOWN = 'unknown'
+FIXATION = 'fixation'
+SACCADE = 'saccade'
+BLINK = 'blink'
+
+#%%
+class EventDetector(object):
+    """
+    Incremental velocity-threshold classifier with adaptive noise estimate
+    """
+    def __init__(self, geometry, initial_threshold=100.0, min_threshold=30.0,
+                 max_threshold=300.0, noise_factor=6.0, noise_window=1.0,
+                 min_saccade_samples=2, min_fixation_duration=0.06,
+                 min_blink_duration=0.075):
+        '''
+        Args:
+            geometry - helpers_tobii.MonitorGeometry, used to convert
+                       gaze positions to degrees
+            initial_threshold - velocity threshold (deg/s) until the noise
+                                has been estimated (over noise_window s
+                                of fixation data)
+            min_threshold, max_threshold - limits of the adaptive threshold
+                                           (deg/s)
+            noise_factor - threshold = mean + noise_factor * sd of the
+                           velocity during fixations
+            noise_window - time constant (s) of the noise estimate
+            min_saccade_samples - number of consecutive samples above the
+                                  threshold needed to detect a saccade
+            min_fixation_duration - duration (s) of a period below the
+                                    threshold needed to detect a fixation
+            min_blink_duration - duration (s) of a period of data loss
+                                 needed to detect a blink (shorter periods
+                                 are ignored)
+        '''
+
+        self.geometry = geometry
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.noise_factor = noise_factor
+        self.noise_window = noise_window
+        self.min_saccade_samples = min_saccade_samples
+        self.min_fixation_duration = int(min_fixation_duration * 1e6)
+        self.min_blink_duration = int(min_blink_duration * 1e6)
+
+        self.threshold = float(initial_threshold)
+        self._noise_mean = None
+        self._noise_var = 0.0
+        self._noise_time = 0.0
+
+        self.state = UNKNOWN
+
+        # Last sample of the previous batch (velocity of the first sample)
+        self._prev_ts = None
+        self._prev_pos = np.full(2, np.nan)
+
+        # Last sample with valid data
+        self._last_valid = (None, np.nan, np.nan)
+
+        # Start of the current period of data loss
+        self._loss_start = None
+
+        # Samples above the threshold (saccade candidate)
+        self._n_fast = 0
+        self._fast_start = None
+
+        # Samples below the threshold (fixation candidate)
+        self._fix_start = None
+        self._fix_end = None
+        self._fix_sum = [0.0, 0.0, 0]
+
+        self._sac_start = None
+
+    #%%
+    def add_gaze(self, data):
+        ''' Adds samples from the gaze stream, e.g., from
+        tracker.read_new('gaze') or tracker.buffer.peek_N('gaze', N).
+        The position is the average of the valid eyes
+
+        Args:
+            data - dict with gaze data (TittaPy format)
+
+        Returns:
+            list with the Events detected
+        '''
+
+        xy = np.empty((2, 2, len(data['system_time_stamp'])))
+        for i, eye in enumerate(['left', 'right']):
+            valid = np.asarray(data[eye + '_gaze_point_valid'], dtype=bool)
+            xy[i, 0] = np.where(valid, data[eye + '_gaze_point_on_display_area_x'], np.nan)
+            xy[i, 1] = np.where(valid, data[eye + '_gaze_point_on_display_area_y'], np.nan)
+
+        # Average of the eyes, or the position of the only valid eye
+        n = np.sum(~np.isnan(xy), axis=0)
+        avg = np.nansum(xy, axis=0) / np.maximum(n, 1)
+        avg[n == 0] = np.nan
+
+        return self.add_samples(data['system_time_stamp'], avg[0], avg[1])
+
+    #%%
+    def add_samples(self, ts, x, y):
+        ''' Adds samples
+
+        Args:
+            ts - system time stamps (us)
+            x, y - gaze position in Tobii's coordinate system (nan if
+                   the sample is invalid)
+
+        Returns:
+            list with the Events detected
+        '''
+
+        ts = np.asarray(ts, dtype=np.int64)
+        if len(ts) == 0:
+            return []
+        pos = np.column_stack((x, y)).astype(float)
+
+        # Velocity (deg/s) of all samples in one pass, including the
+        # step from the last sample of the previous batch
+        deg = self.geometry.tobii2deg(np.vstack((self._prev_pos, pos)))
+        t = np.concatenate(([ts[0] if self._prev_ts is None else self._prev_ts], ts))
+        dt = np.diff(t) / 1e6
+        dt[dt <= 0] = np.nan
+        v = np.hypot(*np.diff(deg, axis=0).T) / dt
+
+        self._prev_ts = int(ts[-1])
+        self._prev_pos = pos[-1].copy()
+
+        events = []
+        for ts_i, (x_i, y_i), v_i, dt_i in zip(ts.tolist(), pos.tolist(),
+                                               v.tolist(), dt.tolist()):
+            self._step(ts_i, x_i, y_i, v_i, dt_i, events)
+
+        return events
+
+    #%%
+    def _step(self, ts, x, y, v, dt, events):
+        ''' Classifies one sample
+        '''
+
+        # Data loss
+        if x != x or y != y:
+            if self._loss_start is None:
+                self._loss_start = ts
+            if self.state != BLINK and ts - self._loss_start >= self.min_blink_duration:
+                self._end_event(events, ts)
+                t_last, x_last, y_last = self._last_valid
+                events.append(Event('blink_start', self._loss_start, ts, x_last, y_last, None))
+                self.state = BLINK
+            return
+
+        if self.state == BLINK:
+            events.append(Event('blink_end', ts, ts, x, y, ts - self._loss_start))
+            self.state = UNKNOWN
+        self._loss_start = None
+        self._last_valid = (ts, x, y)
+
+        # First sample, or first sample after data loss
+        if v != v:
+            if self.state != SACCADE:
+                self._add_to_fixation(ts, x, y, events)
+            return
+
+        if v > self.threshold:
+            self._n_fast += 1
+            if self._n_fast == 1:
+                self._fast_start = (ts, x, y)
+            if self.state != SACCADE and self._n_fast >= self.min_saccade_samples:
+                self._end_event(events, ts)
+                self._sac_start = self._fast_start[0]
+                events.append(Event('saccade_start', self._fast_start[0], ts,
+                                    self._fast_start[1], self._fast_start[2], None))
+                self.state = SACCADE
+        else:
+            self._n_fast = 0
+            if self.state == SACCADE:
+                events.append(Event('saccade_end', ts, ts, x, y, ts - self._sac_start))
+                self.state = UNKNOWN
+            self._update_noise(v, dt)
+            self._add_to_fixation(ts, x, y, events)
+
+    #%%
+    def _add_to_fixation(self, ts, x, y, events):
+        ''' Adds a sample below the threshold to the (candidate) fixation
+        '''
+
+        if self._fix_start is None:
+            self._fix_start = ts
+            self._fix_sum = [0.0, 0.0, 0]
+        self._fix_end = ts
+        self._fix_sum[0] += x
+        self._fix_sum[1] += y
+        self._fix_sum[2] += 1
+
+        if self.state != FIXATION and ts - self._fix_start >= self.min_fixation_duration:
+            events.append(Event('fixation_start', self._fix_start, ts,
+                                self._fix_sum[0] / self._fix_sum[2],
+                                self._fix_sum[1] / self._fix_sum[2], None))
+            self.state = FIXATION
+
+    #%%
+    def _end_event(self, events, ts):
+        ''' Ends the current fixation (if any) and resets the fixation
+        candidate
+        '''
+
+        if self.state == FIXATION:
+            events.append(Event('fixation_end', self._fix_end, ts,
+                                self._fix_sum[0] / self._fix_sum[2],
+                                self._fix_sum[1] / self._fix_sum[2],
+                                self._fix_end - self._fix_start))
+        elif self.state == SACCADE:
+            t_last, x_last, y_last = self._last_valid
+            events.append(Event('saccade_end', t_last, ts, x_last, y_last,
+                                t_last - self._sac_start))
+        self.state = UNKNOWN
+        self._fix_start = None
+
+    #%%
+    def _update_noise(self, v, dt):
+        ''' Updates the estimate of the velocity noise during fixations
+        and the adaptive threshold
+        '''
+
+        if self._noise_mean is None:
+            self._noise_mean = v
+            return
+        self._noise_time += dt
+
+        # Weight of the sample (based on the sampling interval). Samples are
+        # weighted equally until noise_window s of data have been seen
+        alpha = min(1.0, dt / min(self._noise_time, self.noise_window))
+
+        d = v - self._noise_mean
+        self._noise_mean += alpha * d
+        self._noise_var = (1 - alpha) * (self._noise_var + alpha * d * d)
+
+        if self._noise_time < self.noise_window:
+            return
+
+        self.threshold = min(max(self._noise_mean + self.noise_factor * np.sqrt(self._noise_var),
+                                 self.min_threshold), self.max_threshold)
+
+    #%%
+    def reset(self):
+        ''' Forgets the current state (e.g., between trials), but keeps
+        the noise estimate
+        '''
+
+        self.state = UNKNOWN
+        self._prev_ts = None
+        self._prev_pos = np.full(2, np.nan)
+        self._last_valid = (None, np.nan, np.nan)
+        self._loss_start = None
+        self._n_fast = 0
+        self._fix_start = None
+        self._sac_start = None
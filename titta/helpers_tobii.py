@@ -4,21 +4,156 @@ Created on Tue Jun 06 16:20:36 2017
 
 @author: marcus
 """
-from psychopy import visual
 import numpy as np
-import copy
 import warnings
 import abc
+import weakref
 
+# test if PsychoPy available (needed for the stimuli, but not to convert
+# between coordinate systems, e.g., in offline analyses)
 HAS_PSYCHOPY = False
 try:
-    from psychopy.tools.monitorunittools import cm2deg, deg2pix
+    from psychopy import visual
 except:
     pass
 else:
     HAS_PSYCHOPY = True
 
 
+#%%
+class CoordinateTransform(object):
+    """
+    Affine transform from Tobii's coordinate system [0, 1] (origin in the
+    upper left corner) to the units of a PsychoPy window (origin in the
+    center, y up), i.e., pos_win = pos_tobii * scale + offset.
+
+    Scale and offset are computed once, so each conversion is one multiply
+    and one add over the whole N x 2 array, and the input is never copied
+    or changed. Use for_window to get a (cached) transform for a window.
+    """
+    def __init__(self, scale, offset):
+        '''
+        Args:
+            scale - (sx, sy)
+            offset - (ox, oy)
+        '''
+
+        self.scale = np.array(scale, dtype=float)
+        self.offset = np.array(offset, dtype=float)
+
+        # pos_tobii = pos_win * inv_scale + inv_offset
+        self.inv_scale = 1.0 / self.scale
+        self.inv_offset = -self.offset / self.scale
+
+    #%%
+    @classmethod
+    def norm(cls):
+        ''' Transform to PsychoPy's 'norm' units (-1, 1)
+        '''
+        return cls((2.0, -2.0), (-1.0, 1.0))
+
+    #%%
+    @classmethod
+    def pix(cls, size):
+        ''' Transform to PsychoPy's 'pix' units
+
+        Args:
+            size - (width, height) of the window in pixels
+        '''
+        w, h = float(size[0]), float(size[1])
+        return cls((w, -h), (-w / 2.0, h / 2.0))
+
+    #%%
+    @classmethod
+    def height(cls, size):
+        ''' Transform to PsychoPy's 'height' units (the height of the
+        window is 1)
+
+        Args:
+            size - (width, height) of the window in pixels
+        '''
+        aspect = float(size[0]) / float(size[1])
+        return cls((aspect, -1.0), (-aspect / 2.0, 0.5))
+
+    #%%
+    @classmethod
+    def for_window(cls, win, units=None):
+        ''' Returns the transform to the units of a window. Transforms are
+        cached per window, and rebuilt if the size of the window changes.
+
+        Args:
+            win - PsychoPy window
+            units - (optional) 'norm', 'pix', or 'height'. Default: units of the window
+        '''
+
+        if units is None:
+            units = win.units
+        size = tuple(win.size)
+
+        try:
+            cache = _transform_cache.get(win)
+            if cache is None:
+                cache = _transform_cache[win] = {}
+        except TypeError:
+            cache = {}
+
+        cached = cache.get(units)
+        if cached is not None and cached[0] == size:
+            return cached[1]
+
+        if units == 'norm':
+            transform = cls.norm()
+        elif units == 'pix':
+            transform = cls.pix(size)
+        elif units == 'height':
+            transform = cls.height(size)
+        else:
+            raise ValueError('Unsupported units: ' + str(units))
+
+        cache[units] = (size, transform)
+        return transform
+
+    #%%
+    def apply(self, pos, out=None):
+        ''' Converts from Tobii's coordinate system to window units
+
+        Args:
+            pos - N x 2 array (or (x, y))
+            out - (optional) preallocated array (same shape as pos) for the result
+
+        Returns:
+            out
+        '''
+        pos = np.asarray(pos, dtype=float)
+        if out is None:
+            out = np.empty(pos.shape)
+        np.multiply(pos, self.scale, out=out)
+        np.add(out, self.offset, out=out)
+        return out
+
+    #%%
+    def inverse(self, pos, out=None):
+        ''' Converts from window units to Tobii's coordinate system
+
+        Args:
+            pos - N x 2 array (or (x, y))
+            out - (optional) preallocated array (same shape as pos) for the result
+
+        Returns:
+            out
+        '''
+        pos = np.asarray(pos, dtype=float)
+        if out is None:
+            out = np.empty(pos.shape)
+        np.multiply(pos, self.inv_scale, out=out)
+        np.add(out, self.inv_offset, out=out)
+        return out
+
+# Transforms per window (see CoordinateTransform.for_window)
+_transform_cache = weakref.WeakKeyDictionary()
+
+_NORM = CoordinateTransform.norm()
+
 #%%
 def tobii2norm(pos):
     ''' Converts from Tobiis coordinate system [0, 1] to PsychoPy's 'norm' (-1, 1).
@@ -28,13 +163,7 @@ def tobii2norm(pos):
     Args:   pos: N x 2 array with positions
     '''
 
-    pos_temp = copy.deepcopy(pos) # To avoid that the called parameter is changed
-
-    # Convert between coordinate system
-    pos_temp[:, 0] = 2.0 * (pos_temp[:, 0] - 0.5)
-    pos_temp[:, 1] = 2.0 * (pos_temp[:, 1] - 0.5) * -1
-
-    return pos_temp
+    return _NORM.apply(pos)
 
 def norm2tobii(pos):
     ''' Converts from PsychoPy's 'norm' (-1, 1) to Tobiis coordinate system [0, 1].
@@ -43,88 +172,140 @@ def norm2tobii(pos):
     y = -1 in PsychoPy coordinates means bottom of screen
     Args:   pos: N x 2 array with positions
     '''
-    pos_temp = copy.deepcopy(pos) # To avoid that the called parameter is changed
 
-    # Convert between coordinate system
-    pos_temp[:, 0] = pos_temp[:, 0] / 2.0 + 0.5
-    pos_temp[:, 1] = pos_temp[:, 1]/ -2.0 + 0.5
+    return _NORM.inverse(pos)
+
+#%%
+class MonitorGeometry(object):
+    """
+    Width (cm), resolution (pixels) and viewing distance (cm) of a monitor,
+    from which the conversions between Tobii's coordinate system [0, 1],
+    cm and degrees (from the center of the screen, y up) are precomputed.
+    Pixels are assumed to be square.
+
+    Conversions are vectorized over N x 2 arrays and do not need PsychoPy,
+    so they can be used to convert recorded gaze data offline.
+
+    Two models of the visual angle are available:
+        exact=False - flat screen approximation (as PsychoPy's 'deg' units,
+                      correctFlat=False): a constant number of cm per degree
+        exact=True - the angle of each position, atan(cm / distance), per axis
+                     (as PsychoPy's 'degFlat' units, correctFlat=True)
+    """
+    def __init__(self, width_cm, size_pix, distance_cm):
+        '''
+        Args:
+            width_cm - width of the screen (cm)
+            size_pix - (width, height) of the screen (pixels)
+            distance_cm - viewing distance (cm)
+        '''
+
+        self.width_cm = float(width_cm)
+        self.size_pix = (int(size_pix[0]), int(size_pix[1]))
+        self.distance_cm = float(distance_cm)
+
+        self.height_cm = self.width_cm * self.size_pix[1] / self.size_pix[0]
 
+        # Same approximation as PsychoPy (cm per degree at the center of the screen)
+        self.cm_per_deg = self.distance_cm * 0.017455
 
-    return pos_temp
+        w, h = self.width_cm, self.height_cm
+        self._tobii2cm = CoordinateTransform((w, -h), (-w / 2.0, h / 2.0))
+        c = self.cm_per_deg
+        self._tobii2deg = CoordinateTransform((w / c, -h / c), (-w / 2.0 / c, h / 2.0 / c))
 
+    #%%
+    @classmethod
+    def from_monitor(cls, mon):
+        ''' Creates the geometry from a PsychoPy monitor
+        '''
+        return cls(mon.getWidth(), mon.getSizePix(), mon.getDistance())
+
+    #%%
+    def tobii2cm(self, pos, out=None):
+        ''' Converts from Tobii's coordinate system to cm
+        Args:   pos: N x 2 array with positions in [0, 1]
+                out: (optional) preallocated N x 2 array for the result
+        '''
+        return self._tobii2cm.apply(pos, out)
+
+    #%%
+    def cm2tobii(self, pos, out=None):
+        ''' Converts from cm to Tobii's coordinate system
+        Args:   pos: N x 2 array with positions in cm
+                out: (optional) preallocated N x 2 array for the result
+        '''
+        return self._tobii2cm.inverse(pos, out)
+
+    #%%
+    def tobii2deg(self, pos, exact=False, out=None):
+        ''' Converts from Tobii's coordinate system to degrees
+        Args:   pos: N x 2 array with positions in [0, 1]
+                exact: use the exact angle of each position (see above)
+                out: (optional) preallocated N x 2 array for the result
+        '''
+        if not exact:
+            return self._tobii2deg.apply(pos, out)
+
+        out = self._tobii2cm.apply(pos, out)
+        np.divide(out, self.distance_cm, out=out)
+        np.arctan(out, out=out)
+        return np.degrees(out, out=out)
+
+    #%%
+    def deg2tobii(self, pos, exact=False, out=None):
+        ''' Converts from degrees to Tobii's coordinate system
+        Args:   pos: N x 2 array with positions in degrees
+                exact: use the exact angle of each position (see above)
+                out: (optional) preallocated N x 2 array for the result
+        '''
+        if not exact:
+            return self._tobii2deg.inverse(pos, out)
+
+        cm = np.tan(np.radians(pos)) * self.distance_cm
+        return self._tobii2cm.inverse(cm, out)
+
+#%%
 def tobii2deg(pos, mon):
     ''' Converts Tobiis coordinate system [0, 1 to degrees.
     Note that the Tobii coordinate system start in the upper left corner
     and the PsychoPy coordinate system in the center
     Assumes pixels are square
     Args:   pos: N x 2 array with calibratio position in [0, 1]
-            screen_height: height of screen in cm
+            mon: PsychoPy monitor
+    To convert many positions, create a MonitorGeometry once and use its
+    tobii2deg method instead
     '''
 
-    pos_temp = copy.deepcopy(pos) # To avoid that the called parameter is changed
-
-    # Center
-    pos_temp[:, 0] = pos_temp[:, 0] - 0.5
-    pos_temp[:, 1] = (pos_temp[:, 1] - 0.5) * -1
-
-    # Cenvert to psychopy coordinates (center)
-    pos_temp[:, 0] = pos_temp[:, 0] * mon.getWidth()
-    pos_temp[:, 1] = pos_temp[:, 1] * mon.getWidth() * (float(mon.getSizePix()[1]) / \
-                                              float(mon.getSizePix()[0]))
-
-    # Convert to deg.
-    pos_deg = cm2deg(pos_temp, mon, correctFlat=False)
-    return pos_deg
+    return MonitorGeometry.from_monitor(mon).tobii2deg(pos)
 
 def deg2tobii(pos, mon):
     ''' Converts from degrees to Tobiis coordinate system [0, 1].
     Note that the Tobii coordinate system start in the upper left corner
     and the PsychoPy coordinate system in the center
+    Args:   pos: N x 2 array with positions in degrees
+            mon: PsychoPy monitor
     '''
 
-    # First convert from deg to pixels
-    pos[:, 0] = deg2pix(pos[:, 0], mon, correctFlat=False)
-    pos[:, 1] = deg2pix(pos[:, 1], mon, correctFlat=False)
-
-    # Then normalize data -1,1
-    pos[:, 0] = pos[:, 0] / float(mon.getSizePix()[0])/2
-    pos[:, 1] = pos[:, 1] / float(mon.getSizePix()[1])/2
-
-    #.. finally shift to tobii coordinate system
-    return norm2tobii(pos)
+    return MonitorGeometry.from_monitor(mon).deg2tobii(pos)
 
 def tobii2pix(pos, win):
     ''' Converts from  Tobiis coordinate system [0, 1] to pixles.
     Note that the Tobii coordinate system start in the upper left corner
     and screen coordinate in the upper left corner
     Args:   pos: N x 2 array with calibratio position in [0, 1]
-            screen_height: height of screen in cm
+            win: PsychoPy window
     '''
 
-    pos_temp = copy.deepcopy(pos)     # Center
-
-    # Center
-    pos_temp[:, 0] = pos_temp[:, 0] - 0.5
-    pos_temp[:, 1] = (pos_temp[:, 1] - 0.5) * -1
-
-	# Convert to pixels
-    pos_temp[:, 0] = pos_temp[:, 0] * win.size[0]
-    pos_temp[:, 1] = pos_temp[:, 1] * win.size[1]
-
-    # Convert to deg.
-    return pos_temp
+    return CoordinateTransform.for_window(win, 'pix').apply(pos)
 
 def pix2tobii(pos, mon):
     ''' Converts from PsychoPy pixels to Tobiis coordinate system [0, 1].
     Note that the Tobii coordinate system start in the upper left corner
     and the PsychoPy coordinate system in the center
     '''
-    # Normalize data -1,1
-    pos[:, 0] = pos[:, 0] / (float(mon.getSizePix()[0]) / 2.0)
-    pos[:, 1] = pos[:, 1] / (float(mon.getSizePix()[1]) / 2.0)
 
-    #.. finally shift to tobii coordinate system
-    return norm2tobii(pos)
+    return CoordinateTransform.pix(mon.getSizePix()).inverse(pos)
 
 # %%
 class TargetBase(metaclass=abc.ABCMeta):
@@ -661,6 +842,82 @@ def angle_between(v1, v2):
     v2_u = unit_vector(v2)
     return np.arccos(np.clip(np.dot(v1_u, v2_u), -1.0, 1.0))
 
+#%%
+def angles_between(v1, v2):
+    """ Returns the angles in radians between the rows of 'v1' and 'v2'
+    (N x 3 arrays). Rows containing nan give nan
+
+            >>> angles_between(np.array([[1, 0, 0], [1, 0, 0]]),
+            ...                np.array([[0, 1, 0], [-1, 0, 0]]))
+            array([1.57079633, 3.14159265])
+    """
+    v1 = np.asarray(v1, dtype=float)
+    v2 = np.asarray(v2, dtype=float)
+    cos = np.sum(v1 * v2, axis=-1) / (np.linalg.norm(v1, axis=-1) *
+                                      np.linalg.norm(v2, axis=-1))
+    return np.arccos(np.clip(cos, -1.0, 1.0))
+
+#%%
+def sample_to_sample_angles(gaze_vector):
+    """ Returns the angles in radians between consecutive gaze vectors
+    ((..., N, 3) array), as used for the RMS-S2S and SD of the validation
+    (validation_quality) and of the live QualityMonitor. The RMS-S2S is
+    rms() of these angles
+    """
+    gaze_vector = np.asarray(gaze_vector, dtype=float)
+    return angles_between(gaze_vector[..., 1:, :], gaze_vector[..., :-1, :])
+
+#%%
+def validation_quality(gaze_origin, gaze_point, target, n_samples):
+    """ Computes data quality (deviation, rms, sd, data loss) per validation
+    point, from the samples of all points at once. The samples of the
+    points follow each other, the first n_samples[0] samples are from the
+    first point, etc. Leading dimensions (e.g., one per eye) are kept.
+
+    Args:
+        gaze_origin - (..., N, 3) array with gaze origins in UCS (mm)
+        gaze_point - (..., N, 3) array with gaze points in UCS (mm)
+        target - (P, 3) array with the position of each point in UCS (mm)
+        n_samples - number of samples per point (length P)
+
+    Returns:
+        deviation - median angle (deg) between the gaze vector and the
+                    vector from the eye to the point
+        rms - RMS of the differences between consecutive sample-to-sample
+              angles (deg), see rms()
+        sd - SD of the sample-to-sample angles (deg)
+        data_loss - proportion of samples without a valid gaze vector
+        Each is a (..., P) array
+    """
+    gaze_origin = np.asarray(gaze_origin, dtype=float)
+    gaze_vector = np.asarray(gaze_point, dtype=float) - gaze_origin
+    target_vector = np.repeat(np.asarray(target, dtype=float), n_samples, axis=0) - gaze_origin
+
+    deviation = angles_between(gaze_vector, target_vector)
+
+    # Angle between each sample and the previous one. The first sample of
+    # each point has no previous sample (nan, and removed below)
+    s2s = np.full(deviation.shape, np.nan)
+    s2s[..., 1:] = sample_to_sample_angles(gaze_vector)
+
+    lost = np.any(np.isnan(gaze_vector), axis=-1)
+
+    shape = deviation.shape[:-1] + (len(n_samples),)
+    out = [np.full(shape, np.nan) for _ in range(4)]
+    bounds = np.cumsum(n_samples)[:-1]
+    for p, (dev, ang, los) in enumerate(zip(np.split(deviation, bounds, axis=-1),
+                                            np.split(s2s, bounds, axis=-1),
+                                            np.split(lost, bounds, axis=-1))):
+        ang = ang[..., 1:]
+        out[0][..., p] = np.nanmedian(dev, axis=-1)
+        out[1][..., p] = np.sqrt(np.nanmean(np.square(np.diff(ang, axis=-1)), axis=-1))
+        out[2][..., p] = np.nanstd(ang, axis=-1)
+        out[3][..., p] = np.mean(los, axis=-1)
+
+    deviation, rms, sd, data_loss = out
+
+    return np.rad2deg(deviation), np.rad2deg(rms), np.rad2deg(sd), data_loss
+
 #%%
 def rms(x):
     rms = np.sqrt(np.nanmean(np.square(np.diff(x))))
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe journal of messages and samples.
+
+While recording, messages (from send_message) and samples (copied
+periodically from the eye tracker buffer) are appended to a compact binary
+file, that is fsynced at a regular interval. If the experiment crashes
+before save_data is called, recover_session rebuilds a Titta HDF5
+container from the journal.
+
+A journal is a header (MAGIC) followed by records, each with a one byte
+type, the length of the payload (uint32), and the payload:
+    REC_MSG  - system time stamp (int64) and the message (utf-8)
+    REC_DATA - length of the stream name (uint8), the stream name (ascii),
+               and the samples as a structured numpy array (.npy format)
+    REC_ENUM - lookup tables of the enum columns of a stream (json), written
+               before the first samples of the stream
+A record that was not completely written when the program crashed is ignored.
+"""
+
+import io
+import os
+import json
+import struct
+import numpy as np
+import pandas as pd
+from threading import Thread, Event, Lock
+from titta import storage
+
+MAGIC = b'TITTAJ01'
+
+REC_MSG = 1
+REC_DATA = 2
+REC_ENUM = 3
+
+_RECORD = struct.Struct('<BI')
+_MSG = struct.Struct('<BIq')
+
+# Streams that are copied to the journal (eye images are too large)
+STREAMS = ['gaze', 'time_sync', 'external_signal']
+
+#%%
+class Journal(Thread):
+    """
+    Background thread that copies new samples from the eye tracker buffer to
+    the journal and fsyncs the journal at a regular interval.
+
+    Samples are peeked (not consumed), so the buffer is left untouched for
+    save_data and gaze contingent code.
+    """
+    def __init__(self, buffer, fname, interval=0.5):
+        '''
+        Args:
+            buffer - TittaPy EyeTracker instance
+            fname - name of the journal file (without extension). The file
+                    must not exist, such that the journal of an earlier
+                    (crashed) session is never appended to or deleted
+            interval - how often (in s) samples are copied to the journal
+                       and the journal is flushed to disk
+        '''
+        Thread.__init__(self, daemon=True)
+
+        self.buffer = buffer
+        self.fname = fname + '.journal'
+        self.interval = interval
+
+        self.streams = [s for s in STREAMS if self.buffer.has_stream(s)]
+
+        # Time stamp of the last sample written to the journal, per stream
+        self._watermark = {s: -1 for s in self.streams}
+
+        # Enum lookup tables written to the journal, per stream
+        self._lookups = {}
+
+        self._lock = Lock()
+        self._stop_event = Event()
+
+        # Error raised while writing the journal (re-raised by stop())
+        self.error = None
+
+        # Raises FileExistsError if a journal with this name exists
+        self._f = open(self.fname, 'xb')
+        self._f.write(MAGIC)
+        self._f.flush()
+
+    #%%
+    def write_message(self, ts, msg):
+        ''' Appends a message to the journal. The message is written to disk
+        the next time the journal is flushed (within 'interval' s)
+
+        Args:
+            ts - system time stamp of the message
+            msg - the message
+        '''
+
+        if self.error is not None:
+            return
+
+        b = str(msg).encode('utf-8')
+        with self._lock:
+            self._f.write(_MSG.pack(REC_MSG, len(b) + 8, ts) + b)
+
+    #%%
+    def _write_data(self, stream, data):
+        ''' Appends samples from one stream to the journal
+        '''
+
+        n = len(data[storage.time_column(stream)])
+        if n == 0:
+            return
+
+        lookup = {}
+        data = storage.prepare_stream_data(stream, data, lookup)
+        arr = np.rec.fromarrays([np.asarray(v) for v in data.values()],
+                                names=list(data.keys()))
+        payload = io.BytesIO()
+        np.save(payload, arr, allow_pickle=False)
+
+        name = stream.encode('ascii')
+        payload = bytes([len(name)]) + name + payload.getvalue()
+        with self._lock:
+            if len(lookup) > 0 and self._lookups.get(stream) != lookup:
+                enum_payload = json.dumps({'stream': stream, 'lookup': lookup}).encode('utf-8')
+                self._f.write(_RECORD.pack(REC_ENUM, len(enum_payload)) + enum_payload)
+                self._lookups[stream] = lookup
+            self._f.write(_RECORD.pack(REC_DATA, len(payload)) + payload)
+
+        self._watermark[stream] = int(data[storage.time_column(stream)][-1])
+
+    #%%
+    def _drain(self):
+        ''' Copies samples added to the buffer since the last call to the
+        journal and flushes the journal to disk
+        '''
+
+        for stream in self.streams:
+            self._write_data(stream, self.buffer.peek_time_range(stream,
+                                                                 self._watermark[stream] + 1))
+
+        # Messages only wait for the flush (to the OS), not for the disk
+        with self._lock:
+            self._f.flush()
+        os.fsync(self._f.fileno())
+
+    #%%
+    def run(self):
+        try:
+            while not self._stop_event.wait(self.interval):
+                self._drain()
+        except Exception as e:
+            # Raised by stop(); messages are no longer written
+            self.error = e
+
+    #%%
+    def stop(self):
+        ''' Copies the remaining samples to the journal and closes it
+
+        Raises:
+            RuntimeError - if writing the journal failed
+        '''
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+        try:
+            if self.error is None:
+                self._drain()
+        except Exception as e:
+            self.error = e
+        finally:
+            self._f.close()
+
+        if self.error is not None:
+            raise RuntimeError('Writing the journal ' + self.fname + ' failed') from self.error
+
+    #%%
+    def remove(self):
+        ''' Deletes the journal (after the data were saved)
+        '''
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+#%%
+def read_journal(fname):
+    ''' Reads the messages and samples in a journal
+
+    Args:
+        fname - name of the journal file (including extension)
+
+    Returns:
+        msg - list with [system_time_stamp, msg]
+        streams - dict with a list of chunks (dicts with one entry per column)
+                  per stream
+        lookups - dict with the lookup tables of the enum columns
+                  ({stream: {column: {name: code}}})
+    '''
+
+    msg = []
+    streams = {}
+    lookups = {}
+    with open(fname, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(fname + ' is not a Titta journal')
+
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+            rec_type, length = _RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                # Last record was not completely written
+                break
+
+            if rec_type == REC_MSG:
+                ts, = struct.unpack_from('<q', payload)
+                msg.append([ts, payload[8:].decode('utf-8')])
+            elif rec_type == REC_DATA:
+                stream = payload[1:1 + payload[0]].decode('ascii')
+                arr = np.load(io.BytesIO(payload[1 + payload[0]:]), allow_pickle=False)
+                streams.setdefault(stream, []).append({c: arr[c] for c in arr.dtype.names})
+            elif rec_type == REC_ENUM:
+                temp = json.loads(payload.decode('utf-8'))
+                lookups[temp['stream']] = temp['lookup']
+
+    return msg, streams, lookups
+
+#%%
+def recover_session(fname, fname_out=None):
+    ''' Rebuilds a HDF5 container from a journal, e.g., after a crash
+
+    Args:
+        fname - name of the journal file (including extension)
+        fname_out - (optional) name of the HDF5 file (without extension).
+                    Default: name of the journal with '_recovered' appended
+
+    Returns:
+        name of the HDF5 file (including extension)
+    '''
+
+    if fname_out is None:
+        fname_out = os.path.splitext(fname)[0] + '_recovered'
+    fname_out = fname_out + '.h5'
+
+    msg, streams, lookups = read_journal(fname)
+
+    for stream, chunks in streams.items():
+        if stream in ('gaze', 'time_sync'):
+            storage.write_stream_pandas(fname_out, stream, chunks)
+        else:
+            # Enums were already converted to integer codes in the journal
+            pd.DataFrame.from_dict(storage._concat_chunks(chunks)).to_hdf(fname_out, key=stream)
+
+    pd.DataFrame(msg, columns=['system_time_stamp', 'msg']).to_hdf(fname_out, key='msg')
+
+    if len(lookups) > 0:
+        storage.enum_lookup_table(lookups).to_hdf(fname_out, key='enum_lookup')
+
+    return fname_out
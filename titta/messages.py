@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+Timestamped messages (sent with send_message).
+
+Time stamps are stored in a growable int64 array and each unique message
+string is stored once (messages are stored as integer codes), in the order
+the messages were sent. Queries by time use binary search (on the messages
+ordered by time stamp), queries by prefix use a sorted index of the unique
+messages, and the first time stamp of each message is kept up to date, so
+they remain fast with tens of thousands of messages.
+"""
+
+import bisect
+import numpy as np
+import pandas as pd
+from threading import Lock
+
+#%%
+class MessageLog(object):
+    """
+    Log of timestamped messages
+    """
+    def __init__(self, capacity=1024):
+        '''
+        Args:
+            capacity - initial number of messages that fit without
+                       the arrays being reallocated
+        '''
+
+        self._ts = np.empty(capacity, dtype=np.int64)
+        self._codes = np.empty(capacity, dtype=np.int32)
+        self._n = 0
+
+        # Unique messages, their codes, and the first time stamp of each
+        self._strings = []
+        self._code_of = {}
+        self._first_ts = []
+
+        # True if the messages were sent in the order of their time stamps
+        self._sorted = True
+
+        # Order of the messages by time stamp (if not sorted), and the
+        # number of messages it was computed for
+        self._order = None
+        self._order_n = 0
+
+        # Sorted unique messages (for prefix search), built when first needed
+        self._prefix_index = None
+
+        # Messages can also be sent from background threads (e.g., monitors)
+        self._lock = Lock()
+
+    #%%
+    @classmethod
+    def from_dataframe(cls, df_msg):
+        ''' Creates a log from a dataframe with columns 'system_time_stamp'
+        and 'msg', e.g., read from a HDF5 container saved by Titta
+        '''
+
+        log = cls(max(len(df_msg), 1))
+        n = len(df_msg)
+
+        codes, strings = pd.factorize(df_msg.msg.astype(str).to_numpy(), use_na_sentinel=False)
+        log._strings = list(strings)
+        log._code_of = {msg: code for code, msg in enumerate(log._strings)}
+        log._ts[:n] = df_msg.system_time_stamp.to_numpy(dtype=np.int64)
+        log._codes[:n] = codes
+        log._n = n
+        log._sorted = bool(np.all(np.diff(log._ts[:n]) >= 0))
+
+        first_ts = np.full(len(strings), np.iinfo(np.int64).max)
+        np.minimum.at(first_ts, codes, log._ts[:n])
+        log._first_ts = first_ts.tolist()
+
+        return log
+
+    #%%
+    def append(self, ts, msg=None):
+        ''' Adds a message. Messages are stored as strings (other objects
+        are converted with str())
+
+        Args:
+            ts - system time stamp of the message, or [ts, msg] (as
+                 appended to msg_container when it was a list)
+            msg - the message
+        '''
+
+        if msg is None and isinstance(ts, (list, tuple)) and len(ts) == 2:
+            ts, msg = ts
+        ts = int(ts)
+        if not isinstance(msg, str):
+            msg = str(msg)
+
+        with self._lock:
+            if self._n == len(self._ts):
+                self._ts = np.resize(self._ts, 2 * len(self._ts))
+                self._codes = np.resize(self._codes, 2 * len(self._codes))
+
+            code = self._code_of.get(msg)
+            if code is None:
+                code = len(self._strings)
+                self._code_of[msg] = code
+                self._strings.append(msg)
+                self._first_ts.append(ts)
+                self._prefix_index = None
+            elif ts < self._first_ts[code]:
+                self._first_ts[code] = ts
+
+            if self._n > 0 and ts < self._ts[self._n - 1]:
+                self._sorted = False
+
+            self._ts[self._n] = ts
+            self._codes[self._n] = code
+            self._n += 1
+
+    #%%
+    def __len__(self):
+        return self._n
+
+    #%%
+    def __iter__(self):
+        ''' Iterates over the messages as [ts, msg], in the order they
+        were sent
+        '''
+        for ts, code in zip(self._ts[:self._n].tolist(), self._codes[:self._n].tolist()):
+            yield [ts, self._strings[code]]
+
+    #%%
+    def __getitem__(self, i):
+        ''' Returns message i as [ts, msg] (or a list of them for a slice),
+        in the order they were sent
+        '''
+        idx = np.arange(self._n)[i]
+        if np.ndim(idx) == 0:
+            return [int(self._ts[idx]), self._strings[self._codes[idx]]]
+        return self._select(idx)
+
+    #%%
+    def _by_time(self):
+        ''' Returns the indices of the messages ordered by time stamp
+        (messages can be sent with a time stamp in the past), or a slice if
+        they were sent in that order
+        '''
+        if self._sorted:
+            return slice(0, self._n)
+
+        with self._lock:
+            if self._order is None or self._order_n != self._n:
+                self._order = np.argsort(self._ts[:self._n], kind='stable')
+                self._order_n = self._n
+            return self._order
+
+    #%%
+    def _select(self, idx):
+        ''' Returns the messages at the given indices as [ts, msg]
+        '''
+        return [[ts, self._strings[code]] for ts, code in
+                zip(self._ts[idx].tolist(), self._codes[idx].tolist())]
+
+    #%%
+    @property
+    def timestamps(self):
+        ''' Time stamps of all messages (ordered by time)
+        '''
+        return self._ts[:self._n][self._by_time()].copy()
+
+    #%%
+    @property
+    def messages(self):
+        ''' All messages (ordered by time)
+        '''
+        return [self._strings[code] for code in self._codes[:self._n][self._by_time()].tolist()]
+
+    #%%
+    def messages_between(self, t0, t1):
+        ''' Returns all messages with time stamps t0 <= ts <= t1
+
+        Args:
+            t0 - first system time stamp
+            t1 - last system time stamp
+
+        Returns:
+            list of [ts, msg]
+        '''
+
+        order = self._by_time()
+        ts = self._ts[:self._n][order]
+        i0 = np.searchsorted(ts, t0, side='left')
+        i1 = np.searchsorted(ts, t1, side='right')
+
+        if isinstance(order, slice):
+            return self._select(slice(i0, i1))
+        return self._select(order[i0:i1])
+
+    #%%
+    def find(self, prefix):
+        ''' Returns all messages that start with prefix, e.g., 'onset_'
+
+        Args:
+            prefix - start of the messages
+
+        Returns:
+            list of [ts, msg] (ordered by time)
+        '''
+
+        if self._prefix_index is None:
+            self._prefix_index = sorted(self._strings)
+
+        # All messages with the prefix are next to each other in the index
+        i = bisect.bisect_left(self._prefix_index, prefix)
+        codes = []
+        while i < len(self._prefix_index) and self._prefix_index[i].startswith(prefix):
+            codes.append(self._code_of[self._prefix_index[i]])
+            i += 1
+
+        return self._select_codes(codes)
+
+    #%%
+    def contains(self, text):
+        ''' Returns all messages that contain text, e.g., 'onset'
+
+        Args:
+            text - part of the messages
+
+        Returns:
+            list of [ts, msg] (ordered by time)
+        '''
+
+        # Each unique message is only searched once
+        codes = [code for code, msg in enumerate(self._strings) if text in msg]
+
+        return self._select_codes(codes)
+
+    #%%
+    def _select_codes(self, codes):
+        ''' Returns all messages with the given codes as [ts, msg]
+        '''
+
+        if len(codes) == 0:
+            return []
+
+        order = self._by_time()
+        idx = np.arange(self._n)[order]
+        idx = idx[np.isin(self._codes[idx], codes)]
+
+        return self._select(idx)
+
+    #%%
+    def first(self, msg):
+        ''' Returns the time stamp of the first (earliest) occurrence of msg,
+        or None if the message was not sent
+        '''
+
+        code = self._code_of.get(msg)
+        if code is None:
+            return None
+
+        return int(self._first_ts[code])
+
+    #%%
+    def to_dataframe(self):
+        ''' Returns the messages as a dataframe with the columns
+        'system_time_stamp' and 'msg' (as stored by save_data), in the order
+        they were sent
+        '''
+
+        return pd.DataFrame({'system_time_stamp': self._ts[:self._n].copy(),
+                             'msg': np.array(self._strings, dtype=object)[self._codes[:self._n]]
+                             if self._n > 0 else np.array([], dtype=object)})
@@ -0,0 +1,509 @@
+# -*- coding: utf-8 -*-
+"""
+Monitoring of the gaze stream while recording.
+
+A Monitor is a background thread that reads the samples added to the eye
+tracker buffer at a regular interval (they are peeked, not consumed) and
+passes each batch to a number of processors, that update their statistics
+in time proportional to the size of the batch and use constant memory.
+
+Processors:
+    QualityMonitor - rolling RMS-S2S, data loss and sample interval jitter
+    LatencyMonitor - histograms of the latency of the newest sample of each
+                     batch and of the intervals between samples
+    DropMonitor - dropped samples, detected from gaps in device_time_stamp
+"""
+
+import json
+import numpy as np
+from collections import deque
+from threading import Thread, Event, Lock
+from titta import helpers_tobii as helpers
+
+EYES = ['left', 'right']
+
+#%%
+class Monitor(Thread):
+    """
+    Background thread that passes new samples from the eye tracker buffer
+    to processors
+    """
+    def __init__(self, buffer, get_time_stamp, interval=0.1, stream='gaze'):
+        '''
+        Args:
+            buffer - TittaPy EyeTracker instance
+            get_time_stamp - function returning the current system time stamp
+            interval - how often (in s) new samples are read
+            stream - stream that is monitored
+        '''
+        Thread.__init__(self, daemon=True)
+
+        self.buffer = buffer
+        self.get_time_stamp = get_time_stamp
+        self.interval = interval
+        self.stream = stream
+
+        self.processors = []
+
+        # Only samples recorded after the monitor was created are processed
+        self._watermark = get_time_stamp()
+
+        self._stop_event = Event()
+
+    #%%
+    def add(self, processor):
+        ''' Adds a processor, which is an object with a method
+        update(data, t_seen) that is called with each batch of new samples
+        and the system time stamp at which the batch was read. The monitor
+        reads the buffer every 'interval' s, so t_seen is the time of the
+        poll, not when each sample arrived in the buffer
+
+        Returns:
+            processor
+        '''
+        self.processors.append(processor)
+        return processor
+
+    #%%
+    def _poll(self):
+        ''' Reads the samples added since the last call and passes them
+        to the processors
+        '''
+
+        data = self.buffer.peek_time_range(self.stream, self._watermark + 1)
+        t_seen = self.get_time_stamp()
+        if len(data['system_time_stamp']) == 0:
+            return
+
+        self._watermark = int(data['system_time_stamp'][-1])
+        for p in self.processors:
+            p.update(data, t_seen)
+
+    #%%
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self._poll()
+
+    #%%
+    def stop(self):
+        ''' Processes the remaining samples and stops the thread
+        '''
+        self._stop_event.set()
+        if self.is_alive():
+            self.join()
+
+        self._poll()
+
+#%%
+class QualityMonitor(object):
+    """
+    Data quality of the most recent gaze samples (a rolling window):
+    RMS-S2S and SD of the angles between consecutive gaze vectors, computed
+    as for the validation (helpers_tobii.validation_quality, so live and
+    validation values can be compared), the proportion of invalid samples,
+    and the mean and standard deviation (jitter) of the intervals between
+    samples.
+
+    Statistics are kept per batch, and batches older than the window are
+    dropped, so memory use does not grow over the recording.
+    """
+    # Sums kept per batch (left, right eye for the first six)
+    _SUM_SQ_DIFF, _N_DIFF, _N_INVALID = 0, 2, 4
+    _SUM_ANGLE, _SUM_SQ_ANGLE, _N_ANGLE = 6, 8, 10
+    _N_SAMPLES, _SUM_ISI, _SUM_SQ_ISI, _N_ISI = 12, 13, 14, 15
+
+    def __init__(self, window=2.0, log_interval=None, send_message=None):
+        '''
+        Args:
+            window - duration (s) over which the quality is computed
+            log_interval - (optional) how often (s) the quality is
+                           logged as a message, e.g., 'data_quality {...}'
+            send_message - function used to log messages. It is called
+                           from the monitor thread (see Monitor), so it
+                           must be thread safe (myTobii passes a function
+                           that queues the messages for its own thread)
+        '''
+
+        self.window = int(window * 1e6)
+        self.log_interval = None if log_interval is None else int(log_interval * 1e6)
+        self.send_message = send_message
+
+        # (time stamp of last sample, sums) per batch
+        self._batches = deque()
+
+        # Last sample (and angle) of the previous batch
+        self._last_ts = None
+        self._last_vector = {eye: np.full(3, np.nan) for eye in EYES}
+        self._last_angle = {eye: np.nan for eye in EYES}
+
+        self._last_log = None
+        self._lock = Lock()
+
+    #%%
+    def update(self, data, t_seen=None):
+        ''' Adds a batch of gaze samples
+
+        Args:
+            data - dict with gaze data (TittaPy format)
+            t_seen - (not used) time the batch was read
+        '''
+
+        ts = np.asarray(data['system_time_stamp'], dtype=np.int64)
+        if len(ts) == 0:
+            return
+
+        sums = np.zeros(16)
+        for i, eye in enumerate(EYES):
+
+            # Gaze vectors (from the eye to the gaze point), including
+            # the last one of the previous batch
+            vectors = np.empty((len(ts) + 1, 3))
+            vectors[0] = self._last_vector[eye]
+            for j, c in enumerate('xyz'):
+                vectors[1:, j] = np.subtract(data[f'{eye}_gaze_point_in_user_coordinates_{c}'],
+                                             data[f'{eye}_gaze_origin_in_user_coordinates_{c}'])
+            self._last_vector[eye] = vectors[-1].copy()
+
+            # Sample-to-sample angles (deg), and their differences (for
+            # the RMS, see helpers_tobii.rms), including the last angle of
+            # the previous batch
+            angles = np.rad2deg(helpers.sample_to_sample_angles(vectors))
+            diffs = np.diff(angles, prepend=self._last_angle[eye])
+            self._last_angle[eye] = angles[-1]
+
+            valid = ~np.isnan(diffs)
+            sums[self._SUM_SQ_DIFF + i] = np.sum(np.square(diffs[valid]))
+            sums[self._N_DIFF + i] = np.count_nonzero(valid)
+            valid = ~np.isnan(angles)
+            sums[self._SUM_ANGLE + i] = np.sum(angles[valid])
+            sums[self._SUM_SQ_ANGLE + i] = np.sum(np.square(angles[valid]))
+            sums[self._N_ANGLE + i] = np.count_nonzero(valid)
+            sums[self._N_INVALID + i] = np.count_nonzero(np.isnan(vectors[1:]).any(axis=1))
+
+        if self._last_ts is None:
+            isi = np.diff(ts)
+        else:
+            isi = np.diff(ts, prepend=self._last_ts)
+        isi = isi / 1000.0
+        sums[self._N_SAMPLES] = len(ts)
+        sums[self._SUM_ISI] = np.sum(isi)
+        sums[self._SUM_SQ_ISI] = np.sum(np.square(isi))
+        sums[self._N_ISI] = len(isi)
+        self._last_ts = int(ts[-1])
+
+        with self._lock:
+            self._batches.append((self._last_ts, sums))
+            while self._batches[0][0] < self._last_ts - self.window:
+                self._batches.popleft()
+
+        # Log the quality as a message
+        if self.log_interval is not None and self.send_message is not None:
+            if self._last_log is None:
+                self._last_log = self._last_ts
+            elif self._last_ts - self._last_log >= self.log_interval:
+                self.send_message('data_quality ' + json.dumps(self.snapshot()),
+                                  self._last_ts)
+                self._last_log = self._last_ts
+
+    #%%
+    def snapshot(self):
+        ''' Returns the data quality of the samples in the window
+
+        Returns:
+            dict with the RMS-S2S (deg), SD (deg) and proportion of data
+            loss per eye, the mean and SD of the intervals between samples (ms), the
+            number of samples, and the time stamp of the last sample
+        '''
+
+        with self._lock:
+            if len(self._batches) == 0:
+                return None
+            sums = np.sum([b[1] for b in self._batches], axis=0)
+            t_last = self._batches[-1][0]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rms = np.sqrt(sums[self._SUM_SQ_DIFF:self._SUM_SQ_DIFF + 2] /
+                          sums[self._N_DIFF:self._N_DIFF + 2])
+            n_angle = sums[self._N_ANGLE:self._N_ANGLE + 2]
+            angle_mean = sums[self._SUM_ANGLE:self._SUM_ANGLE + 2] / n_angle
+            sd = np.sqrt(np.maximum(sums[self._SUM_SQ_ANGLE:self._SUM_SQ_ANGLE + 2] / n_angle -
+                                    angle_mean ** 2, 0.0))
+            loss = sums[self._N_INVALID:self._N_INVALID + 2] / sums[self._N_SAMPLES]
+            isi_mean = sums[self._SUM_ISI] / sums[self._N_ISI]
+            isi_var = sums[self._SUM_SQ_ISI] / sums[self._N_ISI] - isi_mean ** 2
+
+        return {'system_time_stamp': t_last,
+                'n_samples': int(sums[self._N_SAMPLES]),
+                'RMS_S2S_left_eye (deg)': float(rms[0]),
+                'RMS_S2S_right_eye (deg)': float(rms[1]),
+                'SD_left_eye (deg)': float(sd[0]),
+                'SD_right_eye (deg)': float(sd[1]),
+                'Prop_data_loss_left_eye': float(loss[0]),
+                'Prop_data_loss_right_eye': float(loss[1]),
+                'Sample_interval_mean (ms)': float(isi_mean),
+                'Sample_interval_SD (ms)': float(np.sqrt(max(isi_var, 0.0)))}
+
+#%%
+class Histogram(object):
+    """
+    Streaming histogram with fixed bins (constant memory), from which
+    percentiles are computed. Values outside the bins are counted in the
+    first and last bin, but their exact sum, minimum and maximum are kept
+    """
+    def __init__(self, bin_width, max_value):
+        '''
+        Args:
+            bin_width - width of the bins
+            max_value - upper limit of the last bin
+        '''
+
+        self.bin_width = bin_width
+        self.counts = np.zeros(int(np.ceil(max_value / bin_width)), dtype=np.int64)
+
+        self.n = 0
+        self._sum = 0.0
+        self._sum_sq = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+    #%%
+    def add(self, values):
+        ''' Adds values (array)
+        '''
+
+        if len(values) == 0:
+            return
+
+        idx = np.clip((values // self.bin_width).astype(np.int64), 0, len(self.counts) - 1)
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+
+        self.n += len(values)
+        self._sum += float(np.sum(values))
+        self._sum_sq += float(np.sum(np.square(values)))
+        self.min = min(self.min, float(np.min(values)))
+        self.max = max(self.max, float(np.max(values)))
+
+    #%%
+    def percentile(self, q):
+        ''' Returns the q:th percentile (0-100), with the resolution of
+        the bins (the center of the bin it falls in)
+        '''
+
+        if self.n == 0:
+            return np.nan
+
+        i = np.searchsorted(np.cumsum(self.counts), q / 100.0 * self.n)
+        i = min(i, len(self.counts) - 1)
+
+        return float(min(max((i + 0.5) * self.bin_width, self.min), self.max))
+
+    #%%
+    def mean(self):
+        return self._sum / self.n if self.n > 0 else np.nan
+
+    #%%
+    def sd(self):
+        if self.n == 0:
+            return np.nan
+        return float(np.sqrt(max(self._sum_sq / self.n - self.mean() ** 2, 0.0)))
+
+#%%
+class LatencyMonitor(object):
+    """
+    Latency of the samples, i.e., the time from the system time stamp of the
+    newest sample of each batch until the batch was read on the Python side,
+    and the intervals between all samples. Both are kept in histograms
+    (0.1 ms and 0.01 ms bins), so memory use does not grow over the
+    recording.
+
+    Older samples of a batch waited in the buffer until the monitor polled
+    it (up to settings.MONITOR_INTERVAL), which says more about the polling
+    than about the eye tracker, so only the newest sample is used. Its
+    latency is the delivery latency (eye tracker to buffer) plus at most one
+    sample interval, since the sample may have arrived any time after the
+    previous one.
+    """
+    PERCENTILES = [50, 90, 95, 99, 99.9]
+
+    def __init__(self):
+
+        self._lock = Lock()
+        self.reset()
+
+    #%%
+    def reset(self):
+        ''' Clears the histograms (e.g., when the data have been saved)
+        '''
+
+        with self._lock:
+            self.latency = Histogram(0.1, 1000.0)   # ms
+            self.interval = Histogram(0.01, 100.0)  # ms
+            self._last_ts = None
+            self._n_samples = 0
+
+    #%%
+    def update(self, data, t_seen):
+        ''' Adds a batch of samples
+
+        Args:
+            data - dict with samples (TittaPy format)
+            t_seen - system time stamp when the batch was read
+        '''
+
+        ts = np.asarray(data['system_time_stamp'], dtype=np.int64)
+        if len(ts) == 0:
+            return
+
+        with self._lock:
+            self.latency.add(np.array([t_seen - ts[-1]]) / 1000.0)
+            self._n_samples += len(ts)
+            if self._last_ts is None:
+                self.interval.add(np.diff(ts) / 1000.0)
+            else:
+                self.interval.add(np.diff(ts, prepend=self._last_ts) / 1000.0)
+            self._last_ts = int(ts[-1])
+
+    #%%
+    def summary(self):
+        ''' Returns the number of samples and of batches (one latency
+        value per batch), and the mean, SD, minimum, percentiles and maximum
+        of the latency and of the intervals between samples (ms), as a dict
+        '''
+
+        out = {}
+        with self._lock:
+            out['n_samples'] = self._n_samples
+            out['n_batches'] = self.latency.n
+            for name, h in [('latency', self.latency), ('interval', self.interval)]:
+                out[f'{name}_mean (ms)'] = h.mean()
+                out[f'{name}_SD (ms)'] = h.sd()
+                out[f'{name}_min (ms)'] = h.min if h.n > 0 else np.nan
+                for q in self.PERCENTILES:
+                    out[f'{name}_p{q} (ms)'] = h.percentile(q)
+                out[f'{name}_max (ms)'] = h.max if h.n > 0 else np.nan
+
+        return out
+
+#%%
+class DropMonitor(object):
+    """
+    Detects samples that were dropped (e.g., because of USB or network
+    problems) from gaps in the device time stamps, given the sampling rate.
+
+    Each gap can be logged as a message, e.g.,
+    'sample_gap {"device_time_stamp": ..., "duration (ms)": ..., "n_dropped": ...}'
+    with the system time stamp of the first sample after the gap. A callback
+    is called when the proportion of dropped samples over the last 'window' s
+    rises above a threshold.
+    """
+    def __init__(self, sampling_rate, min_log_samples=1, threshold=0.01,
+                 window=1.0, send_message=None, callback=None):
+        '''
+        Args:
+            sampling_rate - sampling rate (Hz) of the eye tracker
+            min_log_samples - only gaps with at least this many dropped
+                              samples are logged
+            threshold - proportion of dropped samples (0-1) above which
+                        callback is called
+            window - duration (s) over which the proportion is computed
+            send_message - function used to log messages. It is called
+                           from the monitor thread, so it must be thread
+                           safe (see QualityMonitor)
+            callback - function(drop_rate, system_time_stamp) called
+                       (in the monitor thread) each time the proportion of
+                       dropped samples rises above threshold
+        '''
+
+        self.interval = 1e6 / sampling_rate
+        self.min_log_samples = min_log_samples
+        self.threshold = threshold
+        self.window = int(window * 1e6)
+        self.send_message = send_message
+        self.callback = callback
+
+        self.n_received = 0
+        self.n_dropped = 0
+        self.n_gaps = 0
+
+        # (device time stamp of last sample, received, dropped) per batch
+        self._batches = deque()
+        self._window_received = 0
+        self._window_dropped = 0
+        self._above_threshold = False
+
+        self._last_device_ts = None
+        self._lock = Lock()
+
+    #%%
+    def update(self, data, t_seen=None):
+        ''' Adds a batch of gaze samples
+
+        Args:
+            data - dict with gaze data (TittaPy format)
+            t_seen - (not used) time the batch was read
+        '''
+
+        device_ts = np.asarray(data['device_time_stamp'], dtype=np.int64)
+        if len(device_ts) == 0:
+            return
+
+        if self._last_device_ts is None:
+            d = np.diff(device_ts)
+        else:
+            d = np.diff(device_ts, prepend=self._last_device_ts)
+        self._last_device_ts = int(device_ts[-1])
+
+        # Number of samples missing in each interval
+        missing = np.maximum(np.rint(d / self.interval).astype(np.int64) - 1, 0)
+        gaps = np.flatnonzero(missing)
+        n_dropped = int(np.sum(missing))
+
+        with self._lock:
+            self.n_received += len(device_ts)
+            self.n_dropped += n_dropped
+            self.n_gaps += len(gaps)
+
+            self._batches.append((self._last_device_ts, len(device_ts), n_dropped))
+            self._window_received += len(device_ts)
+            self._window_dropped += n_dropped
+            while self._batches[0][0] < self._last_device_ts - self.window:
+                _, received, dropped = self._batches.popleft()
+                self._window_received -= received
+                self._window_dropped -= dropped
+
+            rate = self._window_dropped / float(self._window_received + self._window_dropped)
+
+        # Log the gaps as messages
+        if self.send_message is not None:
+            # Index of the first sample after each gap in this batch
+            offset = len(device_ts) - len(d)
+            for i in gaps:
+                j = i + offset
+                if missing[i] >= self.min_log_samples:
+                    info = {'device_time_stamp': int(device_ts[j]),
+                            'duration (ms)': float(d[i]) / 1000.0,
+                            'n_dropped': int(missing[i])}
+                    self.send_message('sample_gap ' + json.dumps(info),
+                                      int(data['system_time_stamp'][j]))
+
+        # Call the callback when the drop rate crosses the threshold
+        if rate > self.threshold and not self._above_threshold:
+            self._above_threshold = True
+            if self.callback is not None:
+                self.callback(rate, int(data['system_time_stamp'][-1]))
+        elif rate <= self.threshold:
+            self._above_threshold = False
+
+    #%%
+    def summary(self):
+        ''' Returns the number of received and dropped samples, the number
+        of gaps, and the proportion of dropped samples over the last
+        'window' s, as a dict
+        '''
+
+        with self._lock:
+            total = self._window_received + self._window_dropped
+            return {'n_received': self.n_received,
+                    'n_dropped': self.n_dropped,
+                    'n_gaps': self.n_gaps,
+                    'drop_rate': self._window_dropped / float(total) if total > 0 else np.nan}
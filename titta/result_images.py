@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Offscreen rendering of the calibration and validation result images.
+
+The images (targets and the gaze samples collected at each target) are
+rasterized with NumPy and written as PNG by PIL in a worker thread, so the
+participant display does not wait for the window to be read back and the
+file to be written. Positions are in PsychoPy 'pix' units (origin at the
+centre of the window, y up). Colors are converted to 0 -> 255 rgb (see
+rgb255) on the thread that submits the image, from the color space of the
+window or stimulus they belong to.
+"""
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from titta import helpers_tobii as helpers
+
+# test if PIL available (installed with PsychoPy; needed to write the images)
+HAS_PIL = False
+try:
+    from PIL import Image, ImageColor
+except:
+    pass
+else:
+    HAS_PIL = True
+
+# test if PsychoPy available (used to convert colors from any color space)
+HAS_PSYCHOPY = False
+try:
+    from psychopy import colors
+except:
+    pass
+else:
+    HAS_PSYCHOPY = True
+
+#%%
+def rgb255(color, color_space='rgb'):
+    ''' Converts a PsychoPy color to 0 -> 255 rgb
+
+    Args:
+        color - color name (e.g., 'red'), hex string, or color values in
+                color_space
+        color_space - PsychoPy color space, e.g., 'rgb' (-1 -> 1), 'rgb1'
+                      (0 -> 1) or 'rgb255' (0 -> 255), typically
+                      win.colorSpace or stim.colorSpace. Other color spaces
+                      (e.g., 'hsv') require PsychoPy
+
+    Returns:
+        uint8 array with r, g, b
+    '''
+
+    if HAS_PSYCHOPY:
+        color = colors.Color(color, color_space).rgb255
+    elif isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    elif color_space == 'rgb':
+        color = (np.asarray(color, dtype=float)[:3] + 1) * 127.5
+    elif color_space == 'rgb1':
+        color = np.asarray(color, dtype=float)[:3] * 255
+    elif color_space == 'rgb255':
+        color = np.asarray(color, dtype=float)[:3]
+    else:
+        raise ValueError(f'Color space {color_space} requires PsychoPy')
+
+    return np.rint(np.clip(np.asarray(color, dtype=float)[:3], 0, 255)).astype(np.uint8)
+
+#%%
+def stim_color(stim):
+    ''' Fill color (0 -> 255 rgb) of a PsychoPy shape, in its own color
+    space, or None if the shape is not filled
+    '''
+
+    if stim.fillColor is None:
+        return None
+
+    return rgb255(stim.fillColor, stim.colorSpace)
+
+#%%
+def target_shapes(target):
+    ''' Shapes making up a calibration target, drawn in order
+
+    Args:
+        target - helpers_tobii.MyDot2, MyDot3 or other TargetBase. MyDot2
+                 and MyDot3 get the fill colors of the shapes they draw.
+                 Other targets cannot be rasterized, and are drawn as a
+                 white disk with the size of the target
+
+    Returns:
+        list with (shape, width, height, color), where shape is 'disk'
+        or 'rect', and color 0 -> 255 rgb (see rgb255)
+    '''
+
+    d = target.get_size()
+    if isinstance(target, helpers.MyDot2):
+        inner = target.inner_diameter
+        return [('disk', d, d, stim_color(target.outer_dot)),
+                ('rect', inner, d, stim_color(target.line_vertical)),
+                ('rect', d, inner, stim_color(target.line_horizontal)),
+                ('disk', inner, inner, stim_color(target.inner_dot))]
+    elif isinstance(target, helpers.MyDot3):
+        inner = target.inner_diameter
+        return [('disk', d, d, stim_color(target.outer_dot)),
+                ('disk', inner, inner, stim_color(target.inner_dot))]
+    else:
+        return [('disk', d, d, rgb255('white'))]
+
+#%%
+def fill_shapes(image, xy, shape, width, height, color):
+    ''' Draws the same shape, centred on each of the positions, into an
+    image (all positions at once)
+
+    Args:
+        image - h x w x 3 uint8 array
+        xy - n x 2 array with positions (pix, origin at the centre, y up)
+        shape - 'disk' or 'rect'
+        width, height - size of the shape (pix)
+        color - 0 -> 255 rgb (see rgb255), or None to draw nothing
+    '''
+
+    xy = np.asarray(xy, dtype=float).reshape(-1, 2)
+    xy = xy[~np.any(np.isnan(xy), axis=1)]
+    if len(xy) == 0 or width <= 0 or height <= 0 or color is None:
+        return
+
+    h, w = image.shape[:2]
+    rx, ry = width / 2, height / 2
+
+    # Centres in (fractional) column and row indices of the image
+    col = (xy[:, 0] + w / 2 - 0.5)[:, None, None]
+    row = (h / 2 - xy[:, 1] - 0.5)[:, None, None]
+
+    # Pixels in a box around each centre (n x rows x columns)
+    dc = np.arange(-int(np.ceil(rx)) - 1, int(np.ceil(rx)) + 2)
+    dr = np.arange(-int(np.ceil(ry)) - 1, int(np.ceil(ry)) + 2)
+    c = np.rint(col) + dc[None, None, :]
+    r = np.rint(row) + dr[None, :, None]
+
+    if shape == 'disk':
+        inside = ((c - col) / rx)**2 + ((r - row) / ry)**2 <= 1
+    else:
+        inside = (np.abs(c - col) <= rx) & (np.abs(r - row) <= ry)
+    inside &= (c >= 0) & (c < w) & (r >= 0) & (r < h)
+
+    c, r = np.broadcast_arrays(c, r)
+    image[r[inside].astype(int), c[inside].astype(int)] = color
+
+#%%
+def render(size, background, layers):
+    ''' Renders a result image
+
+    Args:
+        size - (width, height) of the image (pix)
+        background - background color, 0 -> 255 rgb (see rgb255)
+        layers - list with (xy, shapes), drawn in order, where xy is an
+                 n x 2 array with positions and shapes a list with
+                 (shape, width, height, color), see target_shapes()
+
+    Returns:
+        h x w x 3 uint8 array
+    '''
+
+    w, h = int(size[0]), int(size[1])
+    image = np.empty((h, w, 3), dtype=np.uint8)
+    image[:] = background
+
+    for xy, shapes in layers:
+        for shape, width, height, color in shapes:
+            fill_shapes(image, xy, shape, width, height, color)
+
+    return image
+
+#%%
+class ResultImageWriter(object):
+    """
+    Renders and saves result images in a worker thread
+    """
+    def __init__(self):
+
+        # Created when first needed
+        self._executor = None
+
+        # Images not yet known to be written, by file name
+        self._pending = {}
+
+    #%%
+    def submit(self, fname, size, background, layers):
+        ''' Renders an image (see render()) and writes it to a PNG file,
+        in the background
+
+        Returns:
+            concurrent.futures.Future, with the file name as result
+        '''
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+        future = self._executor.submit(self._write, fname, size, background, layers)
+        self._pending[fname] = future
+
+        return future
+
+    #%%
+    def _write(self, fname, size, background, layers):
+        Image.fromarray(render(size, background, layers)).save(fname)
+        return fname
+
+    #%%
+    def wait(self, fname):
+        ''' Waits until an image (if submitted) has been written. Errors
+        raised while rendering or writing the image are raised here
+
+        Returns:
+            fname
+        '''
+
+        future = self._pending.pop(fname, None)
+        if future is not None:
+            future.result()
+
+        return fname
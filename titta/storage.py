@@ -0,0 +1,956 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental storage of eye tracker data in HDF5 containers.
+
+Each data stream is stored as a group in the HDF5 file, with one resizable,
+chunked and typed dataset per column (e.g., /gaze/system_time_stamp). This
+allows data to be appended while recording is still ongoing, and single
+columns to be read without reading the whole table.
+"""
+import os
+import sys
+import json
+import itertools
+import numpy as np
+import pandas as pd
+import h5py
+from pathlib import Path
+from threading import Thread, Event, Lock
+
+# test if pyarrow available (needed to store data as Parquet files)
+HAS_PYARROW = False
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except:
+    pass
+else:
+    HAS_PYARROW = True
+
+# Streams that are written to file (the positioning stream is never saved)
+STREAMS = ['gaze', 'time_sync', 'eye_image', 'external_signal', 'notification']
+
+# Number of rows in each HDF5 chunk
+CHUNK_ROWS = 4096
+
+# Columns with enums (stored as integer codes, see encode_enum)
+ENUM_COLUMNS = ['change_type', 'notification_type', 'type', 'level', 'source']
+
+# Fields of the display area in notifications (stored as separate columns)
+DISPLAY_AREA_CORNERS = ['top_left', 'top_right', 'bottom_left', 'bottom_right']
+
+
+#%%
+def encode_enum(values, column=None, lookup=None):
+    ''' Converts enums (e.g., notification types) to integer codes.
+
+    Args:
+        values - list of enums
+        column - (optional) name of the column
+        lookup - (optional) dict, where the lookup table of the enum
+                 ({name: code}) is stored under the column name
+
+    Returns:
+        codes - numpy array (int8)
+    '''
+
+    codes = np.zeros(len(values), dtype=np.int8)
+    if len(values) == 0:
+        return codes
+
+    # Compare all values with each (of the few) enum members at the time
+    obj = np.empty(len(values), dtype=object)
+    obj[:] = values
+    members = set(values)
+    for member in members:
+        codes[obj == member] = member.value
+
+    if lookup is not None:
+        enum_type = type(next(iter(members)))
+        lookup[column] = {name: m.value for name, m in enum_type.__members__.items()}
+
+    return codes
+
+#%%
+def _flatten_display_area(values):
+    ''' Converts display areas (or None) in notifications to numeric columns,
+    e.g., display_area_top_left_x. Missing values are stored as NaN.
+    '''
+
+    def field(display_area, name):
+        if isinstance(display_area, dict):
+            return display_area[name]
+        return getattr(display_area, name)
+
+    n = len(values)
+    columns = {}
+    for corner in DISPLAY_AREA_CORNERS:
+        for i, c in enumerate('xyz'):
+            columns['display_area_' + corner + '_' + c] = np.full(n, np.nan)
+    columns['display_area_width'] = np.full(n, np.nan)
+    columns['display_area_height'] = np.full(n, np.nan)
+
+    for k, display_area in enumerate(values):
+        if display_area is None:
+            continue
+        for corner in DISPLAY_AREA_CORNERS:
+            for i, c in enumerate('xyz'):
+                columns['display_area_' + corner + '_' + c][k] = field(display_area, corner)[i]
+        columns['display_area_width'][k] = field(display_area, 'width')
+        columns['display_area_height'][k] = field(display_area, 'height')
+
+    return columns
+
+#%%
+def prepare_stream_data(stream, data, lookup=None):
+    ''' Converts the columns of a stream (as returned by e.g., TittaPy's consume_N)
+    such that they can be stored in a HDF5 container without PyTables having
+    to pickle object columns.
+
+    Enums are stored as integer codes (see encode_enum), and the display area
+    in notifications is stored as numeric columns.
+
+    Args:
+        stream - name of the stream, e.g., 'gaze' or 'notification'
+                 (or 'log' for data from the python wrapper)
+        data - dict with one entry per column
+        lookup - (optional) dict, where the lookup table of each enum
+                 column is stored ({column: {name: code}})
+
+    Returns:
+        dict with one entry per column
+    '''
+
+    temp = {}
+    for key, values in data.items():
+        if key in ENUM_COLUMNS and stream in ('external_signal', 'notification',
+                                              'eye_image', 'log'):
+            temp[key] = encode_enum(values, key, lookup)
+        elif stream == 'notification' and key == 'display_area':
+            temp.update(_flatten_display_area(values))
+        elif stream == 'notification' and key == 'output_frequency':
+            temp[key] = np.array([np.nan if f is None else f for f in values],
+                                 dtype=np.float64)
+        elif stream == 'notification' and key == 'errors_or_warnings':
+            temp[key] = np.array(['' if e is None else str(e) for e in values],
+                                 dtype=object)
+        else:
+            temp[key] = values
+
+    return temp
+
+#%%
+def enum_lookup_table(lookups):
+    ''' Converts enum lookup tables to a dataframe (stored as 'enum_lookup')
+
+    Args:
+        lookups - dict with the lookup tables of each table
+                  ({table: {column: {name: code}}})
+
+    Returns:
+        dataframe with columns 'table', 'column', 'code', and 'name'
+    '''
+
+    rows = [[table, column, code, name]
+            for table, columns in lookups.items()
+            for column, names in columns.items()
+            for name, code in names.items()]
+
+    return pd.DataFrame(rows, columns=['table', 'column', 'code', 'name'])
+
+#%%
+def read_enum_lookup(df):
+    ''' Converts a dataframe written by enum_lookup_table back to a dict
+    ({table: {column: {name: code}}})
+    '''
+
+    lookups = {}
+    for table, column, code, name in zip(df.table, df.column, df.code, df.name):
+        lookups.setdefault(table, {}).setdefault(column, {})[name] = int(code)
+
+    return lookups
+
+#%%
+def decode_enums(df, lookups, table):
+    ''' Replaces the integer codes in the enum columns of a dataframe with names
+
+    Args:
+        df - dataframe, e.g., read with pd.read_hdf(fname, 'notification')
+        lookups - lookup tables, as returned by read_enum_lookup
+        table - name of the table, e.g., 'notification'
+
+    Returns:
+        df - dataframe with names in the enum columns
+    '''
+
+    for column, names in lookups.get(table, {}).items():
+        if column in df:
+            df[column] = df[column].map({code: name for name, code in names.items()})
+
+    return df
+
+#%%
+def time_column(stream):
+    ''' Name of the column with the system time stamps of a stream
+    '''
+    if stream == 'time_sync':
+        return 'system_request_time_stamp'
+    else:
+        return 'system_time_stamp'
+
+#%%
+def split_at(stream, data, t):
+    ''' Splits data from a stream into the samples recorded before time
+    stamp t, and the samples recorded at or after t
+
+    Returns:
+        before, after - dicts with one entry per column
+    '''
+
+    if len(data) == 0:
+        return data, data
+
+    mask = np.asarray(data[time_column(stream)]) < t
+    idx = [np.flatnonzero(mask), np.flatnonzero(~mask)]
+
+    parts = []
+    for i in idx:
+        temp = {}
+        for key, values in data.items():
+            if isinstance(values, list):
+                temp[key] = [values[k] for k in i]
+            else:
+                temp[key] = np.asarray(values)[i]
+        parts.append(temp)
+
+    return parts[0], parts[1]
+
+#%%
+def align_stream(timeline, stream, data, method='nearest', max_offset=None):
+    ''' Aligns data from a stream to a timeline, e.g., the time stamps
+    of gaze samples
+
+    Args:
+        timeline - array with system time stamps
+        stream - name of the stream
+        data - dict with one entry per column (samples ordered by time)
+        method - 'nearest': the sample closest in time,
+                 'previous': the last sample at or before each time stamp,
+                 'linear': linear interpolation of float columns (other
+                 columns as 'nearest')
+        max_offset - (optional) maximum distance (us) to the sample used.
+                     Time stamps without a sample within max_offset get
+                     missing values
+
+    Returns:
+        dict with one entry per column, with one value per time stamp.
+        Missing values are nan (float), False (bool), -1 (integer,
+        e.g., time stamps), or None (other)
+    '''
+
+    timeline = np.asarray(timeline, dtype=np.int64)
+    ts = np.asarray(data[time_column(stream)], dtype=np.int64)
+
+    if len(ts) == 0:
+        idx = np.full(len(timeline), -1)
+    else:
+        # Index of the last sample at or before each time stamp
+        idx = np.searchsorted(ts, timeline, side='right') - 1
+
+        if method != 'previous':
+            nxt = np.minimum(idx + 1, len(ts) - 1)
+            prev = np.maximum(idx, 0)
+            use_next = (idx < 0) | (np.abs(ts[nxt] - timeline) < np.abs(timeline - ts[prev]))
+            idx = np.where(use_next, nxt, prev)
+
+    missing = idx < 0
+    if max_offset is not None and len(ts) > 0:
+        missing |= np.abs(ts[np.maximum(idx, 0)] - timeline) > max_offset
+    idx = np.maximum(idx, 0)
+
+    out = {}
+    for key, values in data.items():
+        if isinstance(values, list) or np.asarray(values).dtype == object:
+            out[key] = [None if m else values[i] for i, m in zip(idx.tolist(), missing.tolist())]
+            continue
+
+        values = np.asarray(values)
+        if len(values) == 0:
+            values = np.zeros(1, dtype=values.dtype)
+
+        if values.dtype.kind == 'f':
+            if method == 'linear' and len(ts) > 1:
+                temp = np.interp(timeline, ts, values)
+                # Outside the recorded samples, nothing to interpolate
+                temp[(timeline < ts[0]) | (timeline > ts[-1])] = np.nan
+            else:
+                temp = values[idx]
+            out[key] = np.where(missing, np.nan, temp)
+        elif values.dtype.kind == 'b':
+            out[key] = np.where(missing, False, values[idx])
+        elif values.dtype.kind in 'iu':
+            out[key] = np.where(missing, -1, values[idx].astype(np.int64))
+        else:
+            out[key] = np.where(missing, None, values[idx].astype(object))
+
+    return out
+
+#%%
+def column_dtype(stream, column):
+    ''' Returns the data type a column is stored with, or None if the
+    column should be stored with the data type it already has.
+
+    Time stamps are stored as int64, and for the gaze stream, validity
+    flags are stored as bool and all other values as float32.
+    '''
+
+    if 'time_stamp' in column:
+        return np.int64
+
+    if stream == 'gaze':
+        if column.endswith('_valid') or column.endswith('_available'):
+            return np.bool_
+        return np.float32
+
+    return None
+
+#%%
+def _as_array(values, dtype=None):
+    ''' Converts a column to a numpy array, and strings to a format h5py can store
+    '''
+
+    values = np.asarray(values)
+    if values.dtype.kind in ('U', 'O'):
+        values = np.array([str(v) for v in values], dtype=h5py.string_dtype())
+    elif dtype is not None:
+        values = values.astype(dtype, copy=False)
+
+    return values
+
+#%%
+def append_columns(grp, data, compression=None, stream=None):
+    ''' Appends columns to resizable datasets in a HDF5 group. Datasets are
+    created the first time a column is appended.
+
+    Args:
+        grp - h5py group
+        data - dict with one entry per column (all of the same length)
+        compression - (optional) compression filter, e.g., 'gzip' or 'lzf'
+        stream - (optional) name of the stream, used to look up the data
+                 type of each column (see column_dtype)
+    '''
+
+    for key, values in data.items():
+        values = _as_array(values, column_dtype(stream, key))
+        if len(values) == 0:
+            continue
+
+        if key not in grp:
+            grp.create_dataset(key, data=values,
+                               maxshape=(None,) + values.shape[1:],
+                               chunks=(CHUNK_ROWS,) + values.shape[1:],
+                               compression=compression)
+        else:
+            ds = grp[key]
+            n = ds.shape[0]
+            ds.resize(n + len(values), axis=0)
+            ds[n:] = values
+
+#%%
+def write_eye_images(hf, images, compression='gzip'):
+    ''' Appends eye images to the HDF5 container. Images of the same size
+    (e.g., full or cropped images) are stacked into one N x H x W dataset
+    per size, with one chunk per frame.
+
+    Args:
+        hf - h5py File
+        images - list of 2D arrays (one per frame)
+        compression - (optional) compression filter, e.g., 'gzip' or 'lzf'
+
+    Returns:
+        stacks - name of the dataset (in the group 'eye_image') each frame was written to
+        indices - row of each frame in its dataset
+
+    To read frame i later, use hf['eye_image'][stacks[i]][indices[i]]
+    '''
+
+    grp = hf.require_group('eye_image')
+    stacks = np.empty(len(images), dtype=object)
+    indices = np.zeros(len(images), dtype=np.int64)
+
+    shapes = [im.shape for im in images]
+    for shape in dict.fromkeys(shapes):
+        idx = np.array([i for i, sh in enumerate(shapes) if sh == shape])
+        name = 'x'.join(str(d) for d in shape)
+        frames = np.stack([images[i] for i in idx])
+
+        if name not in grp:
+            grp.create_dataset(name, shape=(0,) + shape,
+                               maxshape=(None,) + shape,
+                               chunks=(1,) + shape,
+                               dtype=frames.dtype,
+                               compression=compression)
+        ds = grp[name]
+        n = ds.shape[0]
+        ds.resize(n + len(idx), axis=0)
+        ds[n:] = frames
+
+        stacks[idx] = name
+        indices[idx] = np.arange(n, n + len(idx))
+
+    return stacks, indices
+
+#%%
+def write_stream(hf, stream, data, compression=None):
+    ''' Appends data from one stream to a HDF5 container
+
+    The lookup table of enum columns is stored as attributes of the dataset
+    ('enum_names' and 'enum_codes').
+
+    Args:
+        hf - h5py File
+        stream - name of the stream, e.g., 'gaze' or 'eye_image'
+        data - dict with one entry per column (as returned by e.g., TittaPy's consume_N)
+        compression - (optional) compression filter, e.g., 'gzip' or 'lzf'
+    '''
+
+    lookup = {}
+    data = prepare_stream_data(stream, data, lookup)
+
+    if stream == 'eye_image':
+        if len(data['image']) == 0:
+            return
+
+        # Save frames in stacks, and where to find them with the metadata
+        data['image_stack'], data['image_index'] = write_eye_images(hf, data['image'],
+                                                                    compression or 'gzip')
+        del data['image']
+        stream = 'eye_metadata'
+
+    grp = hf.require_group(stream)
+    append_columns(grp, data, compression, stream)
+
+    for column, names in lookup.items():
+        if column in grp:
+            grp[column].attrs['enum_names'] = list(names.keys())
+            grp[column].attrs['enum_codes'] = np.array(list(names.values()), dtype=np.int8)
+
+#%%
+def iter_chunks(buffer, stream, chunk_size):
+    ''' Consumes all data from a stream in the buffer, in chunks of at most
+    chunk_size samples. Only one chunk is kept in memory at the time.
+
+    Args:
+        buffer - TittaPy EyeTracker instance
+        stream - name of the stream, e.g., 'gaze'
+        chunk_size - maximum number of samples per chunk
+
+    Yields:
+        dict with one entry per column
+    '''
+
+    while True:
+        data = buffer.consume_N(stream, chunk_size)
+        n = len(next(iter(data.values()))) if len(data) > 0 else 0
+        if n == 0:
+            return
+
+        yield data
+
+        if n < chunk_size:
+            return
+
+#%%
+def _concat_chunks(chunks):
+    ''' Concatenates a list of chunks (dicts with one entry per column)
+    '''
+
+    data = {}
+    for chunk in chunks:
+        for key, values in chunk.items():
+            data.setdefault(key, []).extend(list(values))
+
+    return data
+
+#%%
+def write_stream_pandas(fname, stream, chunks, lookups=None):
+    ''' Writes data from one stream to a HDF5 container using pandas (PyTables).
+
+    The gaze and time_sync streams are stored in pandas' default fixed
+    format if they fit in one chunk, as before data were saved in chunks.
+    Otherwise they are appended chunk by chunk in table format (which can
+    also be read with pd.read_hdf). The other (small) streams are stored as
+    one pandas table (fixed format).
+    Eye images are stored as stacks of frames (see write_eye_images)
+
+    Args:
+        fname - name of the HDF5 file (including extension)
+        stream - name of the stream, e.g., 'gaze'
+        chunks - iterable with data (dicts with one entry per column)
+        lookups - (optional) dict, where the lookup tables of enum columns
+                  are stored ({table: {column: {name: code}}}). Write them to
+                  file with enum_lookup_table
+    '''
+
+    lookup = {}
+
+    if stream in ('gaze', 'time_sync'):
+        # Look one chunk ahead to find out if there is more than one
+        chunks = iter(chunks)
+        first = next(chunks, None)
+        second = next(chunks, None) if first is not None else None
+
+        if second is None:
+            if first is not None:
+                pd.DataFrame.from_dict(first).to_hdf(fname, key=stream)
+        else:
+            n = 0
+            for temp in itertools.chain([first, second], chunks):
+                df = pd.DataFrame.from_dict(temp)
+                df.index += n
+                df.to_hdf(fname, key=stream, format='table', append=True)
+                n += len(df)
+    elif stream == 'eye_image':
+        metadata = []
+        for temp in chunks:
+            if len(temp['image']) == 0:
+                continue
+
+            # Save frames in stacks of images with the same size
+            # To access frame i later, use
+            # hf['eye_image'][eye_metadata.image_stack[i]][eye_metadata.image_index[i]]
+            with h5py.File(fname, 'a') as hf:
+                stacks, indices = write_eye_images(hf, temp['image'])
+
+            # # Remove the numpy image and save the rest
+            temp = prepare_stream_data('eye_image', temp, lookup)
+            del temp['image']
+            temp['image_stack'] = stacks.astype(str)
+            temp['image_index'] = indices
+            metadata.append(temp)
+
+        if len(metadata) > 0:
+            pd.DataFrame.from_dict(_concat_chunks(metadata)).to_hdf(fname, key='eye_metadata')
+    else:
+        temp = prepare_stream_data(stream, _concat_chunks(chunks), lookup)
+        pd.DataFrame.from_dict(temp).to_hdf(fname, key=stream)
+
+    if lookups is not None and len(lookup) > 0:
+        lookups['eye_metadata' if stream == 'eye_image' else stream] = lookup
+
+#%%
+def _to_arrow(stream, data, lookup=None):
+    ''' Converts columns to an Arrow table. Enum columns are dictionary encoded
+    (with the names of the enums as dictionary).
+    '''
+
+    arrays = {}
+    for key, values in data.items():
+        if key in ENUM_COLUMNS and lookup is not None and key in lookup:
+            # Integer codes to positions in the dictionary
+            names = list(lookup[key].keys())
+            codes = np.array(list(lookup[key].values()))
+            position = np.zeros(codes.max() + 1, dtype=np.int32)
+            position[codes] = np.arange(len(codes))
+            arrays[key] = pa.DictionaryArray.from_arrays(position[np.asarray(values, dtype=np.int64)],
+                                                         pa.array(names, type=pa.string()))
+        elif key in ENUM_COLUMNS:
+            arrays[key] = pa.array([str(v) for v in values], type=pa.string()).dictionary_encode()
+        else:
+            values = np.asarray(values)
+            dtype = column_dtype(stream, key)
+            if dtype is not None and values.dtype.kind not in ('U', 'O'):
+                values = values.astype(dtype, copy=False)
+            arrays[key] = pa.array(values)
+
+    return pa.table(arrays)
+
+#%%
+def write_table_parquet(path, key, chunks, compression='snappy', lookup=None):
+    ''' Writes a table to a Parquet file (<path>/<key>.parquet). Each chunk
+    is written as a separate row group.
+
+    Args:
+        path - folder where the file is stored
+        key - name of the table, e.g., 'gaze' or 'msg'
+        chunks - iterable with data (dicts with one entry per column)
+        compression - (optional) compression codec, e.g., 'snappy', 'gzip' or 'zstd'
+        lookup - (optional) lookup tables of enum columns stored as
+                 integer codes ({column: {name: code}})
+    '''
+
+    if not HAS_PYARROW:
+        raise ImportError('pyarrow is required to store data as Parquet files (pip install pyarrow)')
+
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    writer = None
+    for temp in chunks:
+        table = _to_arrow(key, temp, lookup)
+        if writer is None:
+            writer = pq.ParquetWriter(str(Path(path) / (key + '.parquet')),
+                                      table.schema, compression=compression)
+        writer.write_table(table)
+
+    if writer is not None:
+        writer.close()
+
+#%%
+def write_stream_parquet(path, stream, chunks, compression='snappy'):
+    ''' Writes data from one stream to a Parquet file (<path>/<stream>.parquet)
+
+    Eye images cannot be stored in Parquet files, so they are stored as
+    stacks of frames in <path>/eye_image.h5 (see write_eye_images)
+    and their metadata in <path>/eye_metadata.parquet
+
+    Args:
+        path - folder where the file is stored
+        stream - name of the stream, e.g., 'gaze'
+        chunks - iterable with data (dicts with one entry per column)
+        compression - (optional) compression codec, e.g., 'snappy', 'gzip' or 'zstd'
+    '''
+
+    lookup = {}
+
+    def prepared_chunks():
+        for temp in chunks:
+            temp = prepare_stream_data(stream, temp, lookup)
+            if stream == 'eye_image':
+                if len(temp['image']) == 0:
+                    continue
+                with h5py.File(str(Path(path) / 'eye_image.h5'), 'a') as hf:
+                    temp['image_stack'], temp['image_index'] = write_eye_images(hf, temp['image'])
+                temp['image_stack'] = temp['image_stack'].astype(str)
+                del temp['image']
+            yield temp
+
+    Path(path).mkdir(parents=True, exist_ok=True)
+    key = 'eye_metadata' if stream == 'eye_image' else stream
+    write_table_parquet(path, key, prepared_chunks(), compression, lookup)
+
+#%%
+def h5_to_parquet(fname, path=None, compression='snappy'):
+    ''' Converts a HDF5 container saved by Titta to Parquet files, one per
+    table (gaze, msg, time_sync, external_signal, notification,
+    calibration_history, log, eye_metadata). Eye images are not converted.
+
+    Args:
+        fname - name of the HDF5 file (including extension)
+        path - (optional) folder where the Parquet files are stored.
+               Default: fname without extension
+        compression - (optional) compression codec, e.g., 'snappy', 'gzip' or 'zstd'
+
+    Returns:
+        path - folder where the Parquet files are stored
+    '''
+
+    if path is None:
+        path = Path(fname).with_suffix('')
+
+    with h5py.File(fname, 'r') as hf:
+        keys = [k for k in hf.keys() if k not in ('eye_image', 'enum_lookup')]
+        columnar = {k: 'pandas_type' not in hf[k].attrs for k in keys}
+        has_lookup = 'enum_lookup' in hf
+
+    # Enum columns are stored as integer codes (in files saved by older
+    # versions of Titta, as names)
+    if has_lookup:
+        lookups = read_enum_lookup(pd.read_hdf(fname, 'enum_lookup'))
+    else:
+        lookups = {}
+
+    for key in keys:
+        lookup = lookups.get(key, {})
+        if columnar[key]:
+            with h5py.File(fname, 'r') as hf:
+                data = {}
+                for c, ds in hf[key].items():
+                    if h5py.check_string_dtype(ds.dtype) is not None:
+                        data[c] = ds.asstr()[:]
+                    else:
+                        data[c] = ds[:]
+                    if 'enum_names' in ds.attrs:
+                        lookup[c] = dict(zip([str(n) for n in ds.attrs['enum_names']],
+                                             ds.attrs['enum_codes'].tolist()))
+        else:
+            df = pd.read_hdf(fname, key)
+            data = {str(c): df[c].to_numpy() for c in df.columns}
+
+        write_table_parquet(path, key, [data], compression, lookup)
+
+    return path
+
+#%%
+class StreamWriter(Thread):
+    """
+    Background thread that periodically consumes data from the eye tracker
+    buffer and appends them to a HDF5 container.
+
+    The most recent data are left in the buffer, such that they are still
+    available to e.g., gaze contingent code that peeks into the buffer.
+
+    Long recordings can be split into segments (separate HDF5 files) by
+    number of gaze samples, duration, or at messages with a given prefix.
+    A manifest (<fname>.manifest.json) lists the segments and their time ranges.
+    """
+    def __init__(self, buffer, fname, get_system_time_stamp,
+                 interval=1.0, keep_in_buffer=2.0, compression=None,
+                 segment_samples=None, segment_duration=None,
+                 segment_on_message=None):
+        '''
+        Args:
+            buffer - TittaPy EyeTracker instance
+            fname - name of the HDF5 file (without extension)
+            get_system_time_stamp - function returning the current system
+                                    time stamp (in microseconds)
+            interval - how often (in s) data are written to file
+            keep_in_buffer - how much of the most recent data (in s) to leave in the buffer
+            compression - (optional) compression filter, e.g., 'gzip' or 'lzf'
+            segment_samples - (optional) start a new segment after this many gaze samples
+            segment_duration - (optional) start a new segment after this duration (s)
+            segment_on_message - (optional) start a new segment when a message
+                                 starting with this prefix is sent (see message())
+        '''
+        Thread.__init__(self, daemon=True)
+
+        self.buffer = buffer
+        self.fname = fname
+        self.get_system_time_stamp = get_system_time_stamp
+        self.interval = interval
+        self.keep_in_buffer = keep_in_buffer
+        self.compression = compression
+
+        self.segment_samples = segment_samples
+        self.segment_duration = segment_duration
+        self.segment_on_message = segment_on_message
+        self.segmenting = (segment_samples is not None or
+                           segment_duration is not None or
+                           segment_on_message is not None)
+
+        self.streams = [s for s in STREAMS if self.buffer.has_stream(s)]
+
+        # Segments written so far (listed in the manifest)
+        self.segments = []
+
+        # Time stamps of messages where a new segment should start
+        self._markers = []
+        self._marker_lock = Lock()
+
+        self._hf = None
+        self._stop_event = Event()
+        self._t_end = None
+
+        # Exception raised in the thread (if any)
+        self.error = None
+
+    #%%
+    def run(self):
+        # Errors are raised again by stop(), so they are not lost with the thread
+        try:
+            self._run()
+        except Exception as e:
+            self.error = e
+            if self._hf is not None:
+                self._hf.close()
+
+    #%%
+    def _run(self):
+        if self.segmenting:
+            self._open_segment(None)
+        else:
+            self._hf = h5py.File(self.fname + '.h5', 'a')
+
+        while not self._stop_event.wait(self.interval):
+            t1 = self.get_system_time_stamp() - int(self.keep_in_buffer * 1000 * 1000)
+            self._write({stream: self.buffer.consume_time_range(stream, 0, t1)
+                         for stream in self.streams})
+
+        # Write everything that is left in the buffer (or was recorded
+        # before the writer was asked to stop)
+        data = {}
+        for stream in self.streams:
+            if self._t_end is None:
+                data[stream] = self.buffer.consume_N(stream, sys.maxsize)
+            else:
+                data[stream] = self.buffer.consume_time_range(stream, 0, self._t_end)
+        self._write(data)
+
+        self._hf.close()
+        if self.segmenting:
+            # Remove the last segment if no data were written to it
+            if len(self.segments) > 0 and self.segments[-1]['end_time_stamp'] is None:
+                os.remove(os.path.join(os.path.dirname(self.fname), self.segments[-1]['file']))
+                self.segments.pop()
+            self._write_manifest()
+
+    #%%
+    def message(self, ts, msg):
+        ''' Starts a new segment at time stamp ts if the message starts
+        with segment_on_message (called by send_message)
+        '''
+        if self.segment_on_message is not None and str(msg).startswith(self.segment_on_message):
+            with self._marker_lock:
+                self._markers.append(ts)
+
+    #%%
+    def _write(self, data):
+        ''' Writes data from all streams ({stream: data}), and starts
+        new segments where needed
+        '''
+
+        if not self.segmenting:
+            for stream, temp in data.items():
+                write_stream(self._hf, stream, temp, self.compression)
+            return
+
+        while True:
+            t = self._next_boundary(data)
+            if t is None:
+                break
+
+            # Samples before the boundary belong to the current segment
+            before = {}
+            for stream in list(data.keys()):
+                before[stream], data[stream] = split_at(stream, data[stream], t)
+            self._write_segment(before)
+
+            # The next segment starts at its first sample (so pauses in the
+            # data do not give empty segments)
+            if self.segments[-1]['end_time_stamp'] is not None:
+                self._open_segment(None)
+            else:
+                self.segments[-1]['start_time_stamp'] = None
+
+        self._write_segment(data)
+
+    #%%
+    def _next_boundary(self, data):
+        ''' Returns the time stamp where the next segment starts, or None
+        if all data belong to the current segment
+        '''
+
+        ts = [np.asarray(temp[time_column(stream)]) for stream, temp in data.items()
+              if len(temp) > 0 and len(temp[time_column(stream)]) > 0]
+        if len(ts) == 0:
+            return None
+        t_min = min(t[0] for t in ts)
+        t_max = max(t[-1] for t in ts)
+
+        segment = self.segments[-1]
+        if segment['start_time_stamp'] is None:
+            segment['start_time_stamp'] = int(t_min)
+        t_start = segment['start_time_stamp']
+
+        candidates = []
+        with self._marker_lock:
+            self._markers = [t for t in self._markers if t > t_start]
+            candidates += [t for t in self._markers if t <= t_max]
+        if self.segment_duration is not None:
+            candidates.append(t_start + int(self.segment_duration * 1000 * 1000))
+        if self.segment_samples is not None and 'gaze' in data and len(data['gaze']) > 0:
+            gaze_ts = np.asarray(data['gaze'][time_column('gaze')])
+            n_left = max(self.segment_samples - segment['n_samples'], 0)
+            if n_left < len(gaze_ts):
+                candidates.append(int(gaze_ts[n_left]))
+
+        candidates = [t for t in candidates if t_start < t <= t_max]
+        if len(candidates) == 0:
+            return None
+
+        t = min(candidates)
+        with self._marker_lock:
+            self._markers = [m for m in self._markers if m > t]
+
+        return t
+
+    #%%
+    def _write_segment(self, data):
+        ''' Writes data to the current segment
+        '''
+
+        segment = self.segments[-1]
+        for stream, temp in data.items():
+            if len(temp) == 0:
+                continue
+            write_stream(self._hf, stream, temp, self.compression)
+
+            ts = temp[time_column(stream)]
+            if len(ts) > 0:
+                if segment['end_time_stamp'] is None:
+                    # First data in the segment, list it in the manifest
+                    segment['end_time_stamp'] = int(ts[-1])
+                    self._write_manifest()
+                segment['end_time_stamp'] = max(segment['end_time_stamp'], int(ts[-1]))
+                if stream == 'gaze':
+                    segment['n_samples'] += len(ts)
+
+    #%%
+    def _open_segment(self, t_start):
+        ''' Closes the current segment (if any) and starts a new one
+        '''
+
+        if self._hf is not None:
+            self._hf.close()
+
+        name = self.fname + '_seg{:03d}'.format(len(self.segments))
+        self.segments.append({'file': os.path.basename(name) + '.h5',
+                              'start_time_stamp': t_start,
+                              'end_time_stamp': None,
+                              'n_samples': 0})
+        self._hf = h5py.File(name + '.h5', 'a')
+        self._write_manifest()
+
+    #%%
+    def _write_manifest(self):
+        ''' Writes the manifest, which lists the segments and their time
+        ranges (system time stamps)
+        '''
+
+        # Only segments with data (the current segment is listed once data
+        # have been written to it)
+        manifest = {'session': os.path.basename(self.fname) + '.h5',
+                    'segments': [segment for segment in self.segments
+                                 if segment['end_time_stamp'] is not None]}
+        with open(self.fname + '.manifest.json.tmp', 'w') as outfile:
+            json.dump(manifest, outfile, indent=1)
+        os.replace(self.fname + '.manifest.json.tmp', self.fname + '.manifest.json')
+
+    #%%
+    def rename(self, fname):
+        ''' Renames the segments and the manifest (after the writer has stopped)
+
+        Args:
+            fname - new name of the HDF5 file (without extension)
+        '''
+
+        if not self.segmenting:
+            return
+
+        folder = os.path.dirname(self.fname)
+        for i, segment in enumerate(self.segments):
+            name = os.path.basename(fname) + '_seg{:03d}'.format(i) + '.h5'
+            os.replace(os.path.join(folder, segment['file']),
+                       os.path.join(os.path.dirname(fname), name))
+            segment['file'] = name
+
+        os.remove(self.fname + '.manifest.json')
+        self.fname = fname
+        self._write_manifest()
+
+    #%%
+    def stop(self, t_end=None):
+        ''' Writes the remaining data to file and waits for the thread to finish
+
+        Args:
+            t_end - (optional) only write data recorded until this system time stamp.
+                    Default: write all data in the buffer
+
+        Errors raised while writing (in the thread) are raised here, as a
+        RuntimeError
+        '''
+        self._t_end = t_end
+        self._stop_event.set()
+        self.join()
+
+        if self.error is not None:
+            raise RuntimeError('Writing data to ' + self.fname + ' failed') from self.error